@@ -0,0 +1,177 @@
+#ifndef _CARDATA_H_
+#define _CARDATA_H_
+
+/* Layout of the CarData structure shared with cardata_shmem.py. Everything between
+   the AUTO markers is generated by update_cardata_fields.py. */
+
+#include <stddef.h>
+#include <stdint.h>
+
+typedef struct {
+    //AUTO START : struct CarData
+    uint32_t wrc;
+    uint32_t fuel_ctr;
+    uint32_t odometer;
+    uint32_t scflags;
+    uint32_t lat;
+    uint32_t lon;
+    uint16_t wrc1;
+    uint16_t wrc2;
+    uint16_t mga_rpm;
+    uint16_t mgb_rpm;
+    uint16_t speed;
+    uint16_t hv_amps;
+    uint16_t mga_amps;
+    uint16_t mgb_amps;
+    uint16_t hv_volts;
+    uint16_t mga_volts;
+    uint16_t mgb_volts;
+    uint16_t steer;
+    uint16_t engine_rpm;
+    uint16_t ev_range_rem;
+    uint16_t ccspeed;
+    uint8_t brake;
+    uint8_t accel;
+    uint8_t climate_power;
+    uint8_t climate_mode;
+    uint8_t heat_ac;
+    uint8_t battery_raw_soc;
+    uint8_t battery_soc;
+    uint8_t clutch_state;
+    uint8_t ccbtn;
+    uint8_t radiobtn;
+    uint8_t coolant_temp;
+    uint8_t intake_temp;
+    uint8_t battery_temp;
+    uint8_t air_temp1;
+    uint8_t air_temp2;
+    uint8_t air_pressure;
+    uint8_t tire_ft_lf;
+    uint8_t tire_rr_lf;
+    uint8_t tire_ft_rt;
+    uint8_t tire_rr_rt;
+    uint8_t oil_life;
+    uint8_t fanspeed;
+    uint8_t vent;
+    uint8_t select_fanspeed;
+    uint8_t select_temp;
+    uint8_t recirc;
+    uint8_t gear;
+    uint8_t drive_mode;
+    uint8_t rear_defrost;
+    uint8_t motion_state;
+    uint32_t fw_millis;
+    //AUTO END
+} cardata_t;
+
+//AUTO START : cardata offsets
+#define CARDATA_OFS_WRC 0
+#define CARDATA_OFS_FUEL_CTR 4
+#define CARDATA_OFS_ODOMETER 8
+#define CARDATA_OFS_SCFLAGS 12
+#define CARDATA_OFS_LAT 16
+#define CARDATA_OFS_LON 20
+#define CARDATA_OFS_WRC1 24
+#define CARDATA_OFS_WRC2 26
+#define CARDATA_OFS_MGA_RPM 28
+#define CARDATA_OFS_MGB_RPM 30
+#define CARDATA_OFS_SPEED 32
+#define CARDATA_OFS_HV_AMPS 34
+#define CARDATA_OFS_MGA_AMPS 36
+#define CARDATA_OFS_MGB_AMPS 38
+#define CARDATA_OFS_HV_VOLTS 40
+#define CARDATA_OFS_MGA_VOLTS 42
+#define CARDATA_OFS_MGB_VOLTS 44
+#define CARDATA_OFS_STEER 46
+#define CARDATA_OFS_ENGINE_RPM 48
+#define CARDATA_OFS_EV_RANGE_REM 50
+#define CARDATA_OFS_CCSPEED 52
+#define CARDATA_OFS_BRAKE 54
+#define CARDATA_OFS_ACCEL 55
+#define CARDATA_OFS_CLIMATE_POWER 56
+#define CARDATA_OFS_CLIMATE_MODE 57
+#define CARDATA_OFS_HEAT_AC 58
+#define CARDATA_OFS_BATTERY_RAW_SOC 59
+#define CARDATA_OFS_BATTERY_SOC 60
+#define CARDATA_OFS_CLUTCH_STATE 61
+#define CARDATA_OFS_CCBTN 62
+#define CARDATA_OFS_RADIOBTN 63
+#define CARDATA_OFS_COOLANT_TEMP 64
+#define CARDATA_OFS_INTAKE_TEMP 65
+#define CARDATA_OFS_BATTERY_TEMP 66
+#define CARDATA_OFS_AIR_TEMP1 67
+#define CARDATA_OFS_AIR_TEMP2 68
+#define CARDATA_OFS_AIR_PRESSURE 69
+#define CARDATA_OFS_TIRE_FT_LF 70
+#define CARDATA_OFS_TIRE_RR_LF 71
+#define CARDATA_OFS_TIRE_FT_RT 72
+#define CARDATA_OFS_TIRE_RR_RT 73
+#define CARDATA_OFS_OIL_LIFE 74
+#define CARDATA_OFS_FANSPEED 75
+#define CARDATA_OFS_VENT 76
+#define CARDATA_OFS_SELECT_FANSPEED 77
+#define CARDATA_OFS_SELECT_TEMP 78
+#define CARDATA_OFS_RECIRC 79
+#define CARDATA_OFS_GEAR 80
+#define CARDATA_OFS_DRIVE_MODE 81
+#define CARDATA_OFS_REAR_DEFROST 82
+#define CARDATA_OFS_MOTION_STATE 83
+#define CARDATA_OFS_FW_MILLIS 84
+#define CARDATA_SIZE 88
+
+_Static_assert(offsetof(cardata_t, wrc) == CARDATA_OFS_WRC, "cardata_t.wrc moved");
+_Static_assert(offsetof(cardata_t, fuel_ctr) == CARDATA_OFS_FUEL_CTR, "cardata_t.fuel_ctr moved");
+_Static_assert(offsetof(cardata_t, odometer) == CARDATA_OFS_ODOMETER, "cardata_t.odometer moved");
+_Static_assert(offsetof(cardata_t, scflags) == CARDATA_OFS_SCFLAGS, "cardata_t.scflags moved");
+_Static_assert(offsetof(cardata_t, lat) == CARDATA_OFS_LAT, "cardata_t.lat moved");
+_Static_assert(offsetof(cardata_t, lon) == CARDATA_OFS_LON, "cardata_t.lon moved");
+_Static_assert(offsetof(cardata_t, wrc1) == CARDATA_OFS_WRC1, "cardata_t.wrc1 moved");
+_Static_assert(offsetof(cardata_t, wrc2) == CARDATA_OFS_WRC2, "cardata_t.wrc2 moved");
+_Static_assert(offsetof(cardata_t, mga_rpm) == CARDATA_OFS_MGA_RPM, "cardata_t.mga_rpm moved");
+_Static_assert(offsetof(cardata_t, mgb_rpm) == CARDATA_OFS_MGB_RPM, "cardata_t.mgb_rpm moved");
+_Static_assert(offsetof(cardata_t, speed) == CARDATA_OFS_SPEED, "cardata_t.speed moved");
+_Static_assert(offsetof(cardata_t, hv_amps) == CARDATA_OFS_HV_AMPS, "cardata_t.hv_amps moved");
+_Static_assert(offsetof(cardata_t, mga_amps) == CARDATA_OFS_MGA_AMPS, "cardata_t.mga_amps moved");
+_Static_assert(offsetof(cardata_t, mgb_amps) == CARDATA_OFS_MGB_AMPS, "cardata_t.mgb_amps moved");
+_Static_assert(offsetof(cardata_t, hv_volts) == CARDATA_OFS_HV_VOLTS, "cardata_t.hv_volts moved");
+_Static_assert(offsetof(cardata_t, mga_volts) == CARDATA_OFS_MGA_VOLTS, "cardata_t.mga_volts moved");
+_Static_assert(offsetof(cardata_t, mgb_volts) == CARDATA_OFS_MGB_VOLTS, "cardata_t.mgb_volts moved");
+_Static_assert(offsetof(cardata_t, steer) == CARDATA_OFS_STEER, "cardata_t.steer moved");
+_Static_assert(offsetof(cardata_t, engine_rpm) == CARDATA_OFS_ENGINE_RPM, "cardata_t.engine_rpm moved");
+_Static_assert(offsetof(cardata_t, ev_range_rem) == CARDATA_OFS_EV_RANGE_REM, "cardata_t.ev_range_rem moved");
+_Static_assert(offsetof(cardata_t, ccspeed) == CARDATA_OFS_CCSPEED, "cardata_t.ccspeed moved");
+_Static_assert(offsetof(cardata_t, brake) == CARDATA_OFS_BRAKE, "cardata_t.brake moved");
+_Static_assert(offsetof(cardata_t, accel) == CARDATA_OFS_ACCEL, "cardata_t.accel moved");
+_Static_assert(offsetof(cardata_t, climate_power) == CARDATA_OFS_CLIMATE_POWER, "cardata_t.climate_power moved");
+_Static_assert(offsetof(cardata_t, climate_mode) == CARDATA_OFS_CLIMATE_MODE, "cardata_t.climate_mode moved");
+_Static_assert(offsetof(cardata_t, heat_ac) == CARDATA_OFS_HEAT_AC, "cardata_t.heat_ac moved");
+_Static_assert(offsetof(cardata_t, battery_raw_soc) == CARDATA_OFS_BATTERY_RAW_SOC, "cardata_t.battery_raw_soc moved");
+_Static_assert(offsetof(cardata_t, battery_soc) == CARDATA_OFS_BATTERY_SOC, "cardata_t.battery_soc moved");
+_Static_assert(offsetof(cardata_t, clutch_state) == CARDATA_OFS_CLUTCH_STATE, "cardata_t.clutch_state moved");
+_Static_assert(offsetof(cardata_t, ccbtn) == CARDATA_OFS_CCBTN, "cardata_t.ccbtn moved");
+_Static_assert(offsetof(cardata_t, radiobtn) == CARDATA_OFS_RADIOBTN, "cardata_t.radiobtn moved");
+_Static_assert(offsetof(cardata_t, coolant_temp) == CARDATA_OFS_COOLANT_TEMP, "cardata_t.coolant_temp moved");
+_Static_assert(offsetof(cardata_t, intake_temp) == CARDATA_OFS_INTAKE_TEMP, "cardata_t.intake_temp moved");
+_Static_assert(offsetof(cardata_t, battery_temp) == CARDATA_OFS_BATTERY_TEMP, "cardata_t.battery_temp moved");
+_Static_assert(offsetof(cardata_t, air_temp1) == CARDATA_OFS_AIR_TEMP1, "cardata_t.air_temp1 moved");
+_Static_assert(offsetof(cardata_t, air_temp2) == CARDATA_OFS_AIR_TEMP2, "cardata_t.air_temp2 moved");
+_Static_assert(offsetof(cardata_t, air_pressure) == CARDATA_OFS_AIR_PRESSURE, "cardata_t.air_pressure moved");
+_Static_assert(offsetof(cardata_t, tire_ft_lf) == CARDATA_OFS_TIRE_FT_LF, "cardata_t.tire_ft_lf moved");
+_Static_assert(offsetof(cardata_t, tire_rr_lf) == CARDATA_OFS_TIRE_RR_LF, "cardata_t.tire_rr_lf moved");
+_Static_assert(offsetof(cardata_t, tire_ft_rt) == CARDATA_OFS_TIRE_FT_RT, "cardata_t.tire_ft_rt moved");
+_Static_assert(offsetof(cardata_t, tire_rr_rt) == CARDATA_OFS_TIRE_RR_RT, "cardata_t.tire_rr_rt moved");
+_Static_assert(offsetof(cardata_t, oil_life) == CARDATA_OFS_OIL_LIFE, "cardata_t.oil_life moved");
+_Static_assert(offsetof(cardata_t, fanspeed) == CARDATA_OFS_FANSPEED, "cardata_t.fanspeed moved");
+_Static_assert(offsetof(cardata_t, vent) == CARDATA_OFS_VENT, "cardata_t.vent moved");
+_Static_assert(offsetof(cardata_t, select_fanspeed) == CARDATA_OFS_SELECT_FANSPEED, "cardata_t.select_fanspeed moved");
+_Static_assert(offsetof(cardata_t, select_temp) == CARDATA_OFS_SELECT_TEMP, "cardata_t.select_temp moved");
+_Static_assert(offsetof(cardata_t, recirc) == CARDATA_OFS_RECIRC, "cardata_t.recirc moved");
+_Static_assert(offsetof(cardata_t, gear) == CARDATA_OFS_GEAR, "cardata_t.gear moved");
+_Static_assert(offsetof(cardata_t, drive_mode) == CARDATA_OFS_DRIVE_MODE, "cardata_t.drive_mode moved");
+_Static_assert(offsetof(cardata_t, rear_defrost) == CARDATA_OFS_REAR_DEFROST, "cardata_t.rear_defrost moved");
+_Static_assert(offsetof(cardata_t, motion_state) == CARDATA_OFS_MOTION_STATE, "cardata_t.motion_state moved");
+_Static_assert(offsetof(cardata_t, fw_millis) == CARDATA_OFS_FW_MILLIS, "cardata_t.fw_millis moved");
+_Static_assert(sizeof(cardata_t) == CARDATA_SIZE, "cardata_t size changed");
+//AUTO END
+
+#endif
@@ -5,7 +5,7 @@ bsmod = Extension('bitstream',
                      #library_dirs=[''],
                      include_dirs=[],
                      sources=['bitstream.c'],
-                     depends=['bitstream.inc', 'setup.py'],
+                     depends=['bitstream.inc', 'cardata.h', 'setup.py'],
                      )
 
 setup(name="BitStream",
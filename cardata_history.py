@@ -0,0 +1,99 @@
+import ctypes
+
+from cardata_shmem import ShareableStructure, CarData, HEADER_SIZE, CARDATA_LAYOUT
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PATH = '/dev/shm/cardata_history'
+
+# Must be a power of 2. Data frames arrive at roughly 20 Hz, so this holds a little
+# over 13 minutes of driving.
+HISTORY_FRAMES = 16384
+
+def _history_fields():
+    fields = [
+        ('head', ctypes.c_uint64),
+        ('capacity', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32),
+        ('stxtime', ctypes.c_uint64 * HISTORY_FRAMES),
+    ]
+    for name, typ in CarData._fields_:
+        fields.append((name, typ * HISTORY_FRAMES))
+    return fields
+
+class CarDataHistory(ShareableStructure):
+    '''Ring of the most recent CarData frames, stored as one array per field.
+
+    head counts every frame ever written; frame number n lives in slot
+    n & (capacity - 1). The writer fills in a slot and then advances head, so any
+    slot below head is complete until head moves a full capacity past it.'''
+
+    _fields_ = _history_fields()
+
+    @classmethod
+    def create(cls, path=PATH):
+        self = super().create(path)
+        if self.capacity != HISTORY_FRAMES:
+            self.head = 0
+            self.capacity = HISTORY_FRAMES
+        return self
+
+    def append(self, cd, stxtime):
+        columns = self.__dict__.get('_columns')
+        if columns is None:
+            columns = self._columns = [(name, getattr(self, name)) for name, typ in CarData._fields_]
+            self._stxtime = self.stxtime
+
+        head = self.head
+        idx = head & (HISTORY_FRAMES - 1)
+        self._stxtime[idx] = stxtime
+        for name, arr in columns:
+            arr[idx] = getattr(cd, name)
+        self.head = head + 1
+
+    def numpy_view(self):
+        '''Zero-copy NumPy view of the whole ring. Fields are arrays indexed by slot,
+        not by age; use recent() for frames in order.'''
+        return np.frombuffer(self._mmap, dtype=history_dtype(), count=1, offset=HEADER_SIZE)[0]
+
+    def recent(self, nframes=None):
+        '''Return the last nframes frames (all available if None) as a NumPy structured
+        array, oldest first. Frames overwritten while copying are dropped.'''
+        view = self.numpy_view()
+        names = ['stxtime'] + [name for name, typ in CarData._fields_]
+
+        head = int(view['head'])
+        avail = min(head, HISTORY_FRAMES)
+        if nframes is None or nframes > avail:
+            nframes = avail
+
+        start = head - nframes
+        slots = np.arange(start, head, dtype=np.uint64) & (HISTORY_FRAMES - 1)
+        out = np.empty(nframes, dtype=frame_dtype())
+        for name in names:
+            out[name] = view[name][slots]
+
+        # Anything the writer lapped during the copy may be a mix of old and new data
+        lapped = int(view['head']) + 1 - HISTORY_FRAMES - start
+        if lapped > 0:
+            out = out[lapped:]
+        return out
+
+def history_dtype():
+    return np.dtype(CarDataHistory)
+
+def frame_dtype():
+    '''dtype for one row of CarDataHistory.recent().'''
+    return np.dtype([('stxtime', np.uint64)] + [(name, typ) for name, typ, offset in CARDATA_LAYOUT])
+
+def main():
+    hist = CarDataHistory.create()
+    frames = hist.recent(10)
+    for row in frames:
+        print(' '.join('%s=%s' % (name, row[name]) for name in ('stxtime', 'fw_millis', 'rawspeed', 'hv_amps', 'hv_volts', 'battery_soc')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+'''Checks that the ctypes, C, struct and NumPy views of CarData all agree with the
+layout computed by update_cardata_fields.py. Runs under pytest or as a script.'''
+import re
+import shutil
+import struct
+import ctypes
+import subprocess
+from os.path import dirname, join
+
+import pytest
+
+import update_cardata_fields as ucf
+from cardata_shmem import CarData, CARDATA_LAYOUT, CARDATA_SIZE, CARDATA_STRUCT_FORMAT, cardata_dtype, np
+
+CARDATA_H = join(dirname(__file__) or '.', 'bitstream', 'cardata.h')
+
+rxofs = re.compile(r'^#define CARDATA_OFS_(\w+) (\d+)$', re.M)
+rxsize = re.compile(r'^#define CARDATA_SIZE (\d+)$', re.M)
+
+def sample_cardata():
+    cd = CarData()
+    for i, (name, typ) in enumerate(CarData._fields_):
+        setattr(cd, name, i + 1)
+    return cd
+
+def test_ctypes_layout():
+    assert ctypes.sizeof(CarData) == ucf.layout_size
+    assert [name for name, typ in CarData._fields_] == [logname for mcname, logname, typbits, signed, offset in ucf.layout]
+    for mcname, logname, typbits, signed, offset in ucf.layout:
+        typ = dict(CarData._fields_)[logname]
+        assert getattr(CarData, logname).offset == offset, logname
+        assert ctypes.sizeof(typ) * 8 == typbits, logname
+        assert (typ(-1).value < 0) == bool(signed), logname
+
+def test_generated_python_layout():
+    expect = [(logname, '%s%d' % ('i' if signed else 'u', typbits // 8), offset)
+              for mcname, logname, typbits, signed, offset in ucf.layout]
+    assert [tuple(v) for v in CARDATA_LAYOUT] == expect
+    assert CARDATA_SIZE == ucf.layout_size
+    assert CARDATA_STRUCT_FORMAT == ucf.struct_format()
+
+def test_struct_format():
+    assert struct.calcsize(CARDATA_STRUCT_FORMAT) == ctypes.sizeof(CarData)
+    cd = sample_cardata()
+    values = struct.unpack(CARDATA_STRUCT_FORMAT, bytes(cd))
+    assert values == tuple(getattr(cd, name) for name, typ in CarData._fields_)
+
+def test_c_layout():
+    with open(CARDATA_H) as fp:
+        text = fp.read()
+
+    offsets = {name.lower(): int(ofs) for name, ofs in rxofs.findall(text)}
+    assert offsets == {mcname: offset for mcname, logname, typbits, signed, offset in ucf.layout}
+    assert int(rxsize.search(text).group(1)) == ucf.layout_size
+
+    # The header checks its own offsets with _Static_assert, so compiling it is enough
+    cc = shutil.which('cc') or shutil.which('gcc')
+    if cc is None:
+        pytest.skip('no C compiler to check cardata.h with')
+    subprocess.run([cc, '-std=c11', '-fsyntax-only', '-x', 'c', CARDATA_H], check=True)
+
+def test_numpy_layout():
+    pytest.importorskip('numpy')
+
+    dt = cardata_dtype()
+    assert dt.itemsize == ctypes.sizeof(CarData)
+    ctdt = np.dtype(CarData)
+    assert dt.names == ctdt.names
+    for name in dt.names:
+        assert dt.fields[name][:2] == ctdt.fields[name][:2], name
+
+    cd = sample_cardata()
+    view = cd.numpy_view()
+    for name, typ in CarData._fields_:
+        assert view[name] == getattr(cd, name), name
+
+    # The view must alias the structure, not copy it
+    cd.fw_millis = 123456
+    assert view['fw_millis'] == 123456
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
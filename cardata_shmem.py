@@ -1,11 +1,39 @@
 import os
+import time
 import ctypes
 import mmap
 import weakref
 
+from futex import futex_wake, wait_seq
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class ShmHeader(ctypes.Structure):
+    '''Precedes the structure data in every shared file.
+
+    seq is a sequence lock: the writer makes it odd before modifying the structure and
+    even again afterwards. Readers copy the data and retry if seq was odd or changed
+    while they were copying.'''
+    _fields_ = [
+        ('seq', ctypes.c_uint32),
+        ('size', ctypes.c_uint32),
+    ]
+
+HEADER_SIZE = ctypes.sizeof(ShmHeader)
+
+# How long snapshot() waits for an update in progress. A writer that died between
+# begin_write() and end_write() leaves seq odd for good.
+SNAPSHOT_TIMEOUT = 0.1
+
 class ShareableStructure(ctypes.Structure):
     _fields_ = []
 
+    # Only set for instances created with create(); plain instances have no header
+    _hdr = None
+
     @classmethod
     def create(cls, path):
         fd = mm = None
@@ -13,13 +41,16 @@ class ShareableStructure(ctypes.Structure):
             if mm is not None:
                 mm.close()
         try:
-            size = ctypes.sizeof(cls)
+            size = HEADER_SIZE + ctypes.sizeof(cls)
             fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
             fsize = os.lseek(fd, 0, 2)
             if fsize < size:
                 os.ftruncate(fd, size)
             mm = mmap.mmap(fd, size)
-            self = cls.from_buffer(mm)
+            hdr = ShmHeader.from_buffer(mm)
+            hdr.size = ctypes.sizeof(cls)
+            self = cls.from_buffer(mm, HEADER_SIZE)
+            self._hdr = hdr
             self._wr = weakref.ref(self, closemm)
             self._mmap = mm
             mm = None
@@ -29,6 +60,130 @@ class ShareableStructure(ctypes.Structure):
 
         return self
 
+    @property
+    def seq(self):
+        hdr = self._hdr
+        return 0 if hdr is None else hdr.seq
+
+    def begin_write(self):
+        '''Mark the start of an update. Must be paired with end_write().'''
+        hdr = self._hdr
+        if hdr is not None:
+            hdr.seq |= 1
+
+    def end_write(self):
+        '''Mark the end of an update and wake any processes in wait_update().'''
+        hdr = self._hdr
+        if hdr is not None:
+            hdr.seq = (hdr.seq | 1) + 1
+            futex_wake(ctypes.addressof(hdr))
+
+    def wait_update(self, last_seq, timeout=None):
+        '''Block until an update newer than last_seq has completed. Returns the new
+        sequence number, or None if timeout seconds pass first. Only structures
+        opened with create() have the header this waits on.'''
+        if self._hdr is None:
+            raise ValueError('%s has no shared header to wait on; open it with create()' % type(self).__name__)
+        return wait_seq(self._hdr, last_seq, timeout)
+
+    def snapshot(self, timeout=SNAPSHOT_TIMEOUT):
+        '''Return a private copy of the structure that reflects exactly one completed
+        update. Never blocks the writer; only retries if an update was in progress,
+        and returns None if none completes within timeout seconds.'''
+        hdr = self._hdr
+        cls = type(self)
+        if hdr is None:
+            return cls.from_buffer_copy(self)
+
+        deadline = None
+        while True:
+            seq = hdr.seq
+            if seq & 1:
+                if deadline is None:
+                    deadline = time.monotonic() + timeout
+                elif time.monotonic() >= deadline:
+                    return None
+                os.sched_yield()
+                continue
+
+            copy = cls.from_buffer_copy(self)
+            if hdr.seq == seq:
+                copy.snapshot_seq = seq
+                return copy
+
+# (name, NumPy type, offset) for each CarData field. Generated together with the
+# ctypes fields below and cardata_t in bitstream/cardata.h so all three agree.
+CARDATA_LAYOUT = [
+    #AUTO START : numpy CarData layout
+    ('wrc3', 'u4', 0),
+    ('fuel_ctr', 'u4', 4),
+    ('raw_odometer', 'u4', 8),
+    ('scflags', 'u4', 12),
+    ('lat', 'i4', 16),
+    ('lon', 'i4', 20),
+    ('wrc1', 'u2', 24),
+    ('wrc2', 'u2', 26),
+    ('mga_rpm', 'i2', 28),
+    ('mgb_rpm', 'i2', 30),
+    ('rawspeed', 'u2', 32),
+    ('hv_amps', 'i2', 34),
+    ('mga_amps', 'i2', 36),
+    ('mgb_amps', 'i2', 38),
+    ('hv_volts', 'u2', 40),
+    ('mga_volts', 'u2', 42),
+    ('mgb_volts', 'u2', 44),
+    ('steer', 'i2', 46),
+    ('rpm', 'u2', 48),
+    ('range', 'u2', 50),
+    ('rawccspeed', 'u2', 52),
+    ('brake_pct', 'u1', 54),
+    ('accel_pct', 'u1', 55),
+    ('climate_power', 'u1', 56),
+    ('climate_mode', 'u1', 57),
+    ('heat_ac', 'u1', 58),
+    ('battery_raw_soc', 'u1', 59),
+    ('battery_soc', 'u1', 60),
+    ('clutch_state', 'u1', 61),
+    ('ccbtn', 'u1', 62),
+    ('radiobtn', 'u1', 63),
+    ('coolant_temp', 'u1', 64),
+    ('intake_temp', 'u1', 65),
+    ('battery_temp', 'u1', 66),
+    ('air_temp1', 'u1', 67),
+    ('air_temp2', 'u1', 68),
+    ('air_pressure', 'u1', 69),
+    ('tire_ft_lf', 'u1', 70),
+    ('tire_rr_lf', 'u1', 71),
+    ('tire_ft_rt', 'u1', 72),
+    ('tire_rr_rt', 'u1', 73),
+    ('oil_life', 'u1', 74),
+    ('fanspeed', 'u1', 75),
+    ('vent', 'u1', 76),
+    ('select_fanspeed', 'u1', 77),
+    ('select_temp', 'u1', 78),
+    ('recirc', 'u1', 79),
+    ('gear', 'u1', 80),
+    ('drive_mode', 'u1', 81),
+    ('rear_defrost', 'u1', 82),
+    ('motion_state', 'u1', 83),
+    ('fw_millis', 'u4', 84),
+    #AUTO END
+]
+
+#AUTO START : CarData size and format
+CARDATA_SIZE = 88
+CARDATA_STRUCT_FORMAT = '=4I2i2H2hH3h3Hh3H30BI'
+#AUTO END
+
+def cardata_dtype():
+    '''NumPy structured dtype with the same layout as CarData.'''
+    return np.dtype({
+        'names': [name for name, typ, offset in CARDATA_LAYOUT],
+        'formats': [typ for name, typ, offset in CARDATA_LAYOUT],
+        'offsets': [offset for name, typ, offset in CARDATA_LAYOUT],
+        'itemsize': CARDATA_SIZE,
+    })
+
 class CarData(ShareableStructure):
     _fields_ = [
         #AUTO START : ctypes CarData fields
@@ -82,12 +237,16 @@ class CarData(ShareableStructure):
         ('gear', ctypes.c_uint8),
         ('drive_mode', ctypes.c_uint8),
         ('rear_defrost', ctypes.c_uint8),
-        #AUTO END
         ('motion_state', ctypes.c_uint8),
         ('fw_millis', ctypes.c_uint32),
+        #AUTO END
     ]
 
     odometer = 0
     odometer_km = 0
     trip_distance = 0
     trip_ev_distance = 0
+
+    def numpy_view(self):
+        '''Zero-copy NumPy record referring to this structure's memory.'''
+        return np.frombuffer(self, dtype=cardata_dtype(), count=1)[0]
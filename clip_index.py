@@ -0,0 +1,110 @@
+'''Metadata for every clip on a camera's card, kept in one SQLite file per camera.
+
+Each clip's row holds the size and mtime it had when it was last probed, and its
+metadata (duration, begin time, new name, merge info) as JSON. A clip whose size
+or mtime no longer match is a different clip, e.g. after the card was formatted,
+and starts over with no metadata.
+
+All rows are read when the index is opened. Changes are collected and written
+in one transaction by commit(), so a rescan of an unchanged card writes nothing.
+
+Metadata from the older one-JSON-file-per-clip directory is imported the first
+time the index is opened, so clips keep the names they were uploaded under.
+'''
+import os
+import json
+import sqlite3
+from os.path import join, exists
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clips (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    data TEXT NOT NULL
+)
+'''
+
+def encode(data):
+    return json.dumps(data, sort_keys=True)
+
+class ClipIndex:
+    def __init__(self, path, legacy_dir=None):
+        self.path = path
+        new = not exists(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(SCHEMA)
+
+        # name -> (size, mtime, data as stored)
+        self.rows = {name: (size, mtime, data) for name, size, mtime, data in
+                     self.db.execute('SELECT name, size, mtime, data FROM clips')}
+        self.changed = {}
+        self.seen = set()
+
+        if new and legacy_dir is not None:
+            self.import_json(legacy_dir)
+
+    def import_json(self, metadir):
+        '''Take over the metadata in an old directory of <clip>.json files. Files that
+        can't be imported are left in place.'''
+        try:
+            files = [fn for fn in os.listdir(metadir) if fn.endswith('.json')]
+        except FileNotFoundError:
+            return
+
+        imported = []
+        for fn in files:
+            try:
+                with open(join(metadir, fn)) as fp:
+                    data = json.load(fp)
+                name = fn[:-len('.json')]
+                self.rows[name] = data['size'], data['mtime'], encode(data)
+                self.changed[name] = self.rows[name]
+                imported.append(fn)
+            except (ValueError, KeyError, OSError) as e:
+                # Left where it is, to be looked at
+                print('%s: not importing: %s' % (fn, e))
+
+        self.commit(prune=False)
+        for fn in imported:
+            os.unlink(join(metadir, fn))
+        print('imported metadata for %d of %d clips from %s' % (len(imported), len(files), metadir))
+
+    def get(self, name, st):
+        '''Returns (metadata, token) for the clip called name with stat st. The
+        metadata is empty if the clip is new or has changed. Pass the token back to
+        put() so unchanged metadata isn't written.'''
+        name = name.lower()
+        self.seen.add(name)
+        row = self.rows.get(name)
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return {}, None
+        return json.loads(row[2]), row[2]
+
+    def put(self, name, data, token=None):
+        '''Store data for the clip; returns the new token.'''
+        name = name.lower()
+        txt = encode(data)
+        if txt != token:
+            self.rows[name] = self.changed[name] = data['size'], data['mtime'], txt
+        return txt
+
+    def commit(self, prune=True):
+        '''Write every change, and if prune is set, forget clips get() wasn't asked
+        about, all in one transaction.'''
+        gone = [name for name in self.rows if name not in self.seen] if prune else []
+        if not self.changed and not gone:
+            return
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?)',
+                                [(name,) + row for name, row in self.changed.items()])
+            self.db.executemany('DELETE FROM clips WHERE name = ?', [(name,) for name in gone])
+
+        for name in gone:
+            del self.rows[name]
+        self.changed = {}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+'''Checks ClipIndex from clip_index.py: metadata surviving a reopen, clips that
+changed starting over, and the import of the older JSON files. Runs under pytest or
+as a script.'''
+import os
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from clip_index import ClipIndex
+
+def stat(size, mtime):
+    return SimpleNamespace(st_size=size, st_mtime=mtime)
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / 'cam.db')
+    index = ClipIndex(path)
+    data, token = index.get('A.MOV', stat(100, 5.0))
+    assert data == {}
+    index.put('A.MOV', {'size': 100, 'mtime': 5.0, 'newfn': 'a_new.mov'}, token)
+    index.commit()
+    index.close()
+
+    index = ClipIndex(path)
+    data, token = index.get('a.mov', stat(100, 5.0))
+    assert data['newfn'] == 'a_new.mov'
+
+    # Same name, different clip
+    data, token = index.get('a.mov', stat(200, 5.0))
+    assert data == {}
+
+def test_prune(tmp_path):
+    path = str(tmp_path / 'cam.db')
+    index = ClipIndex(path)
+    for name in ('a.mov', 'b.mov'):
+        data, token = index.get(name, stat(1, 1.0))
+        index.put(name, {'size': 1, 'mtime': 1.0}, token)
+    index.commit()
+    index.close()
+
+    index = ClipIndex(path)
+    index.get('a.mov', stat(1, 1.0))
+    index.commit()
+    assert set(index.rows) == {'a.mov'}
+
+def test_import_keeps_bad_files(tmp_path):
+    legacy = tmp_path / 'meta'
+    legacy.mkdir()
+    with open(str(legacy / 'a.mov.json'), 'w') as fp:
+        json.dump({'size': 10, 'mtime': 2.0, 'newfn': 'a_new.mov'}, fp)
+    with open(str(legacy / 'b.mov.json'), 'w') as fp:
+        fp.write('{not json')
+    with open(str(legacy / 'c.mov.json'), 'w') as fp:
+        json.dump({'newfn': 'no size'}, fp)
+
+    index = ClipIndex(str(tmp_path / 'cam.db'), str(legacy))
+    assert index.get('a.mov', stat(10, 2.0))[0]['newfn'] == 'a_new.mov'
+    assert sorted(os.listdir(str(legacy))) == ['b.mov.json', 'c.mov.json']
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ import statistics
 from os.path import dirname, basename, join, exists, expanduser
 
 from utils import load_config, CONFIG, getmtime, get_iface_address
+from metrics import Metrics
 
 def main():
     p = argparse.ArgumentParser(description='')
@@ -26,6 +27,14 @@ def main():
 
     remote_addr = CONFIG['info_server'], CONFIG['info_port']
 
+    metrics = Metrics('clock_monitor')
+    m_queries = metrics.counter('queries')
+    m_replies = metrics.counter('replies')
+    m_corrections = metrics.counter('corrections')
+    m_errors = metrics.counter('errors')
+    m_drift = metrics.gauge('drift', 's')
+    m_spread = metrics.gauge('sample_spread', 's')
+
 
     sock = None
     last_iface_address = -1
@@ -59,6 +68,7 @@ def main():
                     if cmtime >= next_clock_query:
                         next_clock_query = cmtime + 600
                     print('query clock')
+                    m_queries.inc()
                     idle = False
                     samples = []
                     next_pkt_send = cmtime
@@ -83,6 +93,7 @@ def main():
                         origmtime, cwtime = struct.unpack('>dd', pkt[2:])
                         offset = cwtime + (cmtime - origmtime) / 2 -  cmtime
                         #print(offset)
+                        m_replies.inc()
                         samples.append(offset)
                         if len(samples) >= 10:
                             samples.sort()
@@ -95,11 +106,15 @@ def main():
                             walltime = time.time()
                             diff = calctime - walltime
                             txt = 'clock drift %.3f [%.3f, %.3f]' % (diff, low, hi)
+                            m_drift.set(diff)
+                            m_spread.set(hi - low)
                             if abs(diff) > 0.5:
+                                m_corrections.inc()
                                 time.clock_settime(time.CLOCK_REALTIME, calctime)
                                 txt += ' (corrected)'
                             print(txt)
         except Exception:
+            m_errors.inc()
             traceback.print_exc()
             time.sleep(1)
 
@@ -13,6 +13,7 @@ from os.path import dirname, basename, join, exists, expanduser
 from utils import load_config, CONFIG, getmtime, setup_gpio, set_gpio
 
 import i2c_shmem
+from metrics import Metrics
 
 GPIO_ACT = 20
 
@@ -51,6 +52,14 @@ class Manager:
 
         self.i2c_data = i2c_shmem.I2CData.create(i2c_shmem.PATH)
 
+        self.metrics = m = Metrics('dashcam_monitor')
+        self.m_state_changes = m.counter('state_changes')
+        self.m_copies = m.counter('copies')
+        self.m_copy_failures = m.counter('copy_failures')
+        self.m_mounts = m.counter('mounts')
+        self.m_mount_failures = m.counter('mount_failures')
+        self.m_check_time = m.histogram('check_time')
+
         self.all_subprocesses = []
         self.led_flash_base = 0
         self.led_flash_period = 1
@@ -58,7 +67,7 @@ class Manager:
         self.set_state(self.curstate)
         self.cameras = []
         for i, cam in enumerate(CONFIG['cameras']):
-            self.cameras.append(Camera(i, DISK_PATH_BASE + cam['label'], cam['mountpath'], cam.get('copyname', None), cam.get('sequential', False), cam.get('forcetz', None), cam.get('storage', False)))
+            self.cameras.append(Camera(i, DISK_PATH_BASE + cam['label'], cam['mountpath'], cam.get('copyname', None), cam.get('sequential', False), cam.get('forcetz', None), cam.get('storage', False), cam.get('priority', 1)))
 
     def check_flag(self, flag):
         return exists(join(self.flag_path, flag))
@@ -144,6 +153,7 @@ class Manager:
         oldstate.exit(self, newstate)
 
         print('change state %s -> %s' % (oldstate, newstate))
+        self.m_state_changes.inc()
         for j in range(2):
             send_serial_info('CS=%s' % newstate.state_code)
         with open(join(self.flag_path, 'state'), 'w') as fp:
@@ -198,12 +208,15 @@ class Manager:
 
     def run(self):
         while True:
-            if not self.check_state():
+            st = getmtime()
+            changed = self.check_state()
+            self.m_check_time.observe((getmtime() - st) * 1000)
+            if not changed:
                 sleeptime = min(0.2, self.update_led_state())
                 time.sleep(sleeptime)
 
 class Camera:
-    def __init__(self, index, disk_path, mount_path, output_name, sequential, forcetz=None, storage=False):
+    def __init__(self, index, disk_path, mount_path, output_name, sequential, forcetz=None, storage=False, priority=1):
         self.index = index
         self.disk_path = disk_path
         self.mount_path = mount_path
@@ -212,6 +225,9 @@ class Camera:
         self.forcetz = forcetz
         self.storage = storage
 
+        # Share of the upload streams when cameras copy at the same time
+        self.priority = priority
+
         self.timeout = 0
         self.mount_rw = False
         self.want_mount = False
@@ -240,6 +256,7 @@ class Camera:
                     self.mount_process.send_signal(signal.SIGINT)
 
                 print('%s: mount timed out' % self.output_name)
+                mgr.m_mount_failures.inc()
                 self.state_time = ctime
                 self.want_mount = False
                 self.mount_state = NOT_MOUNTED
@@ -260,8 +277,10 @@ class Camera:
                     self.mount_process = None
                     print('%s: mount script status = %d' % (self.output_name, rc))
                     if rc == 0:
+                        mgr.m_mounts.inc()
                         self.mount_state = MOUNTED
                     else:
+                        mgr.m_mount_failures.inc()
                         self.want_mount = False
                         self.mount_state = NOT_MOUNTED
 
@@ -366,7 +385,7 @@ class IdleState(State):
             for cam in mgr.cameras:
                 cam.mount_rw = cam.storage
                 cam.want_mount = True
-            return WaitMountState(0, CopyOpts(local=True))
+            return WaitMountState(CopyOpts(local=True))
 
 class IdleStateFlash(IdleState):
     led_flash = [0, 1, .1, .1, .1, .1, .5]
@@ -450,57 +469,84 @@ class WifiWaitState(State):
                     cam.mount_rw = False
                     cam.want_mount = True
 
-            return WaitMountState(0, CopyOpts(local=False))
+            return WaitMountState(CopyOpts(local=False))
 
     def on_timeout(self, mgr):
         mgr.need_check = False
         return super().on_timeout(mgr)
 
-class IndexState(State):
-    def __init__(self, idx, opts):
-        self.camera_index = idx
-        self.opts = opts
+def finish_copy(mgr, opts):
+    '''Every camera has been copied; don't copy again until asked.'''
+    if opts.local:
+        mgr.want_lcopy = False
+    else:
+        mgr.need_check = False
 
-    def __str__(self):
-        return '%s(%d)' % (type(self).__name__, self.camera_index)
+def copy_cameras(mgr):
+    '''Cameras that a copy should wait for.'''
+    return [cam for cam in mgr.cameras
+            if not cam.storage and not mgr.check_flag('nocopy-%d' % cam.index)]
+
+def split_streams(cams, total):
+    '''Share total upload streams among cams by priority, at least one each.'''
+    weight = sum(cam.priority for cam in cams) or 1
+    return {cam.index: max(1, int(total * cam.priority / weight + 0.5)) for cam in cams}
 
-class WaitMountState(IndexState):
+class WaitMountState(State):
+    '''Wait for every camera to mount, then copy the ones that did.'''
     state_code = 'USB'
     gpio_dc_power = True
     led_flash = [1, .5]
 
+    def __init__(self, opts):
+        self.opts = opts
+        self.failed = set()
+
     def check_transition(self, mgr):
         if mgr.want_record or mgr.abort_all:
             return WaitUnmountState()
 
-        if self.camera_index >= len(mgr.cameras):
-            if self.opts.local:
-                mgr.want_lcopy = False
+        ready = []
+        for cam in copy_cameras(mgr):
+            if cam.mount_state == MOUNTED:
+                ready.append(cam.index)
+            elif cam.mount_state == NOT_MOUNTED:
+                if cam.index not in self.failed:
+                    print('%s: not mounted, copying the others' % cam.output_name)
+                    self.failed.add(cam.index)
+                    mgr.send_notify('usbfail')
             else:
-                mgr.need_check = False
-            return WaitUnmountState()
-
-        cam = mgr.cameras[self.camera_index]
-        if cam.storage or mgr.check_flag('nocopy-%d' % self.camera_index):
-            return WaitMountState(self.camera_index + 1, self.opts)
+                return None
 
-        if cam.mount_state == MOUNTED:
-            return RunCopyState(self.camera_index, self.opts)
-        elif cam.mount_state == NOT_MOUNTED:
-            mgr.need_check = False
-            mgr.send_notify('usbfail')
+        if not ready:
+            finish_copy(mgr, self.opts)
             return WaitUnmountState()
 
-class RunCopyState(IndexState):
+        return RunCopyState(ready, self.opts)
+
+class RunCopyState(State):
+    '''Run do_copy.py for several cameras at once. Each reads its own USB device,
+    so only the upload link is shared; it is split by camera priority.'''
     state_code = 'CPY'
     gpio_dc_power = True
     led_flash = [0, 1000]
 
-    def get_external_command(self, mgr):
-        cam = mgr.cameras[self.camera_index]
+    def __init__(self, indexes, opts):
+        self.indexes = indexes
+        self.opts = opts
+        self.procs = {}
+        self.start_time = None
+        self.failed = False
+
+    def __str__(self):
+        return '%s(%s)' % (type(self).__name__, ','.join(str(i) for i in self.indexes))
+
+    def get_copy_command(self, cam, streams):
         args = ['./do_copy.py', cam.mount_path + '/DCIM/MOVIE', cam.output_name]
         if self.opts.local:
             args.extend(['--nonotify', '--localpath', CONFIG['extra_storage']])
+        else:
+            args.extend(['--streams', str(streams)])
 
         if cam.sequential:
             args.append('--sequential')
@@ -512,7 +558,16 @@ class RunCopyState(IndexState):
         return args
 
     def enter(self, mgr, oldstate):
-        pass
+        cams = [mgr.cameras[i] for i in self.indexes]
+        streams = split_streams(cams, CONFIG.get('upload_streams', 3))
+        self.start_time = getmtime()
+        for cam in cams:
+            print('%s: copying with %d streams' % (cam.output_name, streams[cam.index]))
+            self.procs[cam.index] = mgr.start_subprocess(self.get_copy_command(cam, streams[cam.index]))
+
+    def stop_process(self):
+        for proc in self.procs.values():
+            proc.send_signal(signal.SIGINT)
 
     def check_transition(self, mgr):
         if mgr.want_record or mgr.abort_all:
@@ -524,14 +579,30 @@ class RunCopyState(IndexState):
             mgr.copy_restart = False
             mgr.send_notify('abort')
             self.stop_process()
-            return RunCopyState(self.camera_index, self.opts)
+            return RunCopyState(self.indexes, self.opts)
+
+        for idx, proc in list(self.procs.items()):
+            rcode = proc.returncode
+            if rcode is None:
+                continue
+
+            del self.procs[idx]
+            cam = mgr.cameras[idx]
+            print('%s: copy finished with status %d after %.0f s' % (cam.output_name, rcode, getmtime() - self.start_time))
+            if rcode == 0:
+                mgr.m_copies.inc()
+            else:
+                mgr.m_copy_failures.inc()
+                mgr.send_notify('fail')
+                self.failed = True
 
-    def process_complete(self, mgr, rcode):
-        if rcode == 0:
-            return WaitMountState(self.camera_index + 1, self.opts)
-        else:
-            mgr.send_notify('fail')
-            return WaitUnmountState()
+        if self.procs:
+            return None
+
+        # A failed camera is tried again next time; a clean copy isn't needed
+        if not self.failed:
+            finish_copy(mgr, self.opts)
+        return WaitUnmountState()
 
 class ManualMountExtState(State):
     state_code = 'MAN'
@@ -4,22 +4,31 @@ import re
 import time
 import os
 import stat
-import struct
 import argparse
 import subprocess
 import traceback
 import functools
 import json
+import errno
 import socket
 import select
 import fcntl
 import threading
-import copy
+import queue
+import bisect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import http.client
 import urllib.request
 import urllib.error
 
 from utils import load_config, CONFIG, getmtime
+from metrics import Metrics
+from clip_index import ClipIndex
+from mp4_atoms import ProbeFile, decode_mvhd
+import mp4_excerpt
+import upload_schedule
+from upload_schedule import Scheduler, Clip
 
 from os.path import dirname, basename, join, exists, expanduser, splitext
 
@@ -27,58 +36,161 @@ TIMEOUT = 10
 FAIL_TIMEOUT = 90
 BLOCK_SIZE = 1024 * 1024
 
-uint64 = struct.Struct('>Q')
-uint32 = struct.Struct('>I')
-uint16 = struct.Struct('>H')
+# Bounds for the adaptive upload chunk size, and how much it grows at a time
+MIN_BLOCK_SIZE = 256 * 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+BLOCK_STEP = 256 * 1024
+
+# A chunk taking longer than this risks a lot of work if it has to be retried
+SLOW_CHUNK_TIME = 4
+
+# Blocks read ahead of the upload
+READAHEAD_DEPTH = 4
+
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+# Chunks uploaded at once, each on its own connection
+DEFAULT_STREAMS = 3
+
+# New clips whose headers are read at once
+PROBE_THREADS = 4
+
+# Seconds between saves of how far each file is known to be uploaded
+PROGRESS_INTERVAL = 1
+
+# Seconds either side of a marker to cut out of the clip and upload ahead of it
+EXCERPT_SECONDS = 30
 
 RX_DIGIT = re.compile(r'\d+')
 
+# Set by main(); None when imported by something else
+metrics = None
+
 def version_compare(s):
     return RX_DIGIT.sub(lambda m: m.group(0).rjust(15, '0'), s)
 
-def read_http_status(s):
-    statusline = None
-    rbuf = b''
-    while True:
-        r = s.recv(256)
-        if not r:
-            return ''
-        rbuf += r
-        nlines = rbuf.split(b'\n')
-        rbuf = nlines.pop()
-        for line in nlines:
-            line = line.rstrip(b'\r\n')
-            if statusline is None:
-                statusline = line
-            if not line:
-                return statusline
+class FileRange:
+    '''size bytes of the file at path, starting at offset. Passed to put_data in
+    place of the data itself, so the kernel can send it straight from the file.'''
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def send(self, sock):
+        # socket.sendfile uses os.sendfile, and only falls back to reading and
+        # sending in Python where that is not available
+        with open(self.path, 'rb') as fp:
+            sent = sock.sendfile(fp, self.offset, self.size)
+            # Sent; don't let gigabytes of video push everything else out of the cache
+            fadvise(fp.fileno(), self.offset, self.size, FADV_DONTNEED)
+        return sent
+
+class UploadConnection:
+    '''A keep-alive HTTP/1.1 connection to the upload server. After any error the
+    connection is closed, and the next request opens a new one.'''
+    def __init__(self, host, port, srcaddr):
+        self.host = host
+        self.srcaddr = srcaddr
+        self.conn = http.client.HTTPConnection(host, port, timeout=TIMEOUT,
+                                               source_address=(srcaddr, 0) if srcaddr else None)
+        self.requests = 0
+
+    @property
+    def closed(self):
+        return self.conn is None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def put(self, path, data):
+        conn = self.conn
+        try:
+            conn.putrequest('PUT', path, skip_accept_encoding=True)
+            conn.putheader('Content-type', 'application/octet-stream')
+            conn.putheader('Content-length', str(len(data)))
+            conn.endheaders()
+            if isinstance(data, FileRange):
+                sent = data.send(conn.sock)
+                if sent != data.size:
+                    raise ConnectionError('%s: short read, sent %d of %d bytes' % (data.path, sent, data.size))
+            else:
+                conn.send(data)
+
+            # Read the whole body (content-length or chunked) so the next request
+            # starts at a clean response boundary
+            resp = conn.getresponse()
+            resp.read()
+        except http.client.HTTPException as e:
+            # Garbled response: nothing more can be trusted on this connection.
+            # Raised as an OSError so timeout_retry tries again.
+            self.close()
+            raise ConnectionError('bad response from %s: %r' % (self.host, e)) from e
+        except OSError:
+            self.close()
+            raise
 
-def _put_data(srcaddr, name, dstfn, cpos, data, totalsize, modtime):
-    path = CONFIG['upload_path'].format(copyname=name, dstfn=dstfn, start=cpos, size=len(data), totalsize=totalsize, modtime=modtime, key=CONFIG['key'])
-    host = CONFIG['upload_host']
-    header = 'PUT %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\nContent-type: application/octet-stream\r\nContent-length: %d\r\n\r\n' % (path, host, len(data))
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.settimeout(TIMEOUT)
-        if srcaddr:
-            s.bind((srcaddr, 0))
+        self.requests += 1
+        if resp.will_close:
+            self.close()
 
-        s.connect((host, CONFIG['upload_port']))
-        s.sendall(header.encode('utf8'))
-        s.sendall(data)
+        if resp.status != 200:
+            raise urllib.error.HTTPError('http://%s%s' % (self.host, path), resp.status, resp.reason, resp.headers, None)
 
-        statusline = read_http_status(s)
+class ConnectionPool:
+    '''Idle upload connections, reused across chunks and files.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
 
-        if not statusline:
-            raise urllib.error.HTTPError('http://%s%s' % (host, path), 500, 'no response received', {}, None)
+        # Connections opened since take_opened() was last called
+        self.opened = 0
 
-        resp = statusline.decode('utf8', 'ignore').strip().split(' ', 2)
-        try:
-            vers, code, msg = resp
-            code = int(code)
-            if code != 200:
-                raise urllib.error.HTTPError('http://%s%s' % (host, path), code, msg, {}, None)
-        except ValueError as v:
-            raise urllib.error.HTTPError('http://%s%s' % (host, path), 500, 'malformed response received', {}, None)
+    def acquire(self, srcaddr):
+        with self.lock:
+            while self.idle:
+                uc = self.idle.pop()
+                if uc.srcaddr == srcaddr:
+                    return uc
+                # The Wi-Fi address changed; connections bound to the old one are dead
+                uc.close()
+            self.opened += 1
+
+        return UploadConnection(CONFIG['upload_host'], CONFIG['upload_port'], srcaddr)
+
+    def take_opened(self):
+        with self.lock:
+            opened = self.opened
+            self.opened = 0
+        return opened
+
+    def release(self, uc):
+        if not uc.closed:
+            with self.lock:
+                self.idle.append(uc)
+
+    def close_all(self):
+        with self.lock:
+            for uc in self.idle:
+                uc.close()
+            del self.idle[:]
+
+pool = ConnectionPool()
+
+def _put_data(srcaddr, name, dstfn, cpos, data, totalsize, modtime):
+    path = CONFIG['upload_path'].format(copyname=name, dstfn=dstfn, start=cpos, size=len(data), totalsize=totalsize, modtime=modtime, key=CONFIG['key'])
+    uc = pool.acquire(srcaddr)
+    try:
+        uc.put(path, data)
+    finally:
+        pool.release(uc)
 
 def put_data(srcaddr_file, name, dstfn, cpos, data, totalsize, modtime):
     try:
@@ -104,6 +216,12 @@ def addcomma(n):
     n = str(n)
     return rxcomma.sub(r'\1,', n[::-1])[::-1]
 
+def parse_size(txt):
+    mult = {'k': 1024, 'm': 1024 * 1024}.get(txt[-1:].lower())
+    if mult:
+        return int(float(txt[:-1]) * mult)
+    return int(txt)
+
 def hms(fsecs):
     secs = int(fsecs)
     mins = secs / 60
@@ -117,62 +235,6 @@ def run_ffprobe(fil):
     out, err = p.communicate()
     return out.decode('iso8859')
 
-def get_atom_info(eight_bytes):
-    try:
-        atom_size, atom_type = struct.unpack('>I4s', eight_bytes)
-    except struct.error:
-        return 0, ''
-    return int(atom_size), atom_type.decode('latin1')
-
-recursive_atoms = "moov", "trak", "mdia", "minf", "stbl", "dinf"
-
-def find_atom(fp, startpos, atype):
-    while True:
-        try:
-            fp.seek(startpos)
-            atom_size, atom_type = get_atom_info(fp.read(8))
-        except OSError:
-            return None, None
-
-        if atom_size < 8:
-            return None, None
-
-        if atom_type == atype:
-            return startpos, atom_size
-
-        startpos += atom_size
-
-def decode_mvhd(fp):
-    moov_pos, moov_size = find_atom(fp, 0, 'moov')
-    if moov_pos is None:
-        raise ValueError('MOOV not found')
-
-    mvhd_pos, mvhd_size = find_atom(fp, moov_pos + 8, 'mvhd')
-    if mvhd_pos is None:
-        raise ValueError('MVHD not found')
-
-    mvhd = fp.read(mvhd_size - 8)
-    if len(mvhd) < 20:
-        raise ValueError('MVHD invalid')
-
-    vers = mvhd[0]
-    if vers == 1:
-        ctime = uint64.unpack_from(mvhd, 4)[0]
-        mtime = uint64.unpack_from(mvhd, 12)[0]
-        timescale = uint32.unpack_from(mvhd, 20)[0]
-        duration = uint64.unpack_from(mvhd, 24)[0]
-    else:
-        ctime = uint32.unpack_from(mvhd, 4)[0]
-        mtime = uint32.unpack_from(mvhd, 8)[0]
-        timescale = uint32.unpack_from(mvhd, 12)[0]
-        duration = uint32.unpack_from(mvhd, 16)[0]
-
-    if ctime > 2082844800:
-        ctime -= 2082844800
-    duration = duration / timescale
-    return ctime, duration
-
-
 def strtime(ut):
     lt = time.localtime(ut)
     if lt.tm_isdst:
@@ -202,19 +264,12 @@ class VideoFile:
     SEQUENTIAL_MERGE = False
     forcetz = None
 
-    def __init__(self, path, metapath, st):
+    def __init__(self, path, index, st):
         self.path = path
-        self.metapath = metapath
+        self.index = index
         self.stat = st
 
-        try:
-            with open(metapath, 'r') as fp:
-                mdata = json.load(fp)
-        except (ValueError, FileNotFoundError):
-            mdata = {}
-
-        self.orig_data = copy.deepcopy(mdata)
-        self.data = mdata
+        self.data, self.token = index.get(basename(path), st)
         self.mergefiles = None
 
         self.data['origfn'] = basename(path)
@@ -240,16 +295,19 @@ class VideoFile:
         self.data['newfn'] = ('%s_f%s,%s.mov' % (strtime(btime), strseq, strtot)).lower()
 
     def save_meta(self, force=False):
-        if not force and self.orig_data == self.data:
-            return
+        self.token = self.index.put(basename(self.path), self.data, None if force else self.token)
 
-        with open(self.metapath + '~', 'w') as fp:
-            json.dump(self.data, fp)
-            os.fsync(fp.fileno())
-        os.rename(self.metapath + '~', self.metapath)
-        self.orig_data = copy.deepcopy(self.data)
+    def needs_probe(self):
+        return not self.data.get('error') and not (self.begintime and self.duration)
 
-    def fill_meta(self):
+    def probe(self):
+        '''Read the clip's creation time and duration. Touches nothing else, so it
+        can run in a worker thread.'''
+        with ProbeFile(self.path) as fp:
+            return decode_mvhd(fp)
+
+    def fill_meta(self, probe=None):
+        '''probe is a future for probe() if it was started in advance.'''
         if self.data.get('error'):
             return False
 
@@ -257,8 +315,7 @@ class VideoFile:
             return True
 
         try:
-            with open(self.path, 'rb') as fp:
-                ctime, duration = decode_mvhd(fp)
+            ctime, duration = probe.result() if probe is not None else self.probe()
         except Exception as e:
             print('error decoding %s: %s' % (self.path, e))
             self.data['duration'] = 0
@@ -355,12 +412,13 @@ class VideoFile:
 
 def generate_meta(srcdir, metadir):
     try:
-        os.makedirs(metadir)
+        os.makedirs(dirname(metadir))
     except OSError:
         pass
 
-    seen_meta = set()
-
+    starttime = getmtime()
+    index = ClipIndex(metadir + '.db', metadir)
+    clips = []
     all_files = []
 
     for fn in os.listdir(srcdir):
@@ -375,16 +433,19 @@ def generate_meta(srcdir, metadir):
             if not stat.S_ISREG(st.st_mode):
                 continue
 
-            metafn = fn.lower() + '.json'
-            seen_meta.add(metafn)
-            metapath = join(metadir, metafn)
             if st.st_size < 4*1048576:
                 continue
 
-            vf = VideoFile(join(srcdir, fn), metapath, st)
-            if vf.fill_meta():
-                all_files.append(vf)
-                vf.save_meta()
+            clips.append(VideoFile(join(srcdir, fn), index, st))
+
+    # The card is slow to seek, so read several new clips' headers at once
+    with ThreadPoolExecutor(PROBE_THREADS, thread_name_prefix='probe') as executor:
+        probes = {vf: executor.submit(vf.probe) for vf in clips if vf.needs_probe()}
+
+    for vf in clips:
+        if vf.fill_meta(probes.get(vf)):
+            all_files.append(vf)
+            vf.save_meta()
 
     last_op = None
     all_files.sort(key=lambda vf: vf.begintime)
@@ -398,62 +459,80 @@ def generate_meta(srcdir, metadir):
         if not cur_op.merged:
             cur_op.domerge()
 
-    for fn in os.listdir(metadir):
-        if fn.endswith('.json') and fn not in seen_meta:
-            os.unlink(join(metadir, fn))
+    # Clips no longer on the card are dropped in the same transaction
+    nchanged = len(index.changed)
+    index.commit()
+    index.close()
+    print('metadata: %d clips, %d updated in %.0f ms' % (len(all_files), nchanged, (getmtime() - starttime) * 1000))
 
     return all_files
 
 
+def fadvise(fd, offset, size, advice):
+    '''Best-effort hint to the page cache; does nothing where unsupported.'''
+    if advice is not None:
+        try:
+            os.posix_fadvise(fd, offset, size, advice)
+        except OSError:
+            pass
+
 class FileReader(threading.Thread):
-    def __init__(self, filename, startpos):
-        super().__init__()
+    '''Reads a file ahead of its consumer, keeping up to depth blocks queued.
+
+    get_wait is the time the consumer spent waiting for a block (the reader is the
+    bottleneck); put_wait is the time the reader spent waiting for room in the
+    queue (the consumer is).'''
+    def __init__(self, filename, startpos, block_size=BLOCK_SIZE, depth=READAHEAD_DEPTH):
+        super().__init__(daemon=True)
         self.filename = filename
         self.startpos = startpos
-        self.lock = threading.Lock()
-        self.have_data = threading.Condition(self.lock)
-        self.got_data = threading.Condition(self.lock)
-        self.data = None
-        self.error = None
+        self.block_size = block_size
+        self.queue = queue.Queue(max(1, depth))
+        self.stopped = False
+        self.get_wait = 0
+        self.put_wait = 0
 
     def run(self):
         try:
-            with open(self.filename, 'rb') as fp:
-                fp.seek(self.startpos)
+            with open(self.filename, 'rb', buffering=0) as fp:
+                fd = fp.fileno()
+                cpos = self.startpos
+                fadvise(fd, cpos, 0, FADV_SEQUENTIAL)
+                fadvise(fd, cpos, self.block_size * self.queue.maxsize, FADV_WILLNEED)
                 while True:
-                    cpos = fp.tell()
-                    data = fp.read(BLOCK_SIZE)
-
-                    with self.lock:
-                        while self.data is not None and self.filename is not None:
-                            self.got_data.wait(1000)
-                        if self.filename is None:
-                            return
-                        self.data = cpos, data
-                        self.have_data.notify()
-                    if not data:
+                    data = os.pread(fd, self.block_size, cpos)
+                    # The data is in our own buffer now; the cached copy is not needed
+                    fadvise(fd, cpos, len(data), FADV_DONTNEED)
+                    if not self.put((cpos, data)) or not data:
                         break
+                    cpos += len(data)
         except Exception as e:
             traceback.print_exc()
-            with self.lock:
-                self.error = e
-                self.have_data.notify()
+            self.put(e)
+
+    def put(self, item):
+        st = getmtime()
+        try:
+            while not self.stopped:
+                try:
+                    self.queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.put_wait += getmtime() - st
 
     def get_data(self):
-        with self.lock:
-            while self.data is None and self.error is None:
-                self.have_data.wait(1000)
-            if self.error is not None:
-                raise self.error
-            rv = self.data
-            self.data = None
-            self.got_data.notify()
-        return rv
+        st = getmtime()
+        item = self.queue.get()
+        self.get_wait += getmtime() - st
+        if isinstance(item, Exception):
+            raise item
+        return item
 
     def stop(self):
-        with self.lock:
-            self.filename = None
-            self.got_data.notify()
+        self.stopped = True
 
 
 def timeout_retry(nsec, f, *a, **kw):
@@ -470,6 +549,222 @@ def timeout_retry(nsec, f, *a, **kw):
                 raise
             time.sleep(min(rtime, 0.5))
 
+class ChunkSizer:
+    '''Picks the upload chunk size, AIMD style. The size grows by BLOCK_STEP after
+    each clean chunk that was at least about as fast as recent ones. It halves when
+    an attempt fails or a chunk is slow, since a failed chunk is sent again whole.'''
+    def __init__(self, size, adaptive=True):
+        self.size = size
+        self.adaptive = adaptive
+        self.avg_rate = None
+
+    def update(self, size, elapsed, failures):
+        if not self.adaptive:
+            return
+
+        rate = size / max(elapsed, 1e-6)
+        old_size = self.size
+        if failures or elapsed > SLOW_CHUNK_TIME:
+            self.size = max(MIN_BLOCK_SIZE, self.size // 2)
+        elif self.avg_rate is None or rate >= self.avg_rate * 0.9:
+            self.size = min(MAX_BLOCK_SIZE, self.size + BLOCK_STEP)
+
+        # Chunks that had to be retried say nothing about the link's speed
+        if not failures:
+            self.avg_rate = rate if self.avg_rate is None else self.avg_rate * 0.8 + rate * 0.2
+
+        if self.size != old_size:
+            print('chunk size %s -> %s (%.2f MB/s, %d failed attempts)' % (
+                addcomma(old_size), addcomma(self.size), rate / 1000000.0, failures))
+            if metrics:
+                metrics.gauge('chunk_size', 'B').set(self.size)
+
+class UploadProgress:
+    '''How far each file being uploaded is known to have reached the server with
+    no gaps, kept in path across sessions. Chunks land out of order, so a file's
+    size on the server can be past a chunk that never arrived; a file listed here
+    resumes from its offset here instead.'''
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fp:
+                self.offsets = json.load(fp)
+        except (OSError, ValueError):
+            self.offsets = {}
+        self.saved = 0
+
+    def resume(self, need, srcfiles):
+        '''Move the server's {filename: start position} back to where each file
+        is known to be complete, adding files the server wrongly has all of.'''
+        for fn, offset in list(self.offsets.items()):
+            if fn not in srcfiles:
+                del self.offsets[fn]
+            elif offset < need.get(fn, srcfiles[fn]):
+                print('%-30s: resuming from %s' % (fn, addcomma(offset)))
+                need[fn] = offset
+
+    def set(self, fn, offset, force=True):
+        self.offsets[fn] = offset
+        if force or getmtime() - self.saved >= PROGRESS_INTERVAL:
+            self.save()
+
+    def remove(self, fn):
+        if self.offsets.pop(fn, None) is not None:
+            self.save()
+
+    def save(self):
+        upload_schedule.write_json(self.path, self.offsets)
+        self.saved = getmtime()
+
+class StreamStats:
+    def __init__(self):
+        self.chunks = 0
+        self.bytes = 0
+        self.busy_time = 0
+
+class ChunkUploader:
+    '''Uploads chunks over up to nstreams connections at once.
+
+    Each chunk carries its own offset and is retried by timeout_retry on its own, so
+    chunks may reach the server out of order. A chunk that fails for good is raised
+    from submit() or finish(), and the copy stops there, possibly after later
+    chunks have landed. So the offset below which every chunk has landed is kept in
+    progress, and the next session resumes from there. Chunks are submitted at most
+    nstreams past that offset, so a slow chunk holds back the rest.
+
+    The workers only upload; metrics are updated in wait_some(), on the thread
+    that submits, since metrics counters aren't locked.'''
+    def __init__(self, srcaddr_file, copyname, nstreams, sizer, progress=None):
+        self.srcaddr_file = srcaddr_file
+        self.copyname = copyname
+        self.nstreams = nstreams
+        self.sizer = sizer
+        self.progress = progress
+        self.executor = ThreadPoolExecutor(nstreams, thread_name_prefix='upload')
+        self.pending = set()
+
+        # dstfn -> offset below which every chunk has landed
+        self.acked = {}
+        # dstfn -> {offset: end} of chunks that landed past a gap
+        self.landed = {}
+        # Chunks submitted but not yet below their file's acked offset
+        self.ahead = 0
+        self.lock = threading.Lock()
+        self.stream_stats = {}
+
+        # Time spent waiting for a free stream; high when uploading is the bottleneck
+        self.stream_wait = 0
+
+    def upload(self, dstfn, cpos, data, totalsize, modtime):
+        '''Runs in a worker thread. A chunk that fails for good is returned as
+        error, so wait_some() can still count its failed attempts.'''
+        failures = 0
+        def attempt():
+            nonlocal failures
+            try:
+                put_data(self.srcaddr_file, self.copyname, dstfn, cpos, data, totalsize, modtime)
+            except socket.error:
+                failures += 1
+                raise
+
+        st = getmtime()
+        try:
+            timeout_retry(FAIL_TIMEOUT, attempt)
+        except socket.error as e:
+            return dstfn, cpos, len(data), totalsize, getmtime() - st, failures, e
+        elapsed = getmtime() - st
+
+        name = threading.current_thread().name
+        with self.lock:
+            stats = self.stream_stats.get(name)
+            if stats is None:
+                stats = self.stream_stats[name] = StreamStats()
+            stats.chunks += 1
+            stats.bytes += len(data)
+            stats.busy_time += elapsed
+        return dstfn, cpos, len(data), totalsize, elapsed, failures, None
+
+    def submit(self, dstfn, cpos, data, totalsize, modtime):
+        '''Queue a chunk, first waiting for a free stream if all are busy.'''
+        if dstfn not in self.acked:
+            self.acked[dstfn] = cpos
+            self.landed[dstfn] = {}
+            if self.progress:
+                self.progress.set(dstfn, cpos)
+
+        if self.ahead >= self.nstreams:
+            st = getmtime()
+            while self.ahead >= self.nstreams:
+                self.wait_some()
+            self.stream_wait += getmtime() - st
+        self.pending.add(self.executor.submit(self.upload, dstfn, cpos, data, totalsize, modtime))
+        self.ahead += 1
+
+    def chunk_landed(self, dstfn, cpos, size):
+        landed = self.landed[dstfn]
+        landed[cpos] = cpos + size
+        offset = self.acked[dstfn]
+        while offset in landed:
+            offset = landed.pop(offset)
+            self.ahead -= 1
+        if offset != self.acked[dstfn]:
+            self.acked[dstfn] = offset
+            if self.progress:
+                self.progress.set(dstfn, offset, False)
+
+    def wait_some(self, return_when=FIRST_COMPLETED):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        if metrics:
+            metrics.counter('connections').inc(pool.take_opened())
+        first_error = None
+        for fut in done:
+            dstfn, cpos, size, totalsize, elapsed, failures, error = fut.result()
+            if metrics:
+                metrics.counter('put_errors').inc(failures)
+            if error is not None:
+                # Record the chunks that did land before giving up
+                first_error = first_error or error
+                continue
+            print('%-30s: %12s / %12s %6.2f MB/s' % (dstfn, addcomma(cpos + size), addcomma(totalsize), size / max(elapsed, 1e-6) / 1000000.0))
+            self.sizer.update(size, elapsed, failures)
+            self.chunk_landed(dstfn, cpos, size)
+            if metrics:
+                if failures:
+                    metrics.counter('resent', 'B').inc(size * failures)
+                metrics.counter('copied', 'B').inc(size)
+                metrics.gauge('remaining', 'B').add(-size)
+                metrics.histogram('chunk_time').observe(elapsed * 1000)
+        if first_error is not None:
+            raise first_error
+
+    def finish(self):
+        '''Wait for every queued chunk to be uploaded.'''
+        while self.pending:
+            self.wait_some()
+
+        # Every file is complete on the server now
+        if self.progress:
+            for dstfn in self.acked:
+                self.progress.remove(dstfn)
+        self.acked = {}
+        self.landed = {}
+
+    def report_streams(self):
+        '''Print and reset how much each stream has uploaded.'''
+        with self.lock:
+            stats = self.stream_stats
+            self.stream_stats = {}
+        for name, s in sorted(stats.items()):
+            print('  %-12s %5d chunks %14s bytes %6.2f MB/s' % (
+                name, s.chunks, addcomma(s.bytes), s.bytes / max(s.busy_time, 1e-6) / 1000000.0))
+
+    def shutdown(self):
+        for fut in self.pending:
+            fut.cancel()
+        self.executor.shutdown(wait=False)
+        if self.progress:
+            self.progress.save()
+
 def notify(status, which):
     u = urllib.request.urlopen(CONFIG['upload_notify_url'].format(status=status, copyname=which, key=CONFIG['key']), timeout=3)
     u.read()
@@ -519,7 +814,65 @@ def local_query(basepath, do_delete, jdata):
 
 
 
+def load_marks(args, metadir):
+    '''Times of the markers in the cardata logs, if the upload order uses them.'''
+    if not ('markers' in args.order or 'excerpts' in args.order) or not CONFIG.get('cardata_path'):
+        return []
+    return upload_schedule.find_marks(CONFIG['cardata_path'], join(metadir, 'marks.json'),
+                                      CONFIG.get('upload_priority_events', ()))
+
+def make_excerpts(ops, marks, outdir, window):
+    '''Cut the window seconds either side of each marker out of the clips it falls
+    in, reusing excerpts cut by an earlier session. Returns {excerpt name: (path,
+    begin time, end time)}.'''
+    os.makedirs(outdir, exist_ok=True)
+    excerpts = {}
+    for op in ops:
+        begin = op.data['begintime']
+        duration = op.data['duration']
+
+        # Markers close together share one excerpt
+        windows = []
+        for m in marks[bisect.bisect_left(marks, begin - window):]:
+            if m > begin + duration + window:
+                break
+            start, end = max(0, m - begin - window), min(duration, m - begin + window)
+            if windows and start <= windows[-1][1]:
+                windows[-1][1] = max(windows[-1][1], end)
+            elif start < end:
+                windows.append([start, end])
+
+        for start, end in windows:
+            name = ('%s_excerpt%s' % (strtime(begin + start), splitext(op.data['origfn'])[1])).lower()
+            path = join(outdir, name)
+            if not exists(path):
+                try:
+                    mp4_excerpt.write_excerpt(op.path, path + '~', start, end)
+                except Exception as e:
+                    print('%s: no excerpt for %.0f-%.0f s: %s' % (op.path, start, end, e))
+                    continue
+                os.rename(path + '~', path)
+                print('%s: excerpt %s' % (op.path, name))
+            excerpts[name] = path, begin + start, begin + end
+
+    for fn in os.listdir(outdir):
+        if fn not in excerpts:
+            os.unlink(join(outdir, fn))
+    return excerpts
+
+def schedule(args, metadir, need, srcfiles, clip_times, marks, excerpts):
+    '''Put the server's {filename: start position} in the order to upload.'''
+    rate = None
+    if args.budget:
+        rate = CONFIG.get('upload_rate') or upload_schedule.load_rate(join(metadir, 'upload_rate.json'), args.copyname)
+
+    sched = Scheduler(args.order, marks, args.budget, rate, version_compare)
+    clips = [Clip(fn, srcfiles.get(fn, 0), startpos, *clip_times.get(fn, (None, None)), excerpt=fn in excerpts)
+             for fn, startpos in need.items()]
+    return [(clip.name, clip.startpos) for clip in sched.sort(clips)]
+
 def main():
+    global metrics
     print(sys.argv)
     p = argparse.ArgumentParser(description='')
     p.add_argument('srcpath')
@@ -532,6 +885,14 @@ def main():
     p.add_argument('-N', '--nonotify', action='store_true', help='')
     p.add_argument('-D', '--nodelete', action='store_true', help='')
     p.add_argument('-d', '--cardata', action='store_true', help='')
+    p.add_argument('-B', '--buffered', action='store_true', help='read files through Python instead of using sendfile / copy_file_range')
+    p.add_argument('-b', '--block-size', type=parse_size, default=BLOCK_SIZE, help='bytes per chunk, or the starting size for uploads; K and M suffixes allowed (default 1M)')
+    p.add_argument('-F', '--fixed-size', action='store_true', help='always upload chunks of --block-size instead of adapting to the link')
+    p.add_argument('-r', '--readahead', type=int, default=READAHEAD_DEPTH, help='number of blocks to read ahead (default %d)' % READAHEAD_DEPTH)
+    p.add_argument('-j', '--streams', type=int, help='number of chunks to upload at once (default: upload_streams in config, or %d)' % DEFAULT_STREAMS)
+    p.add_argument('-o', '--order', help='comma-separated upload order, from %s (default: upload_order in config, or %s)' % (
+        ', '.join(sorted(upload_schedule.scorers)), ','.join(upload_schedule.DEFAULT_ORDER)))
+    p.add_argument('--budget', type=float, help='seconds likely available to upload; clips that won\'t fit go later (default: upload_budget in config)')
     args = p.parse_args()
 
     do_delete = not args.nodelete
@@ -543,9 +904,35 @@ def main():
     VideoFile.SEQUENTIAL_MERGE = args.sequential
 
     load_config()
+    if args.streams is None:
+        args.streams = CONFIG.get('upload_streams', DEFAULT_STREAMS)
+    if args.order is None:
+        args.order = CONFIG.get('upload_order', upload_schedule.DEFAULT_ORDER)
+    else:
+        args.order = args.order.split(',')
+    unknown = [name for name in args.order if name not in upload_schedule.scorers]
+    if unknown:
+        p.error('unknown upload order: %s' % ', '.join(unknown))
+    if args.budget is None:
+        args.budget = CONFIG.get('upload_budget')
+
+    # cardata and a camera can be copying at the same time, so each copy gets its own file
+    metrics = Metrics('do_copy-%s' % args.copyname)
+    metrics.counter('copied', 'B')
+    metrics.counter('files')
+    metrics.histogram('chunk_time')
+    m_remaining = metrics.gauge('remaining', 'B')
+    metrics.counter('put_errors')
+    metrics.counter('resent', 'B')
+    metrics.gauge('chunk_size', 'B').set(args.block_size)
+    metrics.counter('connections')
+    metrics.counter('stream_wait', 's')
 
     srcfiles = {}
     true_fn = {}
+    clip_times = {}
+    metadir = join(dirname(os.path.abspath(__file__)), 'cvmeta')
+    os.makedirs(metadir, exist_ok=True)
 
     print('scan %s...' % args.srcpath)
     if args.cardata:
@@ -565,15 +952,25 @@ def main():
             true_fn[fn] = fn
             srcfiles[fn] = st.st_size
     else:
-        all_ops = generate_meta(args.srcpath, join(dirname(__file__), 'cvmeta', args.copyname))
+        all_ops = generate_meta(args.srcpath, join(metadir, args.copyname))
 
         for op in all_ops:
             dstfn = op.data['newfn']
             true_fn[dstfn] = op.data['origfn']
             srcfiles[dstfn] = op.data['size']
+            clip_times[dstfn] = op.data['begintime'], op.data['begintime'] + op.data['duration']
             #print('mv %s %s' % (op.data['origfn'].lower(), dstfn))
             #print('mv meta.%s.json meta.%s.json' % (op.data['origfn'].lower(), dstfn))
 
+    marks = load_marks(args, metadir) if clip_times else []
+    excerpts = {}
+    window = CONFIG.get('excerpt_seconds', EXCERPT_SECONDS)
+    if marks and window and 'excerpts' in args.order:
+        excerpts = make_excerpts(all_ops, marks, join(metadir, args.copyname + '-excerpts'), window)
+        for name, (path, begintime, endtime) in excerpts.items():
+            srcfiles[name] = os.path.getsize(path)
+            clip_times[name] = begintime, endtime
+
     if args.localpath:
         response = local_query(args.localpath, False, {'files': srcfiles})
     else:
@@ -586,9 +983,13 @@ def main():
         response = json.loads(r.decode('utf8', 'ignore'))
 
     need = response['need']
+    progress = None
+    if not args.localpath:
+        progress = UploadProgress(join(metadir, args.copyname + '-progress.json'))
+        progress.resume(need, srcfiles)
 
     total_need = 0
-    need = sorted(need.items(), key=lambda v: version_compare(v[0]))
+    need = schedule(args, metadir, need, srcfiles, clip_times, marks, excerpts)
     for fn, startpos in need:
         need_amt = max(0, srcfiles.get(fn) - startpos)
         total_need += need_amt
@@ -597,6 +998,7 @@ def main():
     print()
     print('%-30s: %s' % ('total', addcomma(total_need)))
     print()
+    m_remaining.set(total_need)
     if args.noaction:
         return
 
@@ -608,59 +1010,175 @@ def main():
     if not args.nonotify:
         notify('start', args.copyname)
 
-    for dstfn, startpos in need:
-        fn = true_fn[dstfn]
-        path = join(args.srcpath, fn)
-        st = os.lstat(path)
-        totalsize = st.st_size
-        modtime = int(st.st_mtime * 1000)
+    uploader = None
+    if not args.localpath:
+        sizer = ChunkSizer(args.block_size, not args.fixed_size)
+        uploader = ChunkUploader(args.srcaddr_file, args.copyname, max(1, args.streams), sizer, progress)
+
+    m_copied = metrics.counter('copied', 'B')
+    start_copied = m_copied.value
+    start_time = getmtime()
+    try:
+        for dstfn, startpos in need:
+            # Excerpts are cut into metadir, not found under srcpath
+            path = excerpts[dstfn][0] if dstfn in excerpts else join(args.srcpath, true_fn[dstfn])
+            copy_file(args, uploader, dstfn, path, startpos)
+    finally:
+        if uploader:
+            uploader.shutdown()
+
+        # Remember how fast this link went, to plan the next session's budget
+        elapsed = getmtime() - start_time
+        if uploader and elapsed >= 10:
+            upload_schedule.save_rate(join(metadir, 'upload_rate.json'), args.copyname, (m_copied.value - start_copied) / elapsed)
+
+    pool.close_all()
+    if not args.nonotify:
+        notify('finish', args.copyname)
 
-        reader = FileReader(path, startpos)
+# Cleared the first time the kernel refuses, e.g. copy_file_range across filesystems
+use_copy_file_range = hasattr(os, 'copy_file_range')
+use_sendfile = hasattr(os, 'sendfile')
+
+def copy_range(src_fd, dst_fd, offset, size):
+    '''Copy size bytes at offset from src_fd to the same offset in dst_fd without
+    passing them through Python if the kernel allows it.'''
+    global use_copy_file_range, use_sendfile
+    end = offset + size
+    while offset < end:
+        n = None
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, end - offset, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                print('copy_file_range not usable (%s), falling back' % e)
+                use_copy_file_range = False
+                continue
 
-        if args.localpath:
-            output_file_path = join(args.localpath, dstfn)
-            output_fd = os.open(output_file_path, os.O_CREAT | os.O_WRONLY, 0o644)
+        elif use_sendfile:
+            try:
+                os.lseek(dst_fd, offset, 0)
+                n = os.sendfile(dst_fd, src_fd, offset, end - offset)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                print('sendfile not usable (%s), falling back' % e)
+                use_sendfile = False
+                continue
 
-        try:
+        else:
+            data = os.pread(src_fd, min(end - offset, BLOCK_SIZE), offset)
+            n = len(data) and os.pwrite(dst_fd, data, offset)
+
+        if n == 0:
+            raise OSError(errno.EIO, 'unexpected end of file at %d' % offset)
+        offset += n
+
+def file_ranges(path, startpos, totalsize, sizer, bsize):
+    '''Split path into FileRanges, asking sizer (if any) for each range's size.'''
+    cpos = startpos
+    while cpos < totalsize:
+        if sizer:
+            bsize = sizer.size
+        size = min(bsize, totalsize - cpos)
+        yield cpos, FileRange(path, cpos, size)
+        cpos += size
+
+def copy_file(args, uploader, dstfn, path, startpos):
+    '''Copy path from startpos to dstfn, either to args.localpath or to the server
+    through uploader.'''
+    st = os.lstat(path)
+    totalsize = st.st_size
+    modtime = int(st.st_mtime * 1000)
+
+    if args.localpath:
+        output_file_path = join(args.localpath, dstfn)
+        output_fd = os.open(output_file_path, os.O_CREAT | os.O_WRONLY, 0o644)
+
+    reader = None
+    src_fd = None
+    try:
+        begin_time = getmtime()
+        begin_cpu = time.process_time()
+        last_time = begin_time
+        total_copied = 0
+        begin_stream_wait = uploader.stream_wait if uploader else 0
+
+        bsize = args.block_size
+        if args.buffered:
+            reader = FileReader(path, startpos, bsize, args.readahead)
             reader.start()
-            begin_time = getmtime()
-            last_time = getmtime()
-            last_delta = 0
-            last_size = 0
-            total_copied = 0
-            while True:
-                cpos, data = reader.get_data()
-                if last_size:
-                    mbps = last_size / last_delta / 1000000.0
-                else:
-                    mbps = 0
-                print('%-30s: %12s / %12s %6.2f MB/s' % (dstfn, addcomma(cpos), addcomma(totalsize), mbps))
-
-                last_size = len(data)
-                total_copied += last_size
-                if not data:
-                    break
-                if args.localpath:
-                    os.lseek(output_fd, cpos, 0)
-                    os.write(output_fd, data)
-                else:
-                    #url = (BASEURL_COPY % args.copyname) + '%s?start=%d&append=%d&totalsize=%d&modtime=%d' % (dstfn, cpos, len(data), totalsize, modtime)
-                    timeout_retry(FAIL_TIMEOUT, put_data, args.srcaddr_file, args.copyname, dstfn, cpos, data, totalsize, modtime)
-                ctime = getmtime()
-                last_delta = ctime - last_time
-                last_time = ctime
-
-            end_time = getmtime()
-            mbps = total_copied / (end_time - begin_time) / 1000000.0
-            print('%-30s: copied %s in %s, %.2f MB/s' % (dstfn, addcomma(total_copied), hms(end_time - begin_time), mbps))
-            print()
-        finally:
-            if args.localpath:
-                os.close(output_fd)
-            reader.stop()
+            chunks = iter(reader.get_data, None)
+        else:
+            # The kernel reads the file inside sendfile / copy_file_range; ask it to
+            # start reading args.readahead blocks before they are needed
+            src_fd = os.open(path, os.O_RDONLY)
+            fadvise(src_fd, startpos, 0, FADV_SEQUENTIAL)
+            fadvise(src_fd, startpos, bsize * args.readahead, FADV_WILLNEED)
+            chunks = file_ranges(path, startpos, totalsize, uploader.sizer if uploader else None, bsize)
+
+        for cpos, data in chunks:
+            if not data:
+                break
+
+            if uploader:
+                # Read in the size the uploader currently wants
+                bsize = uploader.sizer.size
+                if reader:
+                    reader.block_size = bsize
+            if src_fd is not None:
+                fadvise(src_fd, cpos + bsize * args.readahead, bsize, FADV_WILLNEED)
+
+            total_copied += len(data)
+            if uploader:
+                #url = (BASEURL_COPY % args.copyname) + '%s?start=%d&append=%d&totalsize=%d&modtime=%d' % (dstfn, cpos, len(data), totalsize, modtime)
+                uploader.submit(dstfn, cpos, data, totalsize, modtime)
+                continue
 
-    if not args.nonotify:
-        notify('finish', args.copyname)
+            if isinstance(data, FileRange):
+                copy_range(src_fd, output_fd, cpos, len(data))
+                fadvise(src_fd, cpos, len(data), FADV_DONTNEED)
+            else:
+                os.pwrite(output_fd, data, cpos)
+            ctime = getmtime()
+            print('%-30s: %12s / %12s %6.2f MB/s' % (dstfn, addcomma(cpos + len(data)), addcomma(totalsize), len(data) / max(ctime - last_time, 1e-6) / 1000000.0))
+            metrics.counter('copied', 'B').inc(len(data))
+            metrics.gauge('remaining', 'B').add(-len(data))
+            metrics.histogram('chunk_time').observe((ctime - last_time) * 1000)
+            last_time = ctime
+
+        if uploader:
+            uploader.finish()
+
+        end_time = getmtime()
+        mbps = total_copied / max(end_time - begin_time, 1e-6) / 1000000.0
+        print('%-30s: copied %s in %s, %.2f MB/s, %.2f s CPU' % (dstfn, addcomma(total_copied), hms(end_time - begin_time), mbps, time.process_time() - begin_cpu))
+        stream_wait = uploader.stream_wait - begin_stream_wait if uploader else 0
+        if reader:
+            # Whichever side waited less for the other is the one holding things up
+            print('  waited %.1f s for reads, %.1f s for %s, %.1f s for a free stream: %s is the bottleneck' % (
+                reader.get_wait, reader.put_wait, 'uploads' if uploader else 'writes', stream_wait,
+                'reading' if reader.get_wait > reader.put_wait else 'uploading' if uploader else 'writing'))
+            metrics.counter('reader_wait', 's').inc(reader.get_wait)
+            metrics.counter('consumer_wait', 's').inc(reader.put_wait)
+        elif uploader:
+            # sendfile reads the file inside each upload, so reading and uploading
+            # can't be told apart here; near all of the time means the streams are full
+            print('  waited %.1f s of %.1f s for a free stream' % (stream_wait, end_time - begin_time))
+        if uploader:
+            metrics.counter('stream_wait', 's').inc(stream_wait)
+            uploader.report_streams()
+        print()
+        metrics.counter('files').inc()
+    finally:
+        if args.localpath:
+            os.close(output_fd)
+        if src_fd is not None:
+            os.close(src_fd)
+        if reader:
+            reader.stop()
 
 if __name__ == '__main__':
     main()
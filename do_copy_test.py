@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+'''Checks the chunked upload logic in do_copy.py: resuming after a chunk that never
+arrived, the window past the last gap, and chunk sizing. put_data is replaced, so
+nothing is sent. Runs under pytest or as a script.'''
+import json
+import time
+import threading
+
+import pytest
+
+import do_copy
+from do_copy import ChunkUploader, ChunkSizer, UploadProgress
+
+CHUNK = 10
+
+@pytest.fixture
+def put(monkeypatch):
+    '''Install f(dstfn, cpos) as put_data.'''
+    monkeypatch.setattr(do_copy, 'FAIL_TIMEOUT', 0.1)
+    def install(f):
+        monkeypatch.setattr(do_copy, 'put_data', lambda srcaddr_file, name, dstfn, cpos, data, totalsize, modtime: f(dstfn, cpos))
+    return install
+
+def make_uploader(progress=None, nstreams=3):
+    return ChunkUploader('wifi-addr', 'test', nstreams, ChunkSizer(CHUNK, False), progress)
+
+def upload_file(uploader, nchunks, dstfn='a.mov'):
+    for i in range(nchunks):
+        uploader.submit(dstfn, i * CHUNK, b'x' * CHUNK, nchunks * CHUNK, 0)
+    uploader.finish()
+
+def test_resume_from_gap(put, tmp_path):
+    # The second chunk fails for good after the ones around it have landed
+    def f(dstfn, cpos):
+        if cpos == CHUNK:
+            time.sleep(0.05)
+            raise ConnectionError('link down')
+    put(f)
+
+    path = str(tmp_path / 'progress.json')
+    uploader = make_uploader(UploadProgress(path))
+    with pytest.raises(ConnectionError):
+        upload_file(uploader, 3)
+    uploader.shutdown()
+
+    with open(path) as fp:
+        assert json.load(fp) == {'a.mov': CHUNK}
+
+    # The server has the whole file's size, but the gap is sent again
+    need = {}
+    UploadProgress(path).resume(need, {'a.mov': 3 * CHUNK})
+    assert need == {'a.mov': CHUNK}
+
+def test_landed_chunks_recorded_before_error(put):
+    def f(dstfn, cpos):
+        if cpos == 0:
+            time.sleep(0.05)
+            raise ConnectionError('link down')
+    put(f)
+
+    uploader = make_uploader()
+    for i in range(3):
+        uploader.submit('a.mov', i * CHUNK, b'x' * CHUNK, 3 * CHUNK, 0)
+    time.sleep(0.3)
+    with pytest.raises(ConnectionError):
+        uploader.finish()
+    assert uploader.landed['a.mov'] == {CHUNK: 2 * CHUNK, 2 * CHUNK: 3 * CHUNK}
+    uploader.shutdown()
+
+def test_window_stops_at_gap(put):
+    # While the first chunk is stuck, at most nstreams chunks may be sent past it
+    release = threading.Event()
+    furthest = []
+    def f(dstfn, cpos):
+        if cpos == 0:
+            release.wait(1)
+        elif not release.is_set():
+            furthest.append(cpos)
+    put(f)
+
+    uploader = make_uploader(nstreams=3)
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    upload_file(uploader, 10)
+    timer.join()
+    assert max(furthest) < 3 * CHUNK
+    uploader.shutdown()
+
+def test_complete_file_leaves_no_progress(put, tmp_path):
+    put(lambda dstfn, cpos: None)
+    path = str(tmp_path / 'progress.json')
+    progress = UploadProgress(path)
+    uploader = make_uploader(progress)
+    upload_file(uploader, 5)
+    uploader.shutdown()
+
+    assert progress.offsets == {}
+    need = {}
+    UploadProgress(path).resume(need, {'a.mov': 5 * CHUNK})
+    assert need == {}
+
+def test_resume_forgets_missing_files(tmp_path):
+    path = str(tmp_path / 'progress.json')
+    progress = UploadProgress(path)
+    progress.set('gone.mov', 100)
+    progress.set('b.mov', 20)
+
+    need = {'b.mov': 50}
+    progress.resume(need, {'b.mov': 80})
+    assert need == {'b.mov': 20}
+    assert progress.offsets == {'b.mov': 20}
+
+def test_chunk_sizer():
+    sizer = ChunkSizer(do_copy.BLOCK_SIZE)
+    sizer.update(do_copy.BLOCK_SIZE, 0.1, 0)
+    assert sizer.size == do_copy.BLOCK_SIZE + do_copy.BLOCK_STEP
+
+    sizer.update(sizer.size, 0.1, 1)
+    assert sizer.size == (do_copy.BLOCK_SIZE + do_copy.BLOCK_STEP) // 2
+
+    for i in range(20):
+        sizer.update(sizer.size, do_copy.SLOW_CHUNK_TIME + 1, 0)
+    assert sizer.size == do_copy.MIN_BLOCK_SIZE
+
+    fixed = ChunkSizer(do_copy.BLOCK_SIZE, False)
+    fixed.update(do_copy.BLOCK_SIZE, 0.1, 3)
+    assert fixed.size == do_copy.BLOCK_SIZE
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import time
+import errno
+import ctypes
+import platform
+
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+
+# Shared (non-private) futexes are required, since the waiter and waker are in
+# different processes mapping the same file.
+SYS_FUTEX = {
+    'x86_64': 202,
+    'i386': 240,
+    'i686': 240,
+    'armv6l': 240,
+    'armv7l': 240,
+    'aarch64': 98,
+    'riscv64': 98,
+}.get(platform.machine())
+
+class timespec(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_nsec', ctypes.c_long),
+    ]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_syscall = _libc.syscall
+
+def futex_wait(addr, val, timeout=None):
+    '''Sleep while the 32-bit word at address addr is equal to val, until woken by
+    futex_wake or until timeout seconds pass. Returns False only on timeout.'''
+    if SYS_FUTEX is None:
+        time.sleep(0.01 if timeout is None else min(timeout, 0.01))
+        return True
+
+    ts = None
+    if timeout is not None:
+        timeout = max(0, timeout)
+        ts = ctypes.byref(timespec(int(timeout), int((timeout % 1) * 1000000000)))
+
+    rv = _syscall(SYS_FUTEX, ctypes.c_void_p(addr), FUTEX_WAIT, ctypes.c_uint32(val), ts, None, 0)
+    if rv == -1:
+        err = ctypes.get_errno()
+        if err == errno.ETIMEDOUT:
+            return False
+        if err != errno.EAGAIN and err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+    return True
+
+def futex_wake(addr, count=0x7FFFFFFF):
+    '''Wake up to count processes waiting on the word at address addr.'''
+    if SYS_FUTEX is None:
+        return 0
+    return _syscall(SYS_FUTEX, ctypes.c_void_p(addr), FUTEX_WAKE, count, None, None, 0)
+
+def wait_seq(word, last_seq, timeout=None, odd_busy=True):
+    '''Block until the 32-bit counter at the start of the ctypes object word changes
+    from last_seq. If odd_busy is set, odd values mean an update is in progress and
+    are waited through. Returns the new value, or None on timeout.'''
+    addr = ctypes.addressof(word)
+    ptr = ctypes.cast(addr, ctypes.POINTER(ctypes.c_uint32))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        seq = ptr[0]
+        if seq != last_seq and not (odd_busy and seq & 1):
+            return seq
+
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+        futex_wait(addr, seq, remaining)
@@ -28,6 +28,12 @@
 #define SHM_SIZE 32768
 
 #define MAXWIDGETS 256
+
+// Must be a power of 2, and match hud_shm.py
+#define DIRTY_QUEUE_SIZE 512
+
+// Check every widget at least this often (in passes) even if none were queued
+#define FULL_SCAN_PASSES 20
 #define FLAG_ALIGN_RIGHT 1
 #define FLAG_ALIGN_CENTER 2
 #define FLAG_HIDE 2
@@ -89,12 +95,29 @@ typedef struct {
     int nchar;
     uint8_t visible;
     char* textbuf;
+
+    // Last consistent copy of the widget and its text; drawing only uses these
+    widget_t snap;
+    char* text;
 } widget_ldata_t;
 
 typedef struct {
     uint32_t version;
     uint32_t numwidgets;
     uint32_t visibility;
+    uint32_t update_seq;
+
+    uint64_t layout_hash;
+
+    uint64_t trace_stxtime;
+    uint32_t blit_seq;
+    uint32_t blit_latency_us;
+
+    uint32_t dirty_head;
+    uint32_t dirty_tail;
+    uint32_t dirty_overflow;
+    uint32_t dirty_reserved;
+    uint16_t dirty_queue[DIRTY_QUEUE_SIZE];
 } memheader_t;
 
 typedef void(*drawfunc)(cairo_t* ctx, widget_t* cw, widget_ldata_t* ld);
@@ -120,6 +143,9 @@ static int src_stride;
 static int dst_stride;
 
 static widget_ldata_t widget_ldata[MAXWIDGETS];
+static char text_copy[SHM_SIZE];
+static int passes_since_scan;
+static uint64_t last_trace_stxtime;
 
 static uint16_t dirty_bits[16];
 static uint8_t tile_widgets[256 * 32];
@@ -305,16 +331,24 @@ void load_widgets() {
             ld->nchar = cw->cnchar;
             if (textbuf + ld->nchar > shmend) {
                 ld->nchar = 0;
+                ld->text = "";
             } else {
                 ld->textbuf = textbuf;
+                ld->text = text_copy + (textbuf - (char*)shmdata);
+                if (ld->nchar) {
+                    memcpy(ld->text, textbuf, ld->nchar);
+                    ld->text[ld->nchar - 1] = 0;
+                }
                 textbuf += ld->nchar;
             }
+            memcpy(&ld->snap, (widget_t*)cw, sizeof(widget_t));
             ld->last_version = cw->version - 1;
         }
         if (cvers == shmhdr->version) {
             cur_header.version = cvers;
             cur_header.numwidgets = nw;
             cur_header.visibility = 0;
+            passes_since_scan = FULL_SCAN_PASSES;
             clear_image(frontctx, 0);
             mark_screen_dirty();
             break;
@@ -331,6 +365,63 @@ void load_widgets() {
     }
 }
 
+/* Each widget's version is a sequence lock: the writer makes it odd while changing the
+   widget and even again when done. Copy the widget and its text, and keep the copy
+   only if the version was even and unchanged throughout. Otherwise the previous copy
+   stays in place; check_widget then makes the next pass a full scan, since the writer
+   may not queue the widget again. */
+int snapshot_widget(volatile widget_t* cw, widget_ldata_t* ld, uint32_t version) {
+    widget_t snap;
+    char text[256];
+    int tries;
+
+    for (tries = 0; tries < 4; tries++) {
+        if (version & 1)
+            return 0;
+
+        memcpy(&snap, (widget_t*)cw, sizeof(widget_t));
+        if (ld->nchar)
+            memcpy(text, ld->textbuf, ld->nchar);
+
+        __atomic_thread_fence(__ATOMIC_ACQUIRE);
+        uint32_t check = __atomic_load_n(&cw->version, __ATOMIC_RELAXED);
+        if (check == version) {
+            ld->snap = snap;
+            if (ld->nchar) {
+                memcpy(ld->text, text, ld->nchar);
+                ld->text[ld->nchar - 1] = 0;
+            }
+            ld->last_version = version;
+            return 1;
+        }
+        version = check;
+    }
+    return 0;
+}
+
+void check_widget(int i, uint32_t new_visibility) {
+    volatile widget_t* cw = &widgets[i];
+    widget_ldata_t* ld = &widget_ldata[i];
+
+    uint32_t version = __atomic_load_n(&cw->version, __ATOMIC_ACQUIRE);
+    int was_visible = IS_VISIBLE((&ld->snap), cur_header.visibility);
+    int now_visible = IS_VISIBLE((&ld->snap), new_visibility);
+    int changed = version != ld->last_version && snapshot_widget(cw, ld, version);
+    if (version != ld->last_version && !changed) {
+        // Caught mid-update; its dirty queue entry is used up, so look at every
+        // widget again on the next pass
+        passes_since_scan = FULL_SCAN_PASSES;
+    }
+    if ((now_visible && changed) || was_visible != now_visible) {
+        int yy;
+        //ld->updating_row = -1;
+        ld->visible = now_visible;
+
+        for (yy = ld->ty1; yy <= ld->ty2; yy++)
+            dirty_bits[yy] |= ld->dirty_mask;
+    }
+}
+
 void draw_widget_text(cairo_t* ctx, widget_t* cw, widget_ldata_t* ld) {
     int fontidx = cw->cfont;
     if (fontidx >= MAXFONTS || !fonts[fontidx]) return;
@@ -344,7 +435,7 @@ void draw_widget_text(cairo_t* ctx, widget_t* cw, widget_ldata_t* ld) {
 
     cairo_text_extents_t xt;
     if (flags & (FLAG_ALIGN_RIGHT|FLAG_ALIGN_CENTER)) {
-        cairo_text_extents(ctx, ld->textbuf, &xt);
+        cairo_text_extents(ctx, ld->text, &xt);
         if (flags & FLAG_ALIGN_CENTER) {
             xo += (cw->cw - xt.x_advance * cw->cxscale) / 2;
         } else {
@@ -354,7 +445,7 @@ void draw_widget_text(cairo_t* ctx, widget_t* cw, widget_ldata_t* ld) {
     cairo_translate(ctx, cw->cx + xo, cw->cy + cw->cyo);
     cairo_scale(ctx, cw->cxscale, 1);
     cairo_move_to(ctx, 0, 0);
-    cairo_text_path(ctx, ld->textbuf);
+    cairo_text_path(ctx, ld->text);
     cairo_fill(ctx);
     cairo_identity_matrix(ctx);
     uint32_t strike = cw->cstrike;
@@ -414,21 +505,30 @@ void draw_widgets() {
 
     numupdates = 0;
 
+    // Read before looking at any widgets, so the blit below includes this frame
+    uint64_t trace_stxtime = __atomic_load_n(&hdr->trace_stxtime, __ATOMIC_ACQUIRE);
+    int blitted = 0;
+
     uint32_t new_visibility = hdr->visibility;
-    for (i = 0, cw = widgets, ld = widget_ldata; i < cur_header.numwidgets; i++, cw++, ld++) {
-        uint32_t version = cw->version;
-        int was_visible = IS_VISIBLE(cw, cur_header.visibility);
-        int now_visible = IS_VISIBLE(cw, new_visibility);
-        if ((now_visible && version != ld->last_version) || was_visible != now_visible) {
-            int yy;
-            //ld->updating_row = -1;
-            ld->visible = now_visible;
-
-            for (yy = ld->ty1; yy <= ld->ty2; yy++)
-                dirty_bits[yy] |= ld->dirty_mask;
-            ld->last_version = version;
+    uint32_t head = __atomic_load_n(&hdr->dirty_head, __ATOMIC_ACQUIRE);
+    uint32_t tail = hdr->dirty_tail;
+    int overflow = __atomic_exchange_n(&hdr->dirty_overflow, 0, __ATOMIC_ACQ_REL);
+
+    // Only widgets in the dirty queue can have changed, unless the queue overflowed
+    // or the visibility changed.
+    if (overflow || head - tail > DIRTY_QUEUE_SIZE || new_visibility != cur_header.visibility ||
+        ++passes_since_scan >= FULL_SCAN_PASSES) {
+        passes_since_scan = 0;
+        for (i = 0; i < cur_header.numwidgets; i++)
+            check_widget(i, new_visibility);
+    } else {
+        for (; tail != head; tail++) {
+            uint32_t wjtnum = hdr->dirty_queue[tail & (DIRTY_QUEUE_SIZE - 1)];
+            if (wjtnum < cur_header.numwidgets)
+                check_widget(wjtnum, new_visibility);
         }
     }
+    __atomic_store_n(&hdr->dirty_tail, head, __ATOMIC_RELEASE);
 
     int cx, cy, ctx, cty, x1;
 
@@ -480,7 +580,7 @@ void draw_widgets() {
                 for (i = 0; i < numupdates; i++) {
                     int wjtnum = update_widgets[i];
                     ld = &widget_ldata[wjtnum];
-                    cw = &widgets[wjtnum];
+                    cw = &ld->snap;
 
                     if (i != 0) {
                         cairo_reset_clip(frontctx);
@@ -518,6 +618,7 @@ void draw_widgets() {
             if (z == 1) {
                 if (cx > screenw) cx = screenw;
                 blitter(x1, cy, cx - x1, ch);
+                blitted = 1;
             } else if (z == 2) {
                 x1 = cx;
             }
@@ -528,6 +629,15 @@ void draw_widgets() {
 
     memset(dirty_bits, 0, sizeof(dirty_bits));
     cur_header.visibility = new_visibility;
+
+    if (blitted && trace_stxtime != last_trace_stxtime) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        uint64_t now_us = (uint64_t)now.tv_sec * 1000000 + now.tv_nsec / 1000;
+        last_trace_stxtime = trace_stxtime;
+        hdr->blit_latency_us = now_us - trace_stxtime * 1000;
+        __atomic_store_n(&hdr->blit_seq, hdr->blit_seq + 1, __ATOMIC_RELEASE);
+    }
 }
 
 #ifndef SDL_SIM
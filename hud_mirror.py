@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+'''Mirrors the /dev/shm/hud segment to a phone or tablet, either over the Bluetooth
+SPP link serial_monitor.py already pushes car frames on, or to network clients over
+Wi-Fi when run as its own process.
+
+Only the segment is read, so a slow or stuck client can never hold up the monitor.
+Every message is
+
+    u8 type, u16 payload length, payload
+
+with all integers big-endian. Types:
+
+    L  layout: u32 layout version, u16 widget count, then per widget
+       i16 x, i16 y, u16 w, u16 h, i16 xo, i16 yo, u8 textsize, u8 font,
+       u8 flags, u8 xscale * 100, u32 visgroup, u32 vismask
+    V  visibility: u32
+    W  widget change: u16 index, u8 mask, then in order, only if the bit is set in
+       mask: text (1, u8 length + UTF-8), fg (2, u32), bg (4, u32), strike (8, u32)
+    S  end of a batch of changes; the client can redraw now
+
+A client gets a full layout and the state of every widget when it connects and
+whenever the layout changes. After that it only gets what changed. Each client has
+a small output buffer; while it is full, no new messages are queued for that
+client. Once it drains, the client gets only the latest state of whatever changed
+meanwhile.
+
+On the SPP link the messages share the stream with car frames (STX ... ETX). Each
+batch is sent as ENQ, the messages, ETX, with any byte from 0 to ENQ in the
+messages sent as EOT followed by the byte + 64, the escape the phone already uses
+for what it sends. serial_monitor.py does this when bluetooth_hud_mirror is set in
+the config.'''
+import time
+import socket
+import struct
+import select
+import argparse
+from select import EPOLLIN, EPOLLOUT, EPOLLERR, EPOLLHUP
+
+from hud_shm import WidgetConfig, Widget
+
+DEFAULT_PORT = 9901
+
+# Seconds between checks of the segment; same rate hud.c draws at
+POLL_INTERVAL = 0.05
+
+# New changes are only queued for a client while its backlog is smaller than this
+MAX_OUTBUF = 2048
+
+# Starts a batch of mirror messages on the SPP link
+SPP_START = 5
+SPP_END = 3
+SPP_ESCAPE = 4
+
+MSG_LAYOUT = b'L'
+MSG_VISIBILITY = b'V'
+MSG_WIDGET = b'W'
+MSG_SYNC = b'S'
+
+CHG_TEXT = 1
+CHG_FG = 2
+CHG_BG = 4
+CHG_STRIKE = 8
+
+hdr_struct = struct.Struct('>cH')
+layout_struct = struct.Struct('>hhHHhhBBBBII')
+
+def message(typ, payload=b''):
+    return hdr_struct.pack(typ, len(payload)) + payload
+
+def widget_state(snap, text):
+    return text, snap.cfg, snap.cbg, snap.cstrike
+
+def encode_layout(version, widgets):
+    parts = [struct.pack('>IH', version & 0xFFFFFFFF, len(widgets))]
+    for w in widgets:
+        parts.append(layout_struct.pack(
+            w.cx, w.cy, w.cw, w.ch, w.cxo, w.cyo, w.ctextsize, w.cfont, w.cflags & 0xFF,
+            min(255, int(w.cxscale * 100 + 0.5)), w.cvisgroup, w.cvismask))
+    return message(MSG_LAYOUT, b''.join(parts))
+
+def encode_widget(idx, old, new):
+    '''Encode the difference between widget states old (None if unknown) and new.
+    Returns None if nothing changed.'''
+    mask = 0
+    parts = []
+    text, fg, bg, strike = new
+    if old is None or text != old[0]:
+        mask |= CHG_TEXT
+        text = text[:255]
+        parts.append(bytes([len(text)]) + text)
+    for bit, val, i in ((CHG_FG, fg, 1), (CHG_BG, bg, 2), (CHG_STRIKE, strike, 3)):
+        if old is None or val != old[i]:
+            mask |= bit
+            parts.append(struct.pack('>I', val))
+    if not mask:
+        return None
+    return message(MSG_WIDGET, struct.pack('>HB', idx, mask) + b''.join(parts))
+
+def spp_frame(data):
+    '''Wrap a batch of messages for the SPP link.'''
+    out = bytearray([SPP_START])
+    for b in data:
+        if b <= SPP_START:
+            out.append(SPP_ESCAPE)
+            b += 64
+        out.append(b)
+    out.append(SPP_END)
+    return out
+
+def decode_messages(buf):
+    '''Split complete messages off the front of bytearray buf. Yields (type, payload)
+    and removes them from buf.'''
+    while len(buf) >= hdr_struct.size:
+        typ, length = hdr_struct.unpack_from(buf)
+        end = hdr_struct.size + length
+        if len(buf) < end:
+            return
+        payload = bytes(buf[hdr_struct.size:end])
+        del buf[:end]
+        yield typ, payload
+
+class LinkState:
+    '''What one link has been sent; a new one gets a full snapshot.'''
+    def __init__(self):
+        self.layout_version = None
+        self.visibility = None
+        self.sent = []
+
+class Client(LinkState):
+    def __init__(self, sock, addr):
+        super().__init__()
+        self.sock = sock
+        self.addr = addr
+        self.outbuf = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class Mirror:
+    '''The latest complete state of every widget in the segment.'''
+    def __init__(self, wc):
+        self.wc = wc
+        self.states = []
+        self.versions = []
+
+    def refresh(self):
+        '''Update our copy of each widget's state from the segment.'''
+        wc = self.wc
+        if wc.check_parse(Widget):
+            self.states = [None] * len(wc.widgets)
+            self.versions = [w.version - 1 for w in wc.widgets]
+
+        for idx, wjt in enumerate(wc.widgets):
+            if wjt.version != self.versions[idx]:
+                rv = wjt.snapshot()
+                if rv is not None:
+                    snap, text = rv
+                    self.versions[idx] = snap.version
+                    self.states[idx] = widget_state(snap, text)
+
+    def encode_changes(self, link):
+        '''Messages for everything link (a LinkState) hasn't been sent yet, ending
+        with MSG_SYNC, or nothing if it is up to date. Marks them as sent.'''
+        wc = self.wc
+        out = bytearray()
+        if link.layout_version != wc.version:
+            link.layout_version = wc.version
+            link.visibility = None
+            link.sent = [None] * len(wc.widgets)
+            out += encode_layout(wc.version, wc.widgets)
+
+        vis = wc.hdr.visibility
+        if vis != link.visibility:
+            link.visibility = vis
+            out += message(MSG_VISIBILITY, struct.pack('>I', vis))
+
+        sent = link.sent
+        for idx, state in enumerate(self.states):
+            if state is not None and state is not sent[idx]:
+                msg = encode_widget(idx, sent[idx], state)
+                sent[idx] = state
+                if msg:
+                    out += msg
+
+        if out:
+            out += message(MSG_SYNC)
+        return out
+
+class MirrorServer:
+    def __init__(self, wc, port=DEFAULT_PORT, bind=''):
+        self.mirror = Mirror(wc)
+        self.clients = {}
+
+        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lsock.bind((bind, port))
+        self.lsock.listen(4)
+        self.lsock.setblocking(False)
+
+        self.poller = select.epoll()
+        self.poller.register(self.lsock, EPOLLIN)
+
+    def update_client(self, client):
+        '''Queue everything client hasn't seen yet, unless it is backed up.'''
+        if len(client.outbuf) >= MAX_OUTBUF:
+            return
+
+        out = self.mirror.encode_changes(client)
+        if out:
+            client.outbuf += out
+            self.flush(client)
+
+    def flush(self, client):
+        try:
+            while client.outbuf:
+                nw = client.sock.send(client.outbuf)
+                del client.outbuf[:nw]
+        except BlockingIOError:
+            self.poller.modify(client.sock, EPOLLIN | EPOLLOUT)
+            return
+        except OSError as e:
+            print('%s: send failed: %s' % (client.addr, e))
+            self.drop(client)
+            return
+        self.poller.modify(client.sock, EPOLLIN)
+
+    def accept(self):
+        try:
+            sock, addr = self.lsock.accept()
+        except BlockingIOError:
+            return
+        print('%s: connected' % (addr,))
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = Client(sock, addr)
+        self.clients[sock.fileno()] = client
+        self.poller.register(sock, EPOLLIN)
+        self.mirror.refresh()
+        self.update_client(client)
+
+    def drop(self, client):
+        print('%s: disconnected' % (client.addr,))
+        self.clients.pop(client.fileno(), None)
+        try:
+            self.poller.unregister(client.sock)
+        except OSError:
+            pass
+        client.sock.close()
+
+    def handle_event(self, fd, evt):
+        if fd == self.lsock.fileno():
+            self.accept()
+            return
+
+        client = self.clients.get(fd)
+        if client is None:
+            return
+
+        if evt & (EPOLLERR | EPOLLHUP):
+            self.drop(client)
+            return
+
+        if evt & EPOLLIN:
+            # Clients have nothing to say; just notice when they hang up
+            try:
+                if not client.sock.recv(256):
+                    self.drop(client)
+                    return
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.drop(client)
+                return
+
+        if evt & EPOLLOUT:
+            self.flush(client)
+            if fd in self.clients and not client.outbuf:
+                self.update_client(client)
+
+    def run(self):
+        next_refresh = time.monotonic()
+        while True:
+            timeout = max(0, next_refresh - time.monotonic())
+            for fd, evt in self.poller.poll(timeout):
+                self.handle_event(fd, evt)
+
+            ctime = time.monotonic()
+            if ctime >= next_refresh:
+                next_refresh = ctime + POLL_INTERVAL
+                if self.clients:
+                    self.mirror.refresh()
+                    for client in list(self.clients.values()):
+                        self.update_client(client)
+
+def run_client(host, port):
+    '''Connect to a mirror server and print what it sends, for debugging.'''
+    sock = socket.create_connection((host, port))
+    buf = bytearray()
+    nbytes = 0
+    while True:
+        dat = sock.recv(4096)
+        if not dat:
+            break
+        nbytes += len(dat)
+        buf.extend(dat)
+        for typ, payload in decode_messages(buf):
+            if typ == MSG_LAYOUT:
+                version, nw = struct.unpack_from('>IH', payload)
+                print('layout %d: %d widgets' % (version, nw))
+            elif typ == MSG_VISIBILITY:
+                print('visibility %08x' % struct.unpack('>I', payload))
+            elif typ == MSG_WIDGET:
+                idx, mask = struct.unpack_from('>HB', payload)
+                txt = ''
+                if mask & CHG_TEXT:
+                    txt = payload[4:4 + payload[3]].decode('utf8', 'replace')
+                print('widget %d mask=%x %r' % (idx, mask, txt))
+            elif typ == MSG_SYNC:
+                print('-- %d bytes' % nbytes)
+
+def main():
+    p = argparse.ArgumentParser(description='Stream HUD widget changes to network clients')
+    p.add_argument('-s', '--shm', default='/dev/shm/hud', help='HUD shared segment to read')
+    p.add_argument('-P', '--port', type=int, default=DEFAULT_PORT, help='TCP port to listen on')
+    p.add_argument('-b', '--bind', default='', help='address to listen on')
+    p.add_argument('-c', '--connect', metavar='HOST', help='connect to a server and dump its messages instead')
+    args = p.parse_args()
+
+    if args.connect:
+        run_client(args.connect, args.port)
+        return
+
+    server = MirrorServer(WidgetConfig.from_mmap(args.shm), args.port, args.bind)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+'''Headless renderer for the /dev/shm/hud segment, for screenshots and benchmarking
+on machines without a framebuffer. Follows the same drawing and visibility rules as
+hud.c, but with PIL instead of Cairo.'''
+import os
+import time
+import argparse
+from os.path import join
+
+from hud_shm import WidgetConfig, Widget, FLAG_ALIGN_RIGHT, FLAG_ALIGN_CENTER
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = ImageDraw = ImageFont = None
+
+# Same as hud.c: index 0 is a bold sans font, 1 is a bold monospace font
+FONT_FILES = [
+    'DejaVuSans-Bold.ttf',
+    'DejaVuSansMono-Bold.ttf',
+]
+
+def rgb(c):
+    return (c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF
+
+def rgba(c):
+    return (c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF, (c >> 24) & 0xFF
+
+def is_visible(wjt, visibility):
+    return wjt.cvisgroup == (visibility & wjt.cvismask)
+
+def overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+class HudRenderer:
+    '''Keeps a PIL image in sync with a HUD segment. Each call to render() redraws
+    only widgets that changed, were shown or were hidden since the last call.'''
+
+    def __init__(self, buf, width=800, height=480):
+        self.wc = WidgetConfig(buf)
+        self.width = width
+        self.height = height
+        self.image = Image.new('RGB', (width, height))
+        self.fonts = {}
+        self.states = []
+        self.visibility = 0
+
+        self.frames = 0
+        self.widgets_drawn = 0
+        self.render_time = 0
+
+    @classmethod
+    def from_mmap(cls, path, width=800, height=480):
+        return cls(WidgetConfig.from_mmap(path).buf, width, height)
+
+    def get_font(self, idx, size):
+        key = idx, size
+        font = self.fonts.get(key)
+        if font is None:
+            try:
+                font = ImageFont.truetype(FONT_FILES[idx], size)
+            except (IndexError, OSError):
+                try:
+                    font = ImageFont.load_default(size)
+                except TypeError:
+                    # Pillow before 10.1 only has the fixed-size bitmap font
+                    font = ImageFont.load_default()
+            self.fonts[key] = font
+        return font
+
+    def render(self):
+        '''Bring the image up to date. Returns the list of (x1, y1, x2, y2) rectangles
+        that were redrawn.'''
+        st = time.perf_counter()
+        wc = self.wc
+        if wc.check_parse(Widget):
+            # New layout: like hud.c, start from a blank screen
+            self.states = [[w.version - 1, None, b'', False] for w in wc.widgets]
+            self.visibility = 0
+            self.image.paste((0, 0, 0), (0, 0, self.width, self.height))
+
+        new_visibility = wc.hdr.visibility
+        dirty = []
+        for wjt, state in zip(wc.widgets, self.states):
+            last_version, snap, text, was_visible = state
+            if wjt.version != last_version:
+                rv = wjt.snapshot()
+                if rv is not None:
+                    snap, text = rv
+                    state[0] = snap.version
+                    state[1] = snap
+                    state[2] = text
+                    changed = True
+                else:
+                    changed = False
+            else:
+                changed = False
+
+            if snap is None:
+                continue
+
+            now_visible = is_visible(snap, new_visibility)
+            if (now_visible and changed) or was_visible != now_visible:
+                state[3] = now_visible
+                dirty.append((snap.cx, snap.cy, snap.cx + snap.cw, snap.cy + snap.ch))
+
+        self.visibility = new_visibility
+        for rect in dirty:
+            self.redraw(rect)
+
+        self.frames += 1
+        self.render_time += time.perf_counter() - st
+        return dirty
+
+    def redraw(self, rect):
+        '''Clear rect and draw every visible widget that overlaps it, in order.'''
+        x1, y1, x2, y2 = rect
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        x2 = min(self.width, x2)
+        y2 = min(self.height, y2)
+        if x2 <= x1 or y2 <= y1:
+            return
+
+        # Draw into a separate image so nothing outside the rectangle is touched
+        sub = Image.new('RGB', (x2 - x1, y2 - y1))
+        for snap, text, visible in ((s[1], s[2], s[3]) for s in self.states):
+            if not visible:
+                continue
+            wrect = snap.cx, snap.cy, snap.cx + snap.cw, snap.cy + snap.ch
+            if overlaps(wrect, (x1, y1, x2, y2)):
+                self.draw_widget(sub, snap, text, -x1, -y1)
+                self.widgets_drawn += 1
+        self.image.paste(sub, (x1, y1))
+
+    def draw_widget(self, im, cw, text, ox, oy):
+        x = cw.cx + ox
+        y = cw.cy + oy
+        # Widgets never draw outside their own rectangle
+        cell = Image.new('RGB', (cw.cw, cw.ch))
+        cell.paste(im.crop((x, y, x + cw.cw, y + cw.ch)))
+        if cw.cbg:
+            ImageDraw.Draw(cell, 'RGBA').rectangle((0, 0, cw.cw, cw.ch), fill=rgba(cw.cbg))
+
+        if cw.ctype == 0:
+            self.draw_text(cell, cw, text.decode('utf8', 'replace'))
+
+        im.paste(cell, (x, y))
+
+    def draw_text(self, cell, cw, text):
+        if text:
+            font = self.get_font(cw.cfont, cw.ctextsize)
+            ascent, descent = font.getmetrics()
+            advance = font.getlength(text)
+            mask = Image.new('L', (max(1, int(advance + 0.5)), ascent + descent))
+            ImageDraw.Draw(mask).text((0, ascent), text, fill=255, font=font, anchor='ls')
+            if cw.cxscale != 1:
+                mask = mask.resize((max(1, int(mask.width * cw.cxscale + 0.5)), mask.height))
+
+            xo = cw.cxo
+            if cw.cflags & FLAG_ALIGN_CENTER:
+                xo += (cw.cw - advance * cw.cxscale) / 2
+            elif cw.cflags & FLAG_ALIGN_RIGHT:
+                xo += cw.cw - advance * cw.cxscale
+            cell.paste(rgb(cw.cfg), (int(xo), cw.cyo - ascent), mask)
+
+        if cw.cstrike:
+            ImageDraw.Draw(cell).line((0, cw.ch // 2, cw.cw, cw.ch // 2), fill=rgb(cw.cstrike), width=3)
+
+    def stats(self):
+        return '%d frames, %d widgets drawn, %.2f ms/frame' % (
+            self.frames, self.widgets_drawn, 1000 * self.render_time / max(1, self.frames))
+
+def main():
+    p = argparse.ArgumentParser(description='Render the HUD shared segment to PNG files without a framebuffer')
+    p.add_argument('-s', '--shm', default='/dev/shm/hud', help='HUD shared segment to read')
+    p.add_argument('-o', '--output', default='hudcap', help='directory for PNG frames')
+    p.add_argument('-n', '--count', type=int, default=0, help='stop after this many frames (0 = no limit)')
+    p.add_argument('-1', '--once', action='store_true', help='write a single screenshot and exit')
+    p.add_argument('-N', '--no-write', action='store_true', help='render without writing PNG files, for benchmarking')
+    p.add_argument('-t', '--timeout', type=float, default=1, help='seconds to wait for an update before rendering anyway')
+    args = p.parse_args()
+
+    rend = HudRenderer.from_mmap(args.shm)
+    os.makedirs(args.output, exist_ok=True)
+
+    if args.once:
+        rend.render()
+        rend.image.save(join(args.output, 'hud.png'))
+        return
+
+    seq = rend.wc.hdr.update_seq
+    nframe = 0
+    try:
+        while not args.count or nframe < args.count:
+            newseq = rend.wc.wait_update(seq, args.timeout)
+            if newseq is not None:
+                seq = newseq
+            if rend.render():
+                if not args.no_write:
+                    rend.image.save(join(args.output, 'frame-%06d.png' % nframe))
+                nframe += 1
+    except KeyboardInterrupt:
+        pass
+    print(rend.stats())
+
+if __name__ == '__main__':
+    main()
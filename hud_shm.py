@@ -2,6 +2,9 @@ import os
 from ctypes import *
 import mmap
 import weakref
+import hashlib
+
+from futex import futex_wake, wait_seq
 
 __all__ = [
     'FLAG_ALIGN_RIGHT',
@@ -35,6 +38,9 @@ AT_RIGHT = 3
 
 CENTER_OF = 4
 
+# Must be a power of 2, and match hud.c
+DIRTY_QUEUE_SIZE = 512
+
 txtbuf_types = {}
 
 PREV = object()
@@ -84,6 +90,10 @@ class Widget(Structure):
     visgroup = 0
     vismask = 0
 
+    # Set by WidgetConfig.build() so bump_version() can queue the widget for redraw
+    widget_config = None
+    widget_index = 0
+
     def __init__(self):
         self.last_rawval = None
         self.textbuf = None
@@ -95,10 +105,31 @@ class Widget(Structure):
         self.text = self.fmt % rv
 
     def set_text(self, text):
-        self.textbuf.value = text.encode('utf8')[:self.nchar]
+        self.set_raw_text(text.encode('utf8')[:self.nchar])
+
+    def set_raw_text(self, data):
+        '''Set the text from already encoded and truncated bytes.'''
+        self.version |= 1
+        self.textbuf.value = data
 
     def bump_version(self):
-        self.version += 1
+        '''Publish all changes made since the last call.'''
+        self.version = (self.version | 1) + 1
+        if self.widget_config is not None:
+            self.widget_config.mark_dirty(self.widget_index)
+
+    def snapshot(self):
+        '''Return (copy of this widget, text) reflecting a completed update, or None if
+        an update is in progress.'''
+        for i in range(4):
+            version = self.version
+            if version & 1:
+                return None
+            copy = Widget.from_buffer_copy(self)
+            text = self.textbuf.value if self.textbuf is not None else b''
+            if self.version == version:
+                return copy, text
+        return None
 
     def getkey(self):
         return type(self).__name__
@@ -113,11 +144,55 @@ class Widget(Structure):
             self.update_rawval(rv)
 
 
+SHARED_FIELDS = frozenset(name for name, typ in Widget._fields_) - {'version'}
+
+class SharedField:
+    '''Wraps the ctypes descriptor of a field the renderer reads. version doubles as
+    a sequence lock: setting the field makes it odd, bump_version() makes it even
+    again, and the renderer won't copy the widget while it is odd.'''
+    def __init__(self, field, version):
+        self.field = field
+        self.version = version
+
+    def __get__(self, obj, typ=None):
+        if obj is None:
+            return self.field
+        return self.field.__get__(obj, typ)
+
+    def __set__(self, obj, value):
+        version = self.version
+        version.__set__(obj, version.__get__(obj) | 1)
+        self.field.__set__(obj, value)
+
+for _name in SHARED_FIELDS:
+    setattr(Widget, _name, SharedField(Widget.__dict__[_name], Widget.__dict__['version']))
+
 class MemHeader(Structure):
     _fields_ = [
         ('version', c_uint32),
         ('numwidgets', c_uint32),
         ('visibility', c_uint32),
+        ('update_seq', c_uint32),
+
+        # Hash of the widget layout written by build(); see layout_hash()
+        ('layout_hash', c_uint64),
+
+        # Latency tracing: the writer stores the STX time (monotonic ms) of the last
+        # traced frame in trace_stxtime. After the renderer next blits, it stores the
+        # time since then in blit_latency_us and increments blit_seq.
+        ('trace_stxtime', c_uint64),
+        ('blit_seq', c_uint32),
+        ('blit_latency_us', c_uint32),
+
+        # Single-producer, single-consumer ring of widget indices changed since the
+        # renderer last looked. The writer advances dirty_head and the renderer
+        # advances dirty_tail; if the ring fills up, dirty_overflow tells the renderer
+        # to check every widget instead.
+        ('dirty_head', c_uint32),
+        ('dirty_tail', c_uint32),
+        ('dirty_overflow', c_uint32),
+        ('dirty_reserved', c_uint32),
+        ('dirty_queue', c_uint16 * DIRTY_QUEUE_SIZE),
     ]
 
 def widget_decorator(widget_list):
@@ -184,6 +259,8 @@ class WidgetConfig:
                 nc = w.cnchar
                 if nc:
                     w.textbuf = char_array(self.buf, w.ctextptr, nc + 1)
+                else:
+                    w.textbuf = None
                 w.lasttext = w.lastfg = w.lastbg = w.laststrike = None
 
             if vers_start == self.hdr.version:
@@ -195,6 +272,27 @@ class WidgetConfig:
             return True
         return False
 
+    def notify(self):
+        '''Called by the writer after each batch of widget updates.'''
+        self.hdr.update_seq += 1
+        futex_wake(addressof(self.hdr) + MemHeader.update_seq.offset)
+
+    def wait_update(self, last_seq, timeout=None):
+        '''Block until notify() has been called since update_seq was last_seq. Returns
+        the new update_seq, or None on timeout.'''
+        word = c_uint32.from_buffer(self.buf, MemHeader.update_seq.offset)
+        return wait_seq(word, last_seq, timeout, odd_busy=False)
+
+    def mark_dirty(self, index):
+        '''Queue widget number index for the renderer to check.'''
+        hdr = self.hdr
+        head = hdr.dirty_head
+        if (head - hdr.dirty_tail) & 0xFFFFFFFF >= DIRTY_QUEUE_SIZE:
+            hdr.dirty_overflow = 1
+            return
+        hdr.dirty_queue[head & (DIRTY_QUEUE_SIZE - 1)] = index
+        hdr.dirty_head = head + 1
+
     def set_visgroup(self, mask, group):
         vis = self.hdr.visibility
         vis &= ~mask
@@ -202,17 +300,64 @@ class WidgetConfig:
         self.hdr.visibility = vis
 
     def build(self, widgetlist, sw, sh):
-        self.hdr.visibility = 0
-        self.hdr.numwidgets = 0
-        self.hdr.version += 1
-        self.widgets = []
-        scr = Widget()
+        '''Lay out the widgets in widgetlist on a screen of size sw x sh. If the shared
+        segment already holds an identical layout (as it does after a hot reload),
+        the new widgets are bound to the existing entries, so the renderer keeps
+        what it is showing and nothing is redrawn.'''
+
+        # Lay everything out in a scratch copy first, so the layout can be compared
+        # with the live one before touching it
+        scratch = bytearray(len(self.buf))
+        swidgets, by_key, textend = self.layout(scratch, widgetlist, sw, sh)
+        lhash = layout_hash(scratch, swidgets, sw, sh)
+
+        hdr = self.hdr
+        reuse = hdr.layout_hash == lhash and hdr.numwidgets == len(swidgets)
+        if not reuse:
+            hdr.visibility = 0
+            hdr.numwidgets = 0
+            hdr.version += 1
+            start = sizeof(MemHeader)
+            self.buf[start:textend] = scratch[start:textend]
 
         buf = self.buf
+        pos = sizeof(MemHeader)
+        size_spec = sizeof(Widget)
+        self.widgets = []
+        self.by_key = {'screen': by_key['screen']}
+
+        for cls, swjt in zip(widgetlist, swidgets):
+            if isinstance(cls, type):
+                widget = cls.from_buffer(buf, pos)
+            else:
+                widget = cls(buf, pos)
+            pos += size_spec
+
+            widget.__dict__.update(swjt.__dict__)
+            widget.widget_config = self
+            if widget.nchar:
+                widget.textbuf = char_array(buf, widget.ctextptr, widget.nchar + 1)
+            self.by_key[widget.getkey()] = widget
+            self.widgets.append(widget)
+
+        if not reuse:
+            for widget in self.widgets:
+                widget.bump_version()
+            hdr.layout_hash = lhash
+            hdr.numwidgets = len(self.widgets)
+            hdr.version += 1
+
+        return reuse
+
+    def layout(self, buf, widgetlist, sw, sh):
+        '''Create the widgets in widgetlist in buf and resolve their positions. Returns
+        (widgets, by_key, end of text area).'''
+        widgets = []
+        scr = Widget()
 
         scr.w = sw
         scr.h = sh
-        by_key = self.by_key = {'screen': scr}
+        by_key = {'screen': scr}
 
         pos = sizeof(MemHeader)
         size_spec = sizeof(Widget)
@@ -226,10 +371,11 @@ class WidgetConfig:
                 widget = cls(buf, pos)
 
             pos += size_spec
+            widget.widget_index = len(widgets)
             by_key[widget.getkey()] = widget
-            self.widgets.append(widget)
+            widgets.append(widget)
 
-        for wjt in self.widgets:
+        for wjt in widgets:
             wjt.cw = wjt.w
             wjt.ch = wjt.h
             wjt.cbg = wjt.bg
@@ -247,7 +393,7 @@ class WidgetConfig:
 
             if wjt.nchar:
                 wjt.ctextptr = textptr
-                wjt.textbuf = char_array(self.buf, textptr, wjt.nchar + 1)
+                wjt.textbuf = char_array(buf, textptr, wjt.nchar + 1)
                 wjt.textbuf[0] = 0
                 wjt.textbuf[wjt.nchar] = 0
                 textptr += wjt.nchar + 1
@@ -261,11 +407,26 @@ class WidgetConfig:
             set_pos(wjt, wjt.ypos, 'cy', 'h', by_key)
             by_key['prev'] = wjt
 
-        for wjt in self.widgets:
+        for wjt in widgets:
             wjt.post_build()
 
-        self.hdr.numwidgets = len(self.widgets)
-        self.hdr.version += 1
+        return widgets, by_key, textptr
+
+def layout_hash(buf, widgets, sw, sh):
+    '''Hash everything build() decides about a layout: the screen size, and for each
+    widget its class, key, geometry, style, text buffer placement and any static
+    text set while laying out, such as a label from post_build().'''
+    h = hashlib.blake2b(digest_size=8)
+    h.update(b'%d %d' % (sw, sh))
+    size_spec = sizeof(Widget)
+    for wjt in widgets:
+        h.update(repr((type(wjt).__name__, wjt.getkey())).encode('utf8'))
+        pos = sizeof(MemHeader) + wjt.widget_index * size_spec
+        # Skip version, which changes with every update
+        h.update(buf[pos + sizeof(c_uint32) : pos + size_spec])
+        if wjt.nchar:
+            h.update(buf[wjt.ctextptr : wjt.ctextptr + wjt.cnchar])
+    return int.from_bytes(h.digest(), 'little')
 
 def test():
     buf = bytearray(128)
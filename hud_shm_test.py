@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+'''Checks the HUD segment written by hud_shm.py: the seqlock on shared widget
+fields, the dirty queue hud.c reads, and reusing a layout across hot reloads. The
+segment is an ordinary buffer here. Runs under pytest or as a script.'''
+import pytest
+
+import hud_shm
+from hud_shm import WidgetConfig, Widget, widget_decorator, AT_LEFT, AT_TOP, ON_RIGHT
+
+class LabelWidget(Widget):
+    w = 50
+    h = 20
+    nchar = 8
+    fg = bg = xo = yo = font = flags = strike = wtype = 0
+    visgroup = vismask = 0
+    textsize = 10
+    xscale = 1
+    xpos = AT_LEFT, 'screen'
+    ypos = AT_TOP, 'screen'
+    label = ''
+
+    def post_build(self):
+        if self.label:
+            self.set_text(self.label)
+
+def widget_list(label='', nwidgets=2):
+    lst = []
+    wjt = widget_decorator(lst)
+    for i in range(nwidgets):
+        attrs = {'label': label if i == 0 else ''}
+        if i:
+            attrs['xpos'] = ON_RIGHT, 'prev'
+        wjt(type('W%d' % i, (LabelWidget,), attrs))
+    return lst
+
+def new_config():
+    return WidgetConfig(bytearray(32768))
+
+def dirty(wc):
+    hdr = wc.hdr
+    rv = [hdr.dirty_queue[i & (hud_shm.DIRTY_QUEUE_SIZE - 1)] for i in range(hdr.dirty_tail, hdr.dirty_head)]
+    hdr.dirty_tail = hdr.dirty_head
+    return rv
+
+def test_seqlock():
+    wc = new_config()
+    wc.build(widget_list(), 800, 480)
+    w = wc.widgets[1]
+    assert w.version & 1 == 0
+
+    w.cfg = 0xFF0000
+    assert w.version & 1
+    assert w.snapshot() is None
+
+    w.set_text('12.3')
+    w.bump_version()
+    assert w.version & 1 == 0
+    snap, text = w.snapshot()
+    assert (snap.cfg, text) == (0xFF0000, b'12.3')
+
+def test_dirty_queue():
+    wc = new_config()
+    wc.build(widget_list(), 800, 480)
+    dirty(wc)
+
+    wc.widgets[1].set_text('x')
+    wc.widgets[1].bump_version()
+    wc.widgets[0].bump_version()
+    assert dirty(wc) == [1, 0]
+
+    # A full queue sets the overflow flag instead of losing track of widgets
+    for i in range(hud_shm.DIRTY_QUEUE_SIZE + 1):
+        wc.mark_dirty(1)
+    assert wc.hdr.dirty_overflow == 1
+
+def test_layout_reuse():
+    wc = new_config()
+    assert not wc.build(widget_list('km/h'), 800, 480)
+    wc.widgets[1].set_text('42')
+    wc.widgets[1].bump_version()
+
+    # A hot reload with the same layout keeps the segment and what it shows
+    assert wc.build(widget_list('km/h'), 800, 480)
+    assert wc.widgets[1].textbuf.value == b'42'
+
+    # A changed label is part of the layout
+    assert not wc.build(widget_list('mph'), 800, 480)
+    assert wc.widgets[0].textbuf.value == b'mph'
+
+    assert not wc.build(widget_list('mph', 3), 800, 480)
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
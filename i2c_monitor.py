@@ -11,6 +11,7 @@ from os.path import dirname, basename, join, exists, expanduser
 from utils import getmtime
 
 import i2c_shmem
+from metrics import Metrics
 
 MCP23017_ADDR = 0x20
 PCF8574_ADDR = 0x27
@@ -65,6 +66,13 @@ def main():
 
     gpio = I2C.get_i2c_device(address=PCF8574_ADDR, busnum=args.bus)
 
+    metrics = Metrics('i2c_monitor')
+    m_volts = metrics.gauge('volts', 'V')
+    m_current = metrics.gauge('current', 'mA')
+    m_ina_errors = metrics.counter('ina_errors')
+    m_gpio_errors = metrics.counter('gpio_errors')
+    m_loop_time = metrics.histogram('loop_time')
+
     lastval = [None] * 8
     last_dirbits = 0
 
@@ -72,6 +80,7 @@ def main():
     shutdown_enable_time = 0
 
     while True:
+        st = getmtime()
         if ina:
             try:
                 volt = ina.supply_voltage()
@@ -79,7 +88,10 @@ def main():
                 current = -ina.current()
                 data.volts = int(volt * 1000)
                 data.current = int(current)
+                m_volts.set(volt)
+                m_current.set(current)
             except Exception:
+                m_ina_errors.inc()
                 data.volts = 0
                 data.current = 0
                 pass
@@ -118,8 +130,10 @@ def main():
             try:
                 gpio.writeRaw8(valbits)
             except Exception:
+                m_gpio_errors.inc()
                 traceback.print_exc()
 
+        m_loop_time.observe((getmtime() - st) * 1000)
         time.sleep(0.1)
 
 
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+'''Frame-to-pixel latency tracing.
+
+When enabled, the monitor measures how long after a data frame's STX byte arrived
+it passed the CRC check, was parsed into CarData, was written to the log and had
+its widgets updated, and hud.c reports how long until it blitted the result. Each
+stage goes into a histogram in /dev/shm/latency_trace.
+
+Tracing is switched on and off through the shared file, so it needs no restart:
+
+    latency_trace.py enable
+    latency_trace.py show
+'''
+import ctypes
+import argparse
+
+from cardata_shmem import ShareableStructure
+
+PATH = '/dev/shm/latency_trace'
+
+STAGES = ['crc', 'parse', 'log', 'bump', 'blit']
+STAGE_CRC, STAGE_PARSE, STAGE_LOG, STAGE_BUMP, STAGE_BLIT = range(len(STAGES))
+
+# Bucket 0 holds 0us; bucket n holds [2^(n-1), 2^n) us. The last bucket also holds
+# anything longer.
+NBUCKETS = 24
+
+class LatencyTrace(ShareableStructure):
+    _fields_ = [
+        ('enabled', ctypes.c_uint32),
+        ('last_blit_seq', ctypes.c_uint32),
+        ('count', ctypes.c_uint64 * len(STAGES)),
+        ('total_us', ctypes.c_uint64 * len(STAGES)),
+        ('max_us', ctypes.c_uint32 * len(STAGES)),
+        ('buckets', (ctypes.c_uint32 * NBUCKETS) * len(STAGES)),
+    ]
+
+    @classmethod
+    def create(cls, path=PATH):
+        return super().create(path)
+
+    def record(self, stage, us):
+        us = max(0, int(us))
+        self.count[stage] += 1
+        self.total_us[stage] += us
+        if us > self.max_us[stage]:
+            self.max_us[stage] = min(us, 0xFFFFFFFF)
+        self.buckets[stage][min(NBUCKETS - 1, us.bit_length())] += 1
+
+    def record_frame(self, stxtime, crc_time, parse_time, log_time, bump_time):
+        '''Record one frame. stxtime is BitStream.stxtime (monotonic milliseconds);
+        the rest are getmtime() values, or None if that stage was skipped.'''
+        stx = stxtime / 1000
+        for stage, t in ((STAGE_CRC, crc_time), (STAGE_PARSE, parse_time),
+                         (STAGE_LOG, log_time), (STAGE_BUMP, bump_time)):
+            if t is not None:
+                self.record(stage, (t - stx) * 1000000)
+
+    def check_blit(self, hdr):
+        '''Record the latest latency reported by hud.c in the HUD header, if new.'''
+        seq = hdr.blit_seq
+        if seq != self.last_blit_seq:
+            self.last_blit_seq = seq
+            self.record(STAGE_BLIT, hdr.blit_latency_us)
+
+    def reset(self):
+        enabled = self.enabled
+        ctypes.memset(ctypes.addressof(self), 0, ctypes.sizeof(self))
+        self.enabled = enabled
+
+    def percentile(self, stage, pct):
+        '''Upper bound in us of the bucket containing the pct'th percentile.'''
+        total = self.count[stage]
+        if not total:
+            return 0
+        want = total * pct / 100
+        seen = 0
+        for i, n in enumerate(self.buckets[stage]):
+            seen += n
+            if seen >= want:
+                return min((1 << i) - 1 if i else 0, self.max_us[stage])
+        return self.max_us[stage]
+
+def format_us(us):
+    if us >= 1000:
+        return '%.1fms' % (us / 1000)
+    return '%dus' % us
+
+def show(trace, histogram=False):
+    print('tracing %s' % ('enabled' if trace.enabled else 'disabled'))
+    print('%-6s %8s %9s %9s %9s %9s %9s' % ('stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for stage, name in enumerate(STAGES):
+        count = trace.count[stage]
+        mean = trace.total_us[stage] / count if count else 0
+        print('%-6s %8d %9s %9s %9s %9s %9s' % (
+            name, count, format_us(mean),
+            format_us(trace.percentile(stage, 50)), format_us(trace.percentile(stage, 90)),
+            format_us(trace.percentile(stage, 99)), format_us(trace.max_us[stage])))
+
+    if not histogram:
+        return
+
+    for stage, name in enumerate(STAGES):
+        buckets = trace.buckets[stage]
+        peak = max(buckets)
+        if not peak:
+            continue
+        print()
+        print('%s:' % name)
+        for i, n in enumerate(buckets):
+            if n:
+                print('  < %9s %8d %s' % (format_us(1 << i), n, '#' * (1 + 50 * n // peak)))
+
+def main():
+    p = argparse.ArgumentParser(description='Control and show frame-to-pixel latency tracing')
+    p.add_argument('command', nargs='?', default='show', choices=['show', 'enable', 'disable', 'reset'])
+    p.add_argument('-H', '--histogram', action='store_true', help='also print each stage\'s histogram')
+    args = p.parse_args()
+
+    trace = LatencyTrace.create()
+    if args.command == 'enable':
+        trace.enabled = 1
+    elif args.command == 'disable':
+        trace.enabled = 0
+    elif args.command == 'reset':
+        trace.reset()
+    else:
+        show(trace, args.histogram)
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ from binascii import b2a_hex
 from hashlib import sha256
 
 from utils import load_config, CONFIG, HMACHelper, HMACError
+from metrics import Metrics
 
 import log_hotload
 
@@ -58,6 +59,15 @@ def main():
     sock.bind(('', 22205))
 
     log.sock = sock
+
+    metrics = Metrics('log_receiver')
+    m_packets = metrics.counter('packets')
+    m_packet_bytes = metrics.counter('packet_bytes', 'B')
+    m_time_requests = metrics.counter('time_requests')
+    m_invalid = metrics.counter('invalid_packets')
+    m_errors = metrics.counter('handler_errors')
+    m_handle_time = metrics.histogram('handle_time')
+
     log_hotload.init(log)
     srcaddr = None
     while True:
@@ -65,11 +75,14 @@ def main():
             pkt, srcaddr = sock.recvfrom(256)
             ctime = strtime(time.time())
             if len(pkt) == 18 and pkt[:2] == b'tt':
+                m_time_requests.inc()
                 sock.sendto(pkt[:10] + struct.pack('>d', time.time()), srcaddr)
 
                 continue
 
             print('%s: received packet of length %d from %r' % (ctime, len(pkt), srcaddr))
+            m_packets.inc()
+            m_packet_bytes.inc(len(pkt))
             timestamp, pkt = verifier.verify_message(pkt)
 
             try:
@@ -85,13 +98,17 @@ def main():
                 except Exception:
                     print('exception initializing')
                     traceback.print_exc()
+            st = time.monotonic()
             try:
                 log_hotload.handle_packet(log, timestamp, pkt)
             except Exception:
+                m_errors.inc()
                 traceback.print_exc()
                 log.log([b2a_hex(pkt).decode('ascii')])
+            m_handle_time.observe((time.monotonic() - st) * 1000)
 
         except HMACError as e:
+            m_invalid.inc()
             print('Invalid packet from %r: %s' % (srcaddr, e))
         except Exception:
             traceback.print_exc()
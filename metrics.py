@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+'''Counters, gauges and histograms that other processes can read without asking.
+
+Each daemon keeps its metrics in its own file, /dev/shm/metrics-<process>, which it
+creates and zeroes when it starts:
+
+    metrics = Metrics('serial_monitor')
+    frames = metrics.counter('frames')
+    frames.inc()
+
+The owning process is the only writer, so updates are plain stores with no locking.
+Each value is an aligned 8-byte word, so a reader sees either the old or the new
+value. Within a histogram, the count and the buckets may be one observation apart.
+A metric is filled in before nmetrics is raised to include it, so readers never see
+a half-registered slot.
+
+Run this file (or carmon-stat) to print every process's metrics and their rates.
+'''
+import os
+import sys
+import time
+import glob
+import ctypes
+import bisect
+import argparse
+
+from cardata_shmem import ShareableStructure
+
+PATH_FORMAT = '/dev/shm/metrics-%s'
+
+NAME_LEN = 32
+UNIT_LEN = 8
+MAX_METRICS = 64
+MAX_BOUNDS = 16
+
+KIND_COUNTER, KIND_GAUGE, KIND_HISTOGRAM = 1, 2, 3
+KIND_NAMES = {KIND_COUNTER: 'counter', KIND_GAUGE: 'gauge', KIND_HISTOGRAM: 'histogram'}
+
+# Bucket upper bounds for timings in milliseconds
+MS_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class MetricSlot(ctypes.Structure):
+    _fields_ = [
+        ('name', ctypes.c_char * NAME_LEN),
+        ('unit', ctypes.c_char * UNIT_LEN),
+        ('kind', ctypes.c_uint32),
+        ('nbounds', ctypes.c_uint32),
+
+        # Counter total, gauge value or sum of histogram observations
+        ('value', ctypes.c_double),
+        ('count', ctypes.c_uint64),
+
+        # Bucket i counts observations <= bounds[i] and greater than the one before;
+        # bucket nbounds counts everything above the last bound.
+        ('bounds', ctypes.c_double * MAX_BOUNDS),
+        ('buckets', ctypes.c_uint64 * (MAX_BOUNDS + 1)),
+    ]
+
+class MetricsFile(ShareableStructure):
+    _fields_ = [
+        ('pid', ctypes.c_uint32),
+        ('nmetrics', ctypes.c_uint32),
+        ('start_time', ctypes.c_double),
+        ('slots', MetricSlot * MAX_METRICS),
+    ]
+
+class Counter:
+    '''A total that only goes up, such as frames received or bytes sent.'''
+    def __init__(self, slot):
+        self.slot = slot
+
+    def inc(self, n=1):
+        self.slot.value += n
+
+    def set(self, total):
+        '''Publish a total that is counted somewhere else.'''
+        self.slot.value = total
+
+    @property
+    def value(self):
+        return self.slot.value
+
+class Gauge:
+    '''A value that can go up and down, such as a voltage or a queue length.'''
+    def __init__(self, slot):
+        self.slot = slot
+
+    def set(self, val):
+        self.slot.value = val
+
+    def add(self, n):
+        self.slot.value += n
+
+    @property
+    def value(self):
+        return self.slot.value
+
+class Histogram:
+    '''Counts observations into fixed buckets, for timings and sizes.'''
+    def __init__(self, slot):
+        self.slot = slot
+        self.bounds = list(slot.bounds[:slot.nbounds])
+
+    def observe(self, val):
+        slot = self.slot
+        slot.buckets[bisect.bisect_left(self.bounds, val)] += 1
+        slot.value += val
+        slot.count += 1
+
+class Metrics:
+    '''The metrics for one process. Asking for a metric that already exists returns
+    the same object, so hot-reloaded modules can simply ask again after a reload.'''
+    def __init__(self, process, path=None):
+        self.process = process
+        self.file = mf = MetricsFile.create(path or PATH_FORMAT % process)
+
+        # A new process starts from zero; readers notice the pid changed
+        mf.begin_write()
+        ctypes.memset(ctypes.addressof(mf), 0, ctypes.sizeof(mf))
+        mf.pid = os.getpid()
+        mf.start_time = time.time()
+        mf.end_write()
+
+        self.metrics = {}
+
+    def _get(self, cls, kind, name, unit, bounds=()):
+        m = self.metrics.get(name)
+        if m is not None:
+            if not isinstance(m, cls):
+                raise TypeError('metric %s is a %s' % (name, KIND_NAMES[m.slot.kind]))
+            return m
+
+        mf = self.file
+        if mf.nmetrics < MAX_METRICS:
+            slot = mf.slots[mf.nmetrics]
+        else:
+            print('metrics: no room for %s, not publishing it' % name)
+            slot = MetricSlot()
+
+        bounds = sorted(bounds)[:MAX_BOUNDS]
+        slot.name = name.encode('utf8')[:NAME_LEN - 1]
+        slot.unit = unit.encode('utf8')[:UNIT_LEN - 1]
+        slot.kind = kind
+        slot.nbounds = len(bounds)
+        slot.bounds[:len(bounds)] = bounds
+        if mf.nmetrics < MAX_METRICS:
+            mf.nmetrics += 1
+
+        m = self.metrics[name] = cls(slot)
+        return m
+
+    def counter(self, name, unit=''):
+        return self._get(Counter, KIND_COUNTER, name, unit)
+
+    def gauge(self, name, unit=''):
+        return self._get(Gauge, KIND_GAUGE, name, unit)
+
+    def histogram(self, name, bounds=MS_BOUNDS, unit='ms'):
+        return self._get(Histogram, KIND_HISTOGRAM, name, unit, bounds)
+
+####################################################################################
+# Reading
+
+def process_name(path):
+    return os.path.basename(path)[len(os.path.basename(PATH_FORMAT % '')):]
+
+def find_processes(names=None):
+    '''Returns {process name: path} for every metrics file, or only those in names.'''
+    rv = {}
+    for path in sorted(glob.glob(PATH_FORMAT % '*')):
+        name = process_name(path)
+        if not names or name in names:
+            rv[name] = path
+    return rv
+
+def snapshot(mf):
+    '''Copy a metrics file. Returns (pid, start_time, {name: MetricSlot}).'''
+    slots = {}
+    for i in range(min(mf.nmetrics, MAX_METRICS)):
+        slot = MetricSlot.from_buffer_copy(mf.slots[i])
+        slots[slot.name.decode('utf8', 'replace')] = slot
+    return mf.pid, mf.start_time, slots
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def format_amount(val, unit):
+    if unit == 'B':
+        for div, sfx in ((1e9, 'GB'), (1e6, 'MB'), (1e3, 'kB')):
+            if abs(val) >= div:
+                return '%.2f %s' % (val / div, sfx)
+        return '%d B' % val
+    if val == int(val) and abs(val) < 1e15:
+        txt = '%d' % val
+    else:
+        txt = '%.4g' % val
+    return '%s %s' % (txt, unit) if unit else txt
+
+def format_uptime(secs):
+    secs = int(secs)
+    if secs >= 86400:
+        return '%dd%02dh' % (secs // 86400, secs % 86400 // 3600)
+    return '%dh%02dm%02ds' % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+def percentile(slot, buckets, count, pct):
+    '''Upper bound of the bucket holding the pct'th percentile of count observations
+    spread over buckets.'''
+    want = count * pct / 100
+    seen = 0
+    for i in range(slot.nbounds):
+        seen += buckets[i]
+        if seen >= want:
+            return '%.4g' % slot.bounds[i]
+    return '>%.4g' % slot.bounds[slot.nbounds - 1] if slot.nbounds else '?'
+
+def format_metric(slot, old, interval):
+    '''One line describing slot, with rates since old (the same slot interval
+    seconds ago, or None).'''
+    name = slot.name.decode('utf8', 'replace')
+    unit = slot.unit.decode('utf8', 'replace')
+
+    if slot.kind == KIND_GAUGE:
+        return '  %-28s %16s' % (name, format_amount(slot.value, unit))
+
+    if slot.kind == KIND_COUNTER:
+        delta = slot.value - (old.value if old is not None else 0)
+        if delta < 0:
+            # Totals published with set() start over when their source is recreated
+            delta = slot.value
+        return '  %-28s %16s %16s/s' % (name, format_amount(slot.value, unit), format_amount(delta / interval, unit))
+
+    # Histogram: describe only what happened during the interval if anything did
+    buckets = list(slot.buckets[:slot.nbounds + 1])
+    count = slot.count
+    total = slot.value
+    if old is not None and slot.count > old.count:
+        buckets = [a - b for a, b in zip(buckets, old.buckets)]
+        count -= old.count
+        total -= old.value
+    if not count:
+        return '  %-28s %16s' % (name, 'n=0')
+
+    return '  %-28s %16s %14.1f/s  mean %.4g  p50 %s  p90 %s  p99 %s %s' % (
+        name, 'n=%d' % slot.count, (slot.count - (old.count if old is not None else 0)) / interval,
+        total / count, percentile(slot, buckets, count, 50), percentile(slot, buckets, count, 90),
+        percentile(slot, buckets, count, 99), unit)
+
+def show(files, before, after, interval):
+    for name, mf in files.items():
+        pid, start_time, slots = after[name]
+        opid, ostart, oslots = before[name]
+        if opid != pid or ostart != start_time:
+            # Restarted during the interval; rates are since it started
+            oslots = {}
+
+        state = 'up %s' % format_uptime(time.time() - start_time) if pid_alive(pid) else 'not running'
+        print('%s (pid %d, %s)' % (name, pid, state))
+        for mname, slot in slots.items():
+            print(format_metric(slot, oslots.get(mname), interval))
+        print()
+
+def main():
+    p = argparse.ArgumentParser(description='Show metrics published by the car monitor daemons')
+    p.add_argument('process', nargs='*', help='only show these processes')
+    p.add_argument('-i', '--interval', type=float, default=1, help='seconds to measure rates over')
+    p.add_argument('-w', '--watch', action='store_true', help='keep printing every interval')
+    args = p.parse_args()
+
+    paths = find_processes(args.process)
+    if not paths:
+        print('no metrics found')
+        sys.exit(1)
+
+    files = {name: MetricsFile.create(path) for name, path in paths.items()}
+    before = {name: snapshot(mf) for name, mf in files.items()}
+    try:
+        while True:
+            st = time.monotonic()
+            time.sleep(args.interval)
+            after = {name: snapshot(mf) for name, mf in files.items()}
+            show(files, before, after, time.monotonic() - st)
+            if not args.watch:
+                break
+            before = after
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
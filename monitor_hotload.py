@@ -27,6 +27,7 @@ from os.path import dirname, basename, join, exists
 from binascii import b2a_hex
 
 from cardata_shmem import ShareableStructure, CarData
+from cardata_history import CarDataHistory
 
 from utils import crc16, getmtime, setup_gpio, set_gpio, get_iface_address, CONFIG, load_config, HMACHelper
 from utils import setup_pwm, set_pwm_enable, set_pwm_freq
@@ -370,6 +371,7 @@ def init(self):
     self.cardata = CarData.create('/dev/shm/cardata')
     self.cardata.fw_millis = 0
     self.last_cardata.fw_millis = 0
+    self.cardata_history = CarDataHistory.create()
 
     self.widget_config = wc = WidgetConfig.from_mmap('/dev/shm/hud')
     self.cur_button_mode = 'default'
@@ -417,6 +419,10 @@ def init(self):
     self.iq_data_time = 0
     self.info_hmac = HMACHelper(CONFIG['info_hmac'])
 
+    self.m_resyncs = self.metrics.counter('resyncs')
+    self.m_text_cache_hits = self.metrics.counter('text_cache_hits')
+    self.m_text_cache_misses = self.metrics.counter('text_cache_misses')
+
     self.next_info_packet = 0
 
     self.delay_query_queue = deque()
@@ -455,6 +461,7 @@ def init(self):
     field_def(self, 'last_diag_light_send', 0)
 
     field_def(self, 'last_temp_log_time', 0)
+    field_def(self, 'last_cache_log_time', 0)
 
     field_def(self, 'is_charged', False)
 
@@ -1591,6 +1598,43 @@ def tick(self):
         self.panic_kill_timer = 0
 
     self.wjt_clock.update()
+    for w in self.cardata_widgets:
+        w.flush_pending(cmontime, self)
+    self.widget_config.notify()
+
+    publish_text_cache_stats(self)
+    if cmontime > self.last_cache_log_time + 300:
+        self.last_cache_log_time = cmontime
+        log_text_cache_stats(self)
+
+def flush_widgets(self):
+    '''Show the widget values held back by max_rate that are due. Called from the
+    poll loop once self.flush_deadline passes, so a held value isn't left waiting
+    for the next tick.'''
+    ctime = getmtime()
+    for w in self.cardata_widgets:
+        w.flush_pending(ctime, self)
+    self.widget_config.notify()
+
+def publish_text_cache_stats(self):
+    '''Publish the text cache totals of all widgets as metrics. They restart from
+    zero when the widgets are recreated.'''
+    hits = misses = 0
+    for w in self.cardata_widgets:
+        hits += w.cache_hits
+        misses += w.cache_misses
+    self.m_text_cache_hits.set(hits)
+    self.m_text_cache_misses.set(misses)
+
+def log_text_cache_stats(self):
+    '''Print the hit rate of each widget's text cache.'''
+    stats = []
+    for w in self.cardata_widgets:
+        total = w.cache_hits + w.cache_misses
+        if total:
+            stats.append('%s %.0f%% of %d' % (type(w).__name__, 100 * w.cache_hits / total, total))
+    if stats:
+        print('text cache: ' + ', '.join(stats))
 
 def check_delay_queue(self):
     if self.delay_query_queue:
@@ -2318,6 +2362,8 @@ def gpio_event(self, evt):
                     self.beeper.beepm(f[1])
                 f[0](self)
 
+    self.widget_config.notify()
+
 # Button / rotor handling
 ####################################################################################
 
@@ -2537,38 +2583,53 @@ def handle_data_frame(self, fw_millis, bs):
         cfw += 0x40000000
 
     self.cur_fw_millis = cfw = (cfw & ~0x3FFFFFFF) | fw_millis
-    cd.fw_millis = cfw
 
     check_overlay(self)
 
+    trace = self.latency_trace.enabled
     st = getmtime()
 
+    # Everything written to the shared CarData for this frame goes between
+    # begin_write / end_write so other processes never see a torn frame.
+    # An exception in here must still end the write, or readers wait forever.
+    cd.begin_write()
+    try:
+        cd.fw_millis = cfw
 
-    #self.expect_seq = seq = parse_cardata(bs, cd, lcd, self.expect_seq)
-    self.expect_seq = seq = bs.parse_cardata(cd, lcd, self.expect_seq)
+        #self.expect_seq = seq = parse_cardata(bs, cd, lcd, self.expect_seq)
+        self.expect_seq = seq = bs.parse_cardata(cd, lcd, self.expect_seq)
+
+        if seq != -1:
+            et = getmtime()
+
+            if cd.gear == 0 and cd.clutch_state != 0:
+                self.gear_mismatch_count += 1
+                if self.gear_mismatch_count >= 30:
+                    if et >= self.last_swcan_warn + 10:
+                        self.last_swcan_warn = et
+                        self.beeper.beepm([COL_FREQ[5], 150, COL_FREQ[3], 150, COL_FREQ[1], 150])
+            else:
+                self.gear_mismatch_count = 0
+
+            update_motion_state(self, (fw_millis - lcd.fw_millis) & 0x3FFFFFFF, cd.gear, cd.rawspeed)
+
+            cd.motion_state = self.motion_state
+    finally:
+        cd.end_write()
 
     if seq == -1:
+        self.m_resyncs.inc()
         sendq(self, 'F')
         print('out of sequence!')
         return
 
-    et = getmtime()
-
-    if cd.gear == 0 and cd.clutch_state != 0:
-        self.gear_mismatch_count += 1
-        if self.gear_mismatch_count >= 30:
-            if et >= self.last_swcan_warn + 10:
-                self.last_swcan_warn = et
-                self.beeper.beepm([COL_FREQ[5], 150, COL_FREQ[3], 150, COL_FREQ[1], 150])
-    else:
-        self.gear_mismatch_count = 0
-
-    update_motion_state(self, (fw_millis - lcd.fw_millis) & 0x3FFFFFFF, cd.gear, cd.rawspeed)
-
-    cd.motion_state = self.motion_state
+    self.cardata_history.append(cd, bs.stxtime)
 
+    log_time = None
     if self.logger:
         self.logger.log_data_frame(bs.stxtime, fw_millis, cd, lcd)
+        if trace:
+            log_time = getmtime()
 
     fsdelta = (cd.select_fanspeed & 0xF) - (lcd.select_fanspeed & 0xF)
     tempdelta = TemperatureTarget.convert(cd.select_temp) - TemperatureTarget.convert(lcd.select_temp)
@@ -2640,6 +2701,19 @@ def handle_data_frame(self, fw_millis, bs):
             w.check(cd, self)
             fp.write('%-30s = %s\n' % (type(w).__name__, w.textbuf.value.decode('utf8')))
 
+    self.widget_config.notify()
+
+    if trace:
+        record_frame_latency(self, bs, et, log_time)
+
+def record_frame_latency(self, bs, parse_time, log_time):
+    '''Record how long each stage of handling this frame took since its STX, and tell
+    hud.c which frame to report the blit time for.'''
+    hdr = self.widget_config.hdr
+    hdr.trace_stxtime = bs.stxtime
+    self.latency_trace.record_frame(bs.stxtime, self.frame_crc_time, parse_time, log_time, getmtime())
+    self.latency_trace.check_blit(hdr)
+
 # CarData frame handling
 ####################################################################################
 
@@ -2934,12 +3008,32 @@ def msg_gps(self, msgtype, msgtext):
     except (ValueError, TypeError, IndexError):
         return
 
+@msg('P')
+def start_profiler(self, msgtype, msgtxt):
+    '''mP<seconds>[,cpu] samples the main thread's stack for that long and writes a
+    flame graph profile to profiles/. mP0 stops early.'''
+    secs, sep, clock = msgtxt.partition(',')
+    try:
+        secs = float(secs or 10)
+    except ValueError:
+        return
+
+    if secs <= 0:
+        self.profiler.stop()
+        return
+
+    try:
+        self.profiler.start(secs, clock=clock or 'real')
+    except KeyError:
+        print('unknown profiler clock %r' % clock)
+
 def parse_message(self, msgtype, msgtxt):
     '''Called by serial_monitor when a message is received from phone, or from parse_frame when FT_PTMSG is received'''
     #self.log('msg: %s %r' % (msgtype, msgtxt))
     handler = message_handlers.get(msgtype)
     if handler:
         handler(self, msgtype, msgtxt)
+        self.widget_config.notify()
 
 # Message handling
 ####################################################################################
@@ -3058,6 +3152,22 @@ class BaseWidget(Widget):
     bg = 0
     update_from_data = False
 
+    # Maximum displayed updates per second, or None for no limit. Values arriving
+    # faster than this are coalesced, and the latest one is shown once the interval
+    # is up.
+    max_rate = None
+    next_update = 0
+    pending = False
+    pending_rawval = None
+
+    # Number of raw values to remember the rendered text and colours for, or 0 to
+    # always call update_rawval. Only set this if update_rawval's output depends on
+    # nothing but rv.
+    text_cache_size = 0
+    text_cache = None
+    cache_hits = 0
+    cache_misses = 0
+
     visgroup = VFLAG_VEHICLE_ON | VFLAG_DISPLAY_ON
     vismask = VFLAG_VEHICLE_ON | VFLAG_DISPLAY_ON
 
@@ -3074,10 +3184,63 @@ class BaseWidget(Widget):
 
     def check(self, cd, mon):
         rv = self.get_rawval(cd, mon)
-        if rv != self.last_rawval:
-            self.last_rawval = rv
+        if rv == self.last_rawval:
+            self.pending = False
+            return
+
+        if self.max_rate:
+            ctime = getmtime()
+            if ctime < self.next_update:
+                self.pending = True
+                self.pending_rawval = rv
+                self.schedule_flush(mon)
+                return
+            self.next_update = ctime + 1 / self.max_rate
+
+        self.show_rawval(rv)
+
+    def schedule_flush(self, mon):
+        '''Have the poll loop call flush_widgets when the held value is due.'''
+        if not mon.flush_deadline or self.next_update < mon.flush_deadline:
+            mon.flush_deadline = self.next_update
+
+    def flush_pending(self, ctime, mon):
+        '''Show a value held back by max_rate if its interval has expired.'''
+        if not self.pending:
+            return
+        if ctime >= self.next_update:
+            self.next_update = ctime + 1 / self.max_rate
+            self.show_rawval(self.pending_rawval)
+        else:
+            self.schedule_flush(mon)
+
+    def show_rawval(self, rv):
+        self.pending = False
+        self.last_rawval = rv
+        if self.text_cache_size:
+            self.cached_update_rawval(rv)
+        else:
             self.update_rawval(rv)
-            self.bump_version()
+        self.bump_version()
+
+    def cached_update_rawval(self, rv):
+        cache = self.text_cache
+        if cache is None:
+            cache = self.text_cache = OrderedDict()
+
+        ent = cache.get(rv)
+        if ent is not None:
+            cache.move_to_end(rv)
+            self.cache_hits += 1
+            text, self.cfg, self.cbg, self.cstrike = ent
+            self.set_raw_text(text)
+            return
+
+        self.cache_misses += 1
+        self.update_rawval(rv)
+        cache[rv] = self.textbuf.value, self.cfg, self.cbg, self.cstrike
+        if len(cache) > self.text_cache_size:
+            cache.popitem(last=False)
 
 
 @wjt
@@ -3091,6 +3254,8 @@ class SpeedWidget(BaseWidget):
     xscale = .7
     nchar = 2
     update_from_data = True
+    max_rate = 10
+    text_cache_size = 256
 
     fmt = '%02d'
 
@@ -3119,6 +3284,7 @@ class CCSpeedWidget(BaseWidget):
 
     field = 'rawccspeed'
     update_from_data = True
+    text_cache_size = 256
 
     xpos = ON_RIGHT, 'SpeedWidget'
     ypos = AT_TOP, 'SpeedWidget'
@@ -3171,6 +3337,7 @@ class RangeWidget(RangeWidgetBase):
 
     field = 'range'
     update_from_data = True
+    max_rate = 4
 
     xpos = AT_LEFT, 'prev'
     ypos = ON_BOTTOM, 'prev', 5
@@ -3384,6 +3551,8 @@ class BattPctWidget(BaseWidget):
     nchar = 5
     field = 'battery_soc'
     update_from_data = True
+    max_rate = 4
+    text_cache_size = 64
 
     visgroup = VFLAG_DISPLAY_ON
     vismask = VFLAG_DISPLAY_ON
@@ -3391,19 +3560,15 @@ class BattPctWidget(BaseWidget):
     xpos = CENTER_OF, 'SpeedWidget'
     ypos = ON_BOTTOM, 'SpeedWidget', 45
 
+    # The (text, colour) shown, so the text cache sees repeats
     def get_rawval(self, cd, mon):
-        return cd.battery_soc, cd.battery_raw_soc, cd.range
+        if cd.battery_soc == 0 or cd.range == 0:
+            return '%.1f' % (cd.battery_raw_soc / 2.55), 0xff1111
+        return '%.1f' % (cd.battery_soc / 2.55), 0xffffff
 
     def update_rawval(self, rv):
-        soc, raw, range = rv
-        if soc == 0 or range == 0:
-            battpct = raw / 2.55
-            self.cfg = 0xff1111
-        else:
-            battpct = soc / 2.55
-            self.cfg = 0xffffff
-
-        self.set_text('%.1f' % (battpct))
+        text, self.cfg = rv
+        self.set_text(text)
 
 @wjt
 class RPMWidget(BaseWidget):
@@ -3415,6 +3580,7 @@ class RPMWidget(BaseWidget):
     field = 'rpm'
     flags = FLAG_ALIGN_RIGHT
     update_from_data = True
+    max_rate = 10
 
     xpos = AT_RIGHT, 'SpeedWidget'
     ypos = ON_BOTTOM, 'SpeedWidget'
@@ -3444,6 +3610,13 @@ class RPMWidget(BaseWidget):
             self.cfg = 0
 
 
+def power_text(power, conv):
+    '''The (text, colour) the power widgets show for power / conv kW.'''
+    if power == 0:
+        return '0.0', 0xFFFFFF
+    kw = power / conv
+    return '%+.1f' % kw, 0xFFFFFF if kw == 0 else (0x44FF44 if kw >= 0 else 0xFFFF44)
+
 @wjt
 class HVKWWidget(BaseWidget):
     w = 180
@@ -3455,21 +3628,19 @@ class HVKWWidget(BaseWidget):
     flags = FLAG_ALIGN_RIGHT
     nchar = 5
     update_from_data = True
+    max_rate = 10
+    text_cache_size = 128
 
     xpos = ON_LEFT, 'SpeedWidget'
     ypos = AT_TOP, 'SpeedWidget'
 
+    # The (text, colour) shown, so the text cache sees repeats
     def get_rawval(self, cd, mon):
-        return cd.hv_amps * cd.hv_volts
+        return power_text(cd.hv_amps * cd.hv_volts, HVKW_CONV)
 
     def update_rawval(self, rv):
-        if rv == 0:
-            self.set_text('0.0')
-            self.cfg = 0xFFFFFF
-        else:
-            hv_kw = rv / HVKW_CONV
-            self.set_text('%+.1f' % hv_kw)
-            self.cfg = 0xFFFFFF if hv_kw == 0 else (0x44FF44 if hv_kw >= 0 else 0xFFFF44)
+        text, self.cfg = rv
+        self.set_text(text)
 
 @wjt
 class MGBPwrWidget(BaseWidget):
@@ -3482,26 +3653,24 @@ class MGBPwrWidget(BaseWidget):
     flags = FLAG_ALIGN_RIGHT
     nchar = 5
     update_from_data = True
+    max_rate = 10
+    text_cache_size = 128
 
     ypos = ON_BOTTOM, 'HVKWWidget'
     xpos = AT_LEFT, 'HVKWWidget'
 
     def get_rawval(self, cd, mon):
-        return cd.mgb_amps * cd.mgb_volts
+        return power_text(cd.mgb_amps * cd.mgb_volts, MOTOR_KW_CONV)
 
     def update_rawval(self, rv):
-        if rv == 0:
-            self.set_text('0.0')
-            self.cfg = 0xFFFFFF
-        else:
-            hv_kw = rv / MOTOR_KW_CONV
-            self.set_text('%+.1f' % hv_kw)
-            self.cfg = 0xFFFFFF if hv_kw == 0 else (0x44FF44 if hv_kw >= 0 else 0xFFFF44)
+        text, self.cfg = rv
+        self.set_text(text)
 
 @wjt
 class MGBSpeedWidget(MGBPwrWidget):
     ypos = ON_BOTTOM, 'prev'
     xpos = AT_LEFT, 'prev'
+    max_rate = None
     def get_rawval(self, cd, mon):
         return cd.mgb_rpm
 
@@ -3516,8 +3685,9 @@ class MGBSpeedWidget(MGBPwrWidget):
 @wjt
 class MGAPwrWidget(MGBPwrWidget):
     xpos = AT_RIGHT, 'HVKWWidget'
+    max_rate = 10
     def get_rawval(self, cd, mon):
-        return cd.mga_amps * cd.mga_volts
+        return power_text(cd.mga_amps * cd.mga_volts, MOTOR_KW_CONV)
 
 @wjt
 class MGASpeedWidget(MGBSpeedWidget):
@@ -4079,6 +4249,7 @@ class TempWidgetBase(BaseWidget):
     flags = FLAG_ALIGN_RIGHT
 
     update_from_data = True
+    text_cache_size = 256
 
     bias = 40
     factor = 1
@@ -4397,16 +4568,20 @@ def setup_menu():
 setup_menu()
 
 def debug_widget_config():
-    from PIL import Image, ImageDraw
+    '''Render the default layout to widget_config.png, without hud.c or a framebuffer.'''
+    from hud_render import HudRenderer
     buf = bytearray(32768)
     wc = WidgetConfig(buf)
     wc.build(all_widgets, 800, 480)
-    im = Image.new('RGB', (800, 480))
-    ctx = ImageDraw.Draw(im)
-
+    wc.set_visgroup(VFLAG_VEHICLE_ON | VFLAG_DISPLAY_ON, VFLAG_VEHICLE_ON | VFLAG_DISPLAY_ON)
     for w in wc.widgets:
-        if not w.visgroup & (VFLAG_TEXT_ENTRY|VFLAG_OVERLAY):
-            pass
+        if w.nchar and not w.textbuf.value:
+            w.set_text('8' * w.nchar)
+            w.bump_version()
+
+    rend = HudRenderer(buf, 800, 480)
+    rend.render()
+    rend.image.save('widget_config.png')
 
 if __name__ == '__main__':
     debug_widget_config()
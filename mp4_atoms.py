@@ -0,0 +1,109 @@
+'''Reading the atoms ("boxes") that MP4 and QuickTime files are made of.
+
+An atom is a 32-bit big-endian size, a four-character type and its contents; the
+size includes the header. A size of 1 means a 64-bit size follows the type. The
+atoms in recursive_atoms contain nothing but other atoms.
+'''
+import os
+import struct
+
+# How much ProbeFile reads at a time. The first read usually holds ftyp, moov and
+# mvhd; a moov after mdat takes one more.
+PROBE_READ_SIZE = 16 * 1024
+
+uint64 = struct.Struct('>Q')
+uint32 = struct.Struct('>I')
+
+def get_atom_info(eight_bytes):
+    try:
+        atom_size, atom_type = struct.unpack('>I4s', eight_bytes)
+    except struct.error:
+        return 0, ''
+    return int(atom_size), atom_type.decode('latin1')
+
+recursive_atoms = "moov", "trak", "mdia", "minf", "stbl", "dinf"
+
+def find_atom(fp, startpos, atype):
+    while True:
+        try:
+            fp.seek(startpos)
+            atom_size, atom_type = get_atom_info(fp.read(8))
+            if atom_size == 1:
+                # 64-bit size follows the type, e.g. for an mdat over 4 GB
+                atom_size = uint64.unpack(fp.read(8))[0]
+        except (OSError, struct.error):
+            return None, None
+
+        if atom_size < 8:
+            return None, None
+
+        if atom_type == atype:
+            return startpos, atom_size
+
+        startpos += atom_size
+
+class ProbeFile:
+    '''Read-only file for walking atoms. Reads are served from one cached window
+    of PROBE_READ_SIZE bytes, so the seek and 8-byte read per atom that find_atom
+    does only reaches the disk when it jumps past the window, e.g. over mdat.'''
+    def __init__(self, path, bufsize=PROBE_READ_SIZE):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.bufsize = bufsize
+        self.pos = 0
+        self.buf = b''
+        self.bufpos = 0
+        self.reads = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, n):
+        ofs = self.pos - self.bufpos
+        if ofs < 0 or ofs + n > len(self.buf):
+            self.buf = os.pread(self.fd, max(n, self.bufsize), self.pos)
+            self.bufpos = self.pos
+            self.reads += 1
+            ofs = 0
+        self.pos += n
+        return self.buf[ofs:ofs + n]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+def decode_mvhd(fp):
+    moov_pos, moov_size = find_atom(fp, 0, 'moov')
+    if moov_pos is None:
+        raise ValueError('MOOV not found')
+
+    mvhd_pos, mvhd_size = find_atom(fp, moov_pos + 8, 'mvhd')
+    if mvhd_pos is None:
+        raise ValueError('MVHD not found')
+
+    mvhd = fp.read(mvhd_size - 8)
+    if len(mvhd) < 20:
+        raise ValueError('MVHD invalid')
+
+    vers = mvhd[0]
+    if vers == 1:
+        ctime = uint64.unpack_from(mvhd, 4)[0]
+        mtime = uint64.unpack_from(mvhd, 12)[0]
+        timescale = uint32.unpack_from(mvhd, 20)[0]
+        duration = uint64.unpack_from(mvhd, 24)[0]
+    else:
+        ctime = uint32.unpack_from(mvhd, 4)[0]
+        mtime = uint32.unpack_from(mvhd, 8)[0]
+        timescale = uint32.unpack_from(mvhd, 12)[0]
+        duration = uint32.unpack_from(mvhd, 16)[0]
+
+    if ctime > 2082844800:
+        ctime -= 2082844800
+    duration = duration / timescale
+    return ctime, duration
@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+'''Cuts a time window out of an MP4 or QuickTime clip without re-encoding.
+
+The sample tables in each track's stbl say where every sample (a video frame or
+a block of audio) is in the file, how big it is, how long it lasts and which
+video frames are keyframes. The window is widened back to the keyframe before
+it, and the samples inside it are copied into a new file with moov rebuilt to
+describe only them:
+
+    mp4_excerpt.py clip.mov excerpt.mov --at 95 --window 30
+
+The result is a normal self-contained file, with moov ahead of mdat so it plays
+while still downloading.
+'''
+import os
+import struct
+import bisect
+import argparse
+
+from mp4_atoms import find_atom, recursive_atoms, get_atom_info
+
+# Samples are interleaved between tracks in chunks of about this many seconds
+CHUNK_SECONDS = 0.5
+
+# Largest single read when copying sample data
+COPY_SIZE = 1024 * 1024
+
+
+class Atom:
+    '''An atom from moov: its children if it is one of recursive_atoms, otherwise
+    its contents.'''
+    def __init__(self, atype, data=b'', children=None):
+        self.type = atype
+        self.data = data
+        self.children = children
+
+    def find(self, atype):
+        for child in self.children:
+            if child.type == atype:
+                return child
+        return None
+
+    def encode(self):
+        body = b''.join(c.encode() for c in self.children) if self.children is not None else self.data
+        if len(body) + 8 > 0xFFFFFFFF:
+            return struct.pack('>I4sQ', 1, self.type.encode('latin1'), len(body) + 16) + body
+        return struct.pack('>I4s', len(body) + 8, self.type.encode('latin1')) + body
+
+def parse_atoms(data):
+    atoms = []
+    pos = 0
+    while pos + 8 <= len(data):
+        size, atype = get_atom_info(data[pos:pos + 8])
+        hdr = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            hdr = 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < hdr or pos + size > len(data):
+            raise ValueError('bad %r atom at %d' % (atype, pos))
+
+        body = data[pos + hdr:pos + size]
+        if atype in recursive_atoms:
+            atoms.append(Atom(atype, children=parse_atoms(body)))
+        else:
+            atoms.append(Atom(atype, body))
+        pos += size
+    return atoms
+
+def full_atom(atype, version, body, flags=0):
+    return Atom(atype, struct.pack('>I', (version << 24) | flags) + body)
+
+def read_top_atom(fp, atype):
+    '''Contents of the top-level atom atype, or None.'''
+    pos, size = find_atom(fp, 0, atype)
+    if pos is None:
+        return None
+    fp.seek(pos)
+    hdr = fp.read(16)
+    if get_atom_info(hdr[:8])[0] == 1:
+        fp.seek(pos + 16)
+        return fp.read(size - 16)
+    fp.seek(pos + 8)
+    return fp.read(size - 8)
+
+class Track:
+    '''One trak from moov, with a list per sample of its offset in the file, size,
+    duration, composition offset, sample description and whether it is a
+    keyframe.'''
+    def __init__(self, trak):
+        self.trak = trak
+        mdia = trak.find('mdia')
+        self.mdhd = mdia.find('mdhd').data
+        self.handler = mdia.find('hdlr').data[8:12].decode('latin1')
+        if self.mdhd[0] == 1:
+            self.timescale = struct.unpack_from('>I', self.mdhd, 20)[0]
+        else:
+            self.timescale = struct.unpack_from('>I', self.mdhd, 12)[0]
+
+        self.stbl = stbl = mdia.find('minf').find('stbl')
+        tables = {a.type: a.data for a in stbl.children}
+        if 'stz2' in tables:
+            raise ValueError('stz2 sample sizes are not supported')
+
+        # Sizes
+        fixed_size, count = struct.unpack_from('>II', tables['stsz'], 4)
+        if fixed_size:
+            self.sizes = [fixed_size] * count
+        else:
+            self.sizes = list(struct.unpack_from('>%dI' % count, tables['stsz'], 12))
+
+        # Durations
+        self.deltas = []
+        for n, delta in self.entries(tables['stts'], 'II'):
+            self.deltas.extend([delta] * n)
+        del self.deltas[count:]
+        self.deltas.extend([self.deltas[-1] if self.deltas else 0] * (count - len(self.deltas)))
+        self.dts = []
+        t = 0
+        for delta in self.deltas:
+            self.dts.append(t)
+            t += delta
+        self.duration = t
+
+        # Composition offsets, only where frames are reordered
+        self.ctts_version = 0
+        self.cts = None
+        if 'ctts' in tables:
+            self.ctts_version = tables['ctts'][0]
+            self.cts = []
+            for n, ofs in self.entries(tables['ctts'], 'Ii' if self.ctts_version else 'II'):
+                self.cts.extend([ofs] * n)
+            self.cts.extend([0] * (count - len(self.cts)))
+
+        # Keyframes; without stss every sample is one
+        if 'stss' in tables:
+            self.keyframes = sorted(n - 1 for n, in self.entries(tables['stss'], 'I'))
+        else:
+            self.keyframes = None
+
+        self.sdtp = tables['sdtp'][4:4 + count] if 'sdtp' in tables else None
+
+        # Offsets, from the chunk offsets and how many samples are in each chunk
+        if 'co64' in tables:
+            chunks = [ofs for ofs, in self.entries(tables['co64'], 'Q')]
+        else:
+            chunks = [ofs for ofs, in self.entries(tables['stco'], 'I')]
+        stsc = list(self.entries(tables['stsc'], 'III'))
+
+        self.offsets = []
+        self.descs = []
+        sample = 0
+        for i, (first, per_chunk, desc) in enumerate(stsc):
+            last = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunks)
+            for chunk in range(first - 1, last):
+                ofs = chunks[chunk]
+                for j in range(per_chunk):
+                    if sample >= count:
+                        break
+                    self.offsets.append(ofs)
+                    self.descs.append(desc)
+                    ofs += self.sizes[sample]
+                    sample += 1
+        if sample != count:
+            raise ValueError('%s track: chunks hold %d of %d samples' % (self.handler, sample, count))
+
+    @staticmethod
+    def entries(data, fmt):
+        '''Entries of a full atom that is a count followed by a table.'''
+        st = struct.Struct('>' + fmt)
+        count = struct.unpack_from('>I', data, 4)[0]
+        for i in range(count):
+            yield st.unpack_from(data, 8 + i * st.size)
+
+    def keyframe_before(self, t):
+        '''Index of the last keyframe at or before time t (in this track's timescale).'''
+        idx = max(0, bisect.bisect_right(self.dts, t) - 1)
+        if self.keyframes is None:
+            return idx
+        i = bisect.bisect_right(self.keyframes, idx) - 1
+        return self.keyframes[max(0, i)]
+
+    def sample_at(self, t):
+        '''Index of the first sample at or after time t.'''
+        return bisect.bisect_left(self.dts, t)
+
+def run_length(values):
+    rv = []
+    for v in values:
+        if rv and rv[-1][1] == v:
+            rv[-1][0] += 1
+        else:
+            rv.append([1, v])
+    return rv
+
+def table(atype, fmt, rows, version=0):
+    st = struct.Struct('>' + fmt)
+    return full_atom(atype, version, struct.pack('>I', len(rows)) + b''.join(st.pack(*row) for row in rows))
+
+class Excerpt:
+    '''The samples of each track between two times, and where they will go in the
+    new file.'''
+    def __init__(self, moov, start, end):
+        self.moov = moov
+        self.mvhd = moov.find('mvhd').data
+        self.tracks = []
+        for trak in moov.children:
+            if trak.type == 'trak':
+                self.tracks.append(Track(trak))
+        if not self.tracks:
+            raise ValueError('no tracks')
+
+        # Keyframes in the video track decide where the excerpt can start
+        ref = next((t for t in self.tracks if t.handler == 'vide'), self.tracks[0])
+        if start * ref.timescale >= ref.duration:
+            raise ValueError('clip is only %.3f s long' % (ref.duration / ref.timescale))
+        first = ref.keyframe_before(start * ref.timescale)
+        last = ref.sample_at(end * ref.timescale)
+        if last <= first:
+            raise ValueError('nothing between %g and %g s' % (start, end))
+        self.start = ref.dts[first] / ref.timescale
+        self.end = (ref.dts[last] if last < len(ref.dts) else ref.duration) / ref.timescale
+
+        self.ranges = {}
+        for track in self.tracks:
+            if track is ref:
+                self.ranges[id(track)] = first, last
+            else:
+                self.ranges[id(track)] = (track.sample_at(self.start * track.timescale),
+                                          track.sample_at(self.end * track.timescale))
+        self.tracks = [t for t in self.tracks if self.ranges[id(t)][0] < self.ranges[id(t)][1]]
+
+    def layout(self):
+        '''Interleave the samples into chunks. Returns [(track, [sample index])].'''
+        slots = []
+        for ti, track in enumerate(self.tracks):
+            a, b = self.ranges[id(track)]
+            base = track.dts[a]
+            for idx in range(a, b):
+                t = (track.dts[idx] - base) / track.timescale
+                slots.append((int(t / CHUNK_SECONDS), ti, idx))
+        slots.sort()
+
+        chunks = []
+        for slot, ti, idx in slots:
+            if chunks and chunks[-1][0] == (slot, ti):
+                chunks[-1][1].append(idx)
+            else:
+                chunks.append(((slot, ti), [idx]))
+        return [(self.tracks[ti], samples) for (slot, ti), samples in chunks]
+
+    def build_moov(self, chunks, data_offset):
+        '''The new moov, with sample data starting at data_offset in the file.'''
+        offsets = {id(t): [] for t in self.tracks}
+        samples_per_chunk = {id(t): [] for t in self.tracks}
+        pos = data_offset
+        for track, samples in chunks:
+            offsets[id(track)].append(pos)
+            samples_per_chunk[id(track)].append(samples)
+            pos += sum(track.sizes[i] for i in samples)
+        use_co64 = pos > 0xFFFFFFFF
+
+        movie_scale = self.movie_timescale()
+        children = []
+        durations = []
+        for atom in self.moov.children:
+            if atom.type == 'mvhd':
+                continue
+            if atom.type != 'trak':
+                children.append(atom)
+                continue
+            track = next((t for t in self.tracks if t.trak is atom), None)
+            if track is None:
+                continue
+            trak, duration = self.build_trak(track, offsets[id(track)], samples_per_chunk[id(track)], use_co64, movie_scale)
+            children.append(trak)
+            durations.append(duration)
+
+        return Atom('moov', children=[self.build_mvhd(max(durations))] + children)
+
+    def movie_timescale(self):
+        return struct.unpack_from('>I', self.mvhd, 20 if self.mvhd[0] == 1 else 12)[0]
+
+    def build_mvhd(self, duration):
+        # do_copy.py takes the creation time as the end of recording; move it to
+        # the end of the excerpt so the excerpt gets its own begin time
+        mvhd = bytearray(self.mvhd)
+        scale = self.movie_timescale()
+        if mvhd[0] == 1:
+            ctime, mtime, _, old = struct.unpack_from('>QQIQ', mvhd, 4)
+        else:
+            ctime, mtime, _, old = struct.unpack_from('>IIII', mvhd, 4)
+        shift = int(old / scale - self.start - duration / scale)
+        ctime = max(0, ctime - shift)
+        mtime = max(0, mtime - shift)
+        if mvhd[0] == 1:
+            struct.pack_into('>QQIQ', mvhd, 4, ctime, mtime, scale, duration)
+        else:
+            struct.pack_into('>IIII', mvhd, 4, ctime, mtime, scale, duration)
+        return Atom('mvhd', bytes(mvhd))
+
+    def build_trak(self, track, chunk_offsets, chunk_samples, use_co64, movie_scale):
+        a, b = self.ranges[id(track)]
+        media_duration = sum(track.deltas[a:b])
+        duration = media_duration * movie_scale // track.timescale
+
+        children = []
+        for atom in track.trak.children:
+            if atom.type == 'tkhd':
+                tkhd = bytearray(atom.data)
+                if tkhd[0] == 1:
+                    struct.pack_into('>Q', tkhd, 28, duration)
+                else:
+                    struct.pack_into('>I', tkhd, 20, duration)
+                children.append(Atom('tkhd', bytes(tkhd)))
+            elif atom.type == 'edts':
+                # One edit covering the excerpt, skipping the first frame's
+                # composition delay as the original edit list would have
+                media_time = track.cts[a] if track.cts else 0
+                elst = table('elst', 'Iii', [(duration, media_time, 0x10000)])
+                children.append(Atom('edts', elst.encode()))
+            elif atom.type == 'mdia':
+                children.append(self.build_mdia(track, atom, chunk_offsets, chunk_samples, use_co64, media_duration))
+            else:
+                children.append(atom)
+        return Atom('trak', children=children), duration
+
+    def build_mdia(self, track, mdia, chunk_offsets, chunk_samples, use_co64, media_duration):
+        children = []
+        for atom in mdia.children:
+            if atom.type == 'mdhd':
+                mdhd = bytearray(atom.data)
+                if mdhd[0] == 1:
+                    struct.pack_into('>Q', mdhd, 24, media_duration)
+                else:
+                    struct.pack_into('>I', mdhd, 16, media_duration)
+                children.append(Atom('mdhd', bytes(mdhd)))
+            elif atom.type == 'minf':
+                minf = [self.build_stbl(track, chunk_offsets, chunk_samples, use_co64) if c.type == 'stbl' else c
+                        for c in atom.children]
+                children.append(Atom('minf', children=minf))
+            else:
+                children.append(atom)
+        return Atom('mdia', children=children)
+
+    def build_stbl(self, track, chunk_offsets, chunk_samples, use_co64):
+        a, b = self.ranges[id(track)]
+        sizes = track.sizes[a:b]
+
+        # Only the sample descriptions are kept as they are. Anything else in stbl,
+        # such as sample groups, is per sample in a way this doesn't rebuild.
+        children = [c for c in track.stbl.children if c.type == 'stsd']
+        children.append(table('stts', 'II', run_length(track.deltas[a:b])))
+        if track.cts is not None:
+            children.append(table('ctts', 'Ii' if track.ctts_version else 'II',
+                                  run_length(track.cts[a:b]), track.ctts_version))
+        if track.keyframes is not None:
+            lo = bisect.bisect_left(track.keyframes, a)
+            hi = bisect.bisect_left(track.keyframes, b)
+            children.append(table('stss', 'I', [(k - a + 1,) for k in track.keyframes[lo:hi]]))
+
+        if len(set(sizes)) == 1:
+            children.append(full_atom('stsz', 0, struct.pack('>II', sizes[0], len(sizes))))
+        else:
+            children.append(full_atom('stsz', 0, struct.pack('>II%dI' % len(sizes), 0, len(sizes), *sizes)))
+
+        stsc = []
+        for chunk, samples in enumerate(chunk_samples):
+            row = (chunk + 1, len(samples), track.descs[samples[0]])
+            if not stsc or stsc[-1][1:] != row[1:]:
+                stsc.append(row)
+        children.append(table('stsc', 'III', stsc))
+        if use_co64:
+            children.append(table('co64', 'Q', [(ofs,) for ofs in chunk_offsets]))
+        else:
+            children.append(table('stco', 'I', [(ofs,) for ofs in chunk_offsets]))
+
+        if track.sdtp is not None:
+            children.append(full_atom('sdtp', 0, track.sdtp[a:b]))
+
+        return Atom('stbl', children=children)
+
+def write_excerpt(src, dst, start, end):
+    '''Write the part of src from start to end seconds into the clip to dst.
+    Returns the (start, end) actually written, which begins at a keyframe.'''
+    with open(src, 'rb') as fp:
+        moov = read_top_atom(fp, 'moov')
+        if moov is None:
+            raise ValueError('MOOV not found')
+        ftyp = read_top_atom(fp, 'ftyp')
+
+    excerpt = Excerpt(Atom('moov', children=parse_atoms(moov)), start, end)
+    chunks = excerpt.layout()
+    head = Atom('ftyp', ftyp).encode() if ftyp is not None else b''
+
+    # moov doesn't change size with the offsets in it, so build it once to measure
+    total = sum(track.sizes[i] for track, samples in chunks for i in samples)
+    mdat_hdr = struct.pack('>I4s', total + 8, b'mdat') if total + 8 <= 0xFFFFFFFF else None
+    if mdat_hdr is None:
+        mdat_hdr = struct.pack('>I4sQ', 1, b'mdat', total + 16)
+    moov_size = len(excerpt.build_moov(chunks, 0).encode())
+    moov = excerpt.build_moov(chunks, len(head) + moov_size + len(mdat_hdr)).encode()
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        with open(dst, 'wb') as out:
+            out.write(head)
+            out.write(moov)
+            out.write(mdat_hdr)
+
+            # Copy runs of samples that are next to each other in src with one read
+            run_start = run_end = None
+            for track, samples in chunks:
+                for i in samples:
+                    ofs, size = track.offsets[i], track.sizes[i]
+                    if ofs == run_end and run_end - run_start + size <= COPY_SIZE:
+                        run_end += size
+                        continue
+                    if run_start is not None:
+                        out.write(os.pread(src_fd, run_end - run_start, run_start))
+                    run_start, run_end = ofs, ofs + size
+            if run_start is not None:
+                out.write(os.pread(src_fd, run_end - run_start, run_start))
+    finally:
+        os.close(src_fd)
+
+    return excerpt.start, excerpt.end
+
+def show_tracks(path):
+    with open(path, 'rb') as fp:
+        moov = read_top_atom(fp, 'moov')
+    if moov is None:
+        print('%s: MOOV not found' % path)
+        return
+    for trak in Atom('moov', children=parse_atoms(moov)).children:
+        if trak.type == 'trak':
+            t = Track(trak)
+            keys = len(t.keyframes) if t.keyframes is not None else len(t.sizes)
+            print('%s: %d samples, %.3f s, %d keyframes, %d bytes' % (
+                t.handler, len(t.sizes), t.duration / t.timescale, keys, sum(t.sizes)))
+
+def main():
+    p = argparse.ArgumentParser(description='Copy part of an MP4 or QuickTime clip without re-encoding it')
+    p.add_argument('src')
+    p.add_argument('dst', nargs='?')
+    p.add_argument('-s', '--start', type=float, help='seconds into the clip to start')
+    p.add_argument('-e', '--end', type=float, help='seconds into the clip to end')
+    p.add_argument('-a', '--at', type=float, help='seconds into the clip to center the excerpt on')
+    p.add_argument('-w', '--window', type=float, default=30, help='seconds either side of --at (default 30)')
+    args = p.parse_args()
+
+    if args.dst is None:
+        show_tracks(args.src)
+        return
+
+    if args.at is not None:
+        start, end = args.at - args.window, args.at + args.window
+    elif args.start is not None or args.end is not None:
+        start, end = args.start or 0, args.end if args.end is not None else float('inf')
+    else:
+        p.error('give --at or --start / --end')
+
+    start, end = write_excerpt(args.src, args.dst, max(0, start), end)
+    print('%s: %.3f to %.3f s, %d bytes' % (args.dst, start, end, os.path.getsize(args.dst)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+'''Checks that mp4_excerpt.py cuts a window out of a clip and rewrites its sample
+tables to match. The clip is built here: a 10 s video track with a keyframe every
+4 s and an audio track, every sample holding bytes that say which one it is. Runs
+under pytest or as a script.'''
+import struct
+
+import pytest
+
+from mp4_excerpt import Atom, Track, full_atom, table, parse_atoms, read_top_atom, write_excerpt
+
+TIMESCALE = 1000
+CREATION_TIME = 3000000000
+
+# (handler, sample count, sample duration, keyframe indexes or None)
+TRACKS = [
+    ('vide', 10, 1000, [0, 4, 8]),
+    ('soun', 20, 500, None),
+]
+
+def sample_data(handler, idx):
+    return ('%s%03d' % (handler, idx)).encode('latin1') * (idx % 3 + 1)
+
+def make_trak(handler, count, delta, keyframes, offsets):
+    tkhd = full_atom('tkhd', 0, bytes(80))
+    mdhd = full_atom('mdhd', 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, count * delta, 0, 0))
+    hdlr = full_atom('hdlr', 0, b'\0' * 4 + handler.encode('latin1') + b'\0' * 13)
+    sizes = [len(sample_data(handler, i)) for i in range(count)]
+    stbl = [
+        full_atom('stsd', 0, struct.pack('>I', 0)),
+        table('stts', 'II', [(count, delta)]),
+        full_atom('stsz', 0, struct.pack('>II%dI' % count, 0, count, *sizes)),
+        table('stsc', 'III', [(1, 1, 1)]),
+        table('stco', 'I', [(ofs,) for ofs in offsets]),
+    ]
+    if keyframes is not None:
+        stbl.append(table('stss', 'I', [(k + 1,) for k in keyframes]))
+    minf = Atom('minf', children=[Atom('stbl', children=stbl)])
+    return Atom('trak', children=[tkhd, Atom('mdia', children=[mdhd, hdlr, minf])])
+
+def make_clip(path):
+    '''Write a clip with mdat ahead of moov, the way cameras record them.'''
+    ftyp = Atom('ftyp', b'qt  \0\0\0\0qt  ').encode()
+    data = bytearray()
+    offsets = {}
+    base = len(ftyp) + 8
+    for handler, count, delta, keyframes in TRACKS:
+        offsets[handler] = []
+        for i in range(count):
+            offsets[handler].append(base + len(data))
+            data += sample_data(handler, i)
+
+    duration = TRACKS[0][1] * TRACKS[0][2]
+    mvhd = full_atom('mvhd', 0, struct.pack('>IIII', CREATION_TIME, CREATION_TIME, TIMESCALE, duration) + bytes(80))
+    traks = [make_trak(handler, count, delta, keyframes, offsets[handler]) for handler, count, delta, keyframes in TRACKS]
+    with open(path, 'wb') as fp:
+        fp.write(ftyp)
+        fp.write(Atom('mdat', bytes(data)).encode())
+        fp.write(Atom('moov', children=[mvhd] + traks).encode())
+
+def read_tracks(path):
+    with open(path, 'rb') as fp:
+        moov = Atom('moov', children=parse_atoms(read_top_atom(fp, 'moov')))
+        fp.seek(0)
+        data = fp.read()
+    tracks = {}
+    for trak in moov.children:
+        if trak.type == 'trak':
+            t = Track(trak)
+            t.data = [data[ofs:ofs + size] for ofs, size in zip(t.offsets, t.sizes)]
+            tracks[t.handler] = t
+    return moov, data, tracks
+
+@pytest.fixture
+def clip(tmp_path):
+    path = str(tmp_path / 'clip.mov')
+    make_clip(path)
+    return path
+
+def test_excerpt_starts_at_keyframe(clip, tmp_path):
+    dst = str(tmp_path / 'excerpt.mov')
+    assert write_excerpt(clip, dst, 5.5, 7.5) == (4.0, 8.0)
+
+    moov, data, tracks = read_tracks(dst)
+    video, audio = tracks['vide'], tracks['soun']
+    assert video.data == [sample_data('vide', i) for i in range(4, 8)]
+    assert audio.data == [sample_data('soun', i) for i in range(8, 16)]
+    assert video.keyframes == [0]
+    assert video.duration == 4000
+    assert audio.duration == 4000
+
+    # moov comes first, so the excerpt plays while it downloads
+    assert data.index(b'moov') < data.index(b'mdat')
+
+def test_excerpt_creation_time(clip, tmp_path):
+    # do_copy.py takes the creation time as the end of recording, so it moves back
+    # by the time cut off the end
+    dst = str(tmp_path / 'excerpt.mov')
+    assert write_excerpt(clip, dst, 1, 3) == (0.0, 3.0)
+    moov, data, tracks = read_tracks(dst)
+    ctime, mtime, scale, duration = struct.unpack_from('>IIII', moov.find('mvhd').data, 4)
+    assert (scale, duration) == (TIMESCALE, 3000)
+    assert ctime == CREATION_TIME - 7
+
+def test_excerpt_to_end(clip, tmp_path):
+    dst = str(tmp_path / 'excerpt.mov')
+    assert write_excerpt(clip, dst, 9, float('inf')) == (8.0, 10.0)
+    moov, data, tracks = read_tracks(dst)
+    assert tracks['vide'].data == [sample_data('vide', i) for i in range(8, 10)]
+    assert tracks['soun'].data == [sample_data('soun', i) for i in range(16, 20)]
+
+def test_excerpt_past_end(clip, tmp_path):
+    with pytest.raises(ValueError):
+        write_excerpt(clip, str(tmp_path / 'excerpt.mov'), 12, 15)
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+'''Times reading the creation time and duration of every clip in a directory, the
+way do_copy.py does for new clips:
+
+    probe_bench.py /media/autocopy/front/DCIM/MOVIE
+
+Each method is run over every clip. Unless -c is given, the clips are dropped from
+the page cache before each run so the card is actually read; that only works for
+files this user can open, and a USB card reader may cache on its own.
+'''
+import io
+import os
+import time
+import argparse
+from os.path import join, splitext
+from concurrent.futures import ThreadPoolExecutor
+
+from mp4_atoms import ProbeFile, decode_mvhd
+from do_copy import fadvise, FADV_DONTNEED, PROBE_THREADS
+
+class CountingRaw(io.FileIO):
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        self.reads = 0
+
+    def readinto(self, b):
+        self.reads += 1
+        return super().readinto(b)
+
+class CountingFile(io.BufferedReader):
+    '''A plain buffered file, as opened by open(path, 'rb'), that counts the reads
+    reaching the disk.'''
+    def __init__(self, path):
+        super().__init__(CountingRaw(path))
+
+    @property
+    def reads(self):
+        return self.raw.reads
+
+def probe(opener, path):
+    fp = opener(path)
+    try:
+        decode_mvhd(fp)
+        return fp.reads, None
+    except Exception as e:
+        return fp.reads, e
+    finally:
+        fp.close()
+
+def drop_cache(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fadvise(fd, 0, 0, FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def run(name, paths, opener, threads, cached):
+    if not cached:
+        drop_cache(paths)
+
+    st = time.monotonic()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(lambda path: probe(opener, path), paths))
+    else:
+        results = [probe(opener, path) for path in paths]
+    elapsed = time.monotonic() - st
+
+    reads = sum(r for r, e in results)
+    errors = sum(1 for r, e in results if e is not None)
+    print('%-24s %8.1f ms %8.0f clips/s %6.2f reads/clip %5d errors' % (
+        name, elapsed * 1000, len(paths) / elapsed if elapsed else 0, reads / len(paths), errors))
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark reading clip headers')
+    p.add_argument('path', help='directory of clips')
+    p.add_argument('-j', '--threads', type=int, default=PROBE_THREADS, help='threads for the parallel run (default %d)' % PROBE_THREADS)
+    p.add_argument('-c', '--cached', action='store_true', help='don\'t drop the clips from the page cache first')
+    args = p.parse_args()
+
+    paths = sorted(join(args.path, fn) for fn in os.listdir(args.path)
+                   if splitext(fn)[1].lower() in ('.mov', '.mkv', '.mp4'))
+    if not paths:
+        print('no clips in %s' % args.path)
+        return
+
+    print('%d clips' % len(paths))
+    run('buffered, serial', paths, CountingFile, 1, args.cached)
+    run('coalesced, serial', paths, ProbeFile, 1, args.cached)
+    run('coalesced, %d threads' % args.threads, paths, ProbeFile, args.threads, args.cached)
+
+if __name__ == '__main__':
+    main()
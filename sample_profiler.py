@@ -0,0 +1,99 @@
+'''Statistical profiler for the main thread of a running process.
+
+While active, an interval timer interrupts the process every few milliseconds and
+the signal handler records the main thread's Python stack. When the time is up, the
+stacks are written out in the collapsed format flamegraph.pl and speedscope read:
+
+    serial_monitor.py:main;serial_monitor.py:run;monitor_hotload.py:tick 42
+
+Nothing is installed while the profiler is idle, so it costs nothing until started.
+The wall-clock timer (the default) also samples while the thread is blocked in
+sleep, read or poll, which is what shows up as lag; the CPU timer only samples while
+the process is running.
+'''
+import os
+import time
+import signal
+from os.path import basename, join
+
+DEFAULT_INTERVAL = 0.005
+
+# Longest run allowed, so a typo can't leave the timer running for hours
+MAX_DURATION = 600
+
+TIMERS = {
+    'real': (signal.ITIMER_REAL, signal.SIGALRM),
+    'cpu': (signal.ITIMER_PROF, signal.SIGPROF),
+}
+
+class SampleProfiler:
+    def __init__(self, outdir='profiles'):
+        self.outdir = outdir
+        self.active = False
+        self.counts = None
+        self.samples = 0
+        self.end_time = 0
+        self.timer = None
+        self.old_handler = None
+        self.path = None
+
+    def start(self, duration, interval=DEFAULT_INTERVAL, clock='real'):
+        '''Sample every interval seconds for duration seconds, then write the
+        profile. Returns the path it will be written to.'''
+        if self.active:
+            self.stop()
+
+        itimer, signum = self.timer = TIMERS[clock]
+        self.counts = {}
+        self.samples = 0
+        self.end_time = time.monotonic() + min(duration, MAX_DURATION)
+        os.makedirs(self.outdir, exist_ok=True)
+        self.path = join(self.outdir, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+
+        self.old_handler = signal.signal(signum, self._sample)
+        signal.setitimer(itimer, interval, interval)
+        self.active = True
+        print('profiler: sampling every %.1f ms for %g s (%s)' % (interval * 1000, duration, clock))
+        return self.path
+
+    def stop(self):
+        '''Stop sampling and write what was collected.'''
+        if not self.active:
+            return None
+
+        itimer, signum = self.timer
+        signal.setitimer(itimer, 0)
+        signal.signal(signum, self.old_handler or signal.SIG_DFL)
+        self.active = False
+        self.old_handler = None
+
+        self.write(self.path)
+        print('profiler: wrote %d samples to %s' % (self.samples, self.path))
+        self.counts = None
+        return self.path
+
+    def _sample(self, signum, frame):
+        # Runs in the main thread between bytecodes. Keep it cheap: just the code
+        # objects, formatted once when writing.
+        key = []
+        while frame is not None:
+            key.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(key)
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + 1
+        self.samples += 1
+
+        if time.monotonic() >= self.end_time:
+            self.stop()
+
+    def write(self, path):
+        merged = {}
+        for key, count in self.counts.items():
+            names = ';'.join('%s:%s' % (basename(code.co_filename), code.co_name) for code in reversed(key))
+            merged[names] = merged.get(names, 0) + count
+
+        with open(path + '~', 'w') as fp:
+            for names, count in sorted(merged.items()):
+                fp.write('%s %d\n' % (names, count))
+        os.rename(path + '~', path)
@@ -21,6 +21,12 @@ from select import EPOLLIN, EPOLLOUT
 
 from utils import load_config, CONFIG, getmtime
 from bitstream import BitStream
+from latency_trace import LatencyTrace
+from metrics import Metrics
+from sample_profiler import SampleProfiler
+from stall_detector import StallDetector
+from hud_shm import WidgetConfig
+import hud_mirror
 
 import hotload
 import monitor_hotload
@@ -64,6 +70,11 @@ def setup_serial_canon(fd, speed):
 
 BLUETOOTH_DISCONNECTED, BLUETOOTH_CONNECTIONG, BLUETOOTH_CONNECTED = range(3)
 
+TICK_INTERVAL = 0.25
+
+# A tick starting later than this after it was due counts as an overrun
+TICK_SLACK = 0.05
+
 class SerialMonitor:
     def __init__(self, args, term_fd, shell_fd):
         self.args = args
@@ -97,6 +108,13 @@ class SerialMonitor:
         self.bt_in_query = False
         self.bt_telesc = False
 
+        # Mirrors the HUD to the phone over the same link; bt_mirror_link is what the
+        # phone has been sent since it last connected
+        self.hud_mirror = None
+        if CONFIG.get('bluetooth_hud_mirror'):
+            self.hud_mirror = hud_mirror.Mirror(WidgetConfig.from_mmap('/dev/shm/hud'))
+        self.bt_mirror_link = None
+
         self.poller = select.epoll()
         #print('term fd = %d' % term_fd)
         self.poller.register(self.term_fd, EPOLLIN)
@@ -106,7 +124,27 @@ class SerialMonitor:
 
         self.verbose_dbg = False
 
+        # When a widget value held back by max_rate is due (getmtime), or 0 for none;
+        # set by monitor_hotload
+        self.flush_deadline = 0
+
         self.shell_outbuf = bytearray()
+
+        self.latency_trace = LatencyTrace.create()
+        self.frame_crc_time = None
+        self.profiler = SampleProfiler()
+
+        self.metrics = m = Metrics('serial_monitor')
+        self.m_frames = m.counter('frames')
+        self.m_crc_errors = m.counter('crc_errors')
+        self.m_serial_bytes = m.counter('serial_in', 'B')
+        self.m_ticks = m.counter('ticks')
+        self.m_tick_overruns = m.counter('tick_overruns')
+        self.m_tick_overrun_time = m.counter('tick_overrun_time', 's')
+        self.m_tick_time = m.histogram('tick_time')
+        self.m_ticks_skipped = m.counter('ticks_skipped')
+        self.stalls = StallDetector(m)
+
         monitor_hotload.init(self)
 
 
@@ -128,6 +166,23 @@ class SerialMonitor:
         self.bt_outbuf.extend(dat)
         self.bluetooth_push()
 
+    def mirror_hud(self):
+        '''Send the phone whatever changed on the HUD, unless the link is still backed
+        up, in which case it gets the latest state later.'''
+        if self.hud_mirror is None or self.bluetooth_fd is None:
+            return
+        if len(self.bt_outbuf) >= hud_mirror.MAX_OUTBUF:
+            return
+        try:
+            self.hud_mirror.refresh()
+            out = self.hud_mirror.encode_changes(self.bt_mirror_link)
+        except Exception:
+            self.log('exception mirroring HUD')
+            traceback.print_exc()
+            return
+        if out:
+            self.bluetooth_write(hud_mirror.spp_frame(out))
+
     def register_subprocess(self, proc):
         self.all_subprocesses.append(proc)
 
@@ -193,6 +248,7 @@ class SerialMonitor:
             if self.bluetooth_fd is None:
                 self.bluetooth_fd = os.open('/dev/rfcomm0', os.O_RDWR | os.O_NONBLOCK)
                 del self.bt_outbuf[:]
+                self.bt_mirror_link = hud_mirror.LinkState()
                 setup_serial(self.bluetooth_fd, termios.B4000000)
                 self.register_fd(self.bluetooth_fd, self.bluetooth_read)
 
@@ -334,11 +390,19 @@ class SerialMonitor:
         etx_count = 0
 
         next_tick = 0
+        stalls = self.stalls
 
         while True:
+            stalls.end_iteration()
             ctime = getmtime()
             wtime = max(0, next_tick - ctime)
             if wtime == 0:
+                late = ctime - next_tick
+                if next_tick and late > TICK_SLACK:
+                    self.m_tick_overruns.inc()
+                    self.m_tick_overrun_time.inc(late)
+
+                stalls.begin('reload')
                 try:
                     mod, reloaded = hotload.tryreload(monitor_hotload, report_error=False)
                 except Exception:
@@ -349,18 +413,49 @@ class SerialMonitor:
                 if reloaded:
                     self.log('reloaded module')
                     self.try_call('init')
+                stalls.end()
+
+                stalls.begin('tick')
                 self.try_call('tick')
+                stalls.end()
 
+                stalls.begin('subprocesses')
                 self.check_subprocesses()
-                next_tick += 0.25
-                if next_tick <= ctime:
-                    next_tick = ctime + 0.25
+                stalls.end()
+
+                stalls.begin('hud_mirror')
+                self.mirror_hud()
+                stalls.end()
+
+                self.m_ticks.inc()
+                self.m_tick_time.observe((getmtime() - ctime) * 1000)
+                if not next_tick:
+                    # First tick; there was no schedule to fall behind
+                    next_tick = ctime + TICK_INTERVAL
+                else:
+                    next_tick += TICK_INTERVAL
+                    if next_tick <= ctime:
+                        # Fell behind by more than a whole tick; start over from now
+                        self.m_ticks_skipped.inc(int((ctime - next_tick) / TICK_INTERVAL) + 1)
+                        next_tick = ctime + TICK_INTERVAL
+
+            if self.flush_deadline:
+                ftime = self.flush_deadline - getmtime()
+                if ftime <= 0:
+                    self.flush_deadline = 0
+                    stalls.begin('flush')
+                    self.try_call('flush_widgets')
+                    stalls.end()
+                else:
+                    wtime = min(wtime, ftime)
 
             events = poll.poll(wtime)
             for fd, event in events:
                 if fd == self.term_fd:
+                    stalls.begin('serial')
                     data = os.read(fd, 256)
                     ldata = len(data)
+                    self.m_serial_bytes.inc(ldata)
                     pos = 0
                     while pos < ldata:
                         frame, pos = bs.parse_data(data, pos, ldata - pos)
@@ -377,17 +472,25 @@ class SerialMonitor:
                             read_crc = bs.read_bits(15)
                             calc_crc = bs.calc_crc()
                             if read_crc == calc_crc:
+                                self.m_frames.inc()
+                                if self.latency_trace.enabled:
+                                    self.frame_crc_time = getmtime()
                                 self.parse_frame(bs)
                             else:
+                                self.m_crc_errors.inc()
                                 buf = bs.getbuffer()
                                 self.log('crc error: read %04x, calc %04x: %r' % (read_crc, calc_crc, buf))
+                    stalls.end()
 
                 else:
                     func = self.read_funcs.get(fd)
                     if func:
+                        stalls.begin(func.__name__)
                         func(fd, event)
+                        stalls.end()
 
     def stop(self):
+        self.profiler.stop()
         self.gpio_poll.terminate()
         if self.bluetooth_process and self.bluetooth_process.returncode is None:
             os.kill(self.bluetooth_process.pid, signal.SIGTERM)
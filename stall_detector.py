@@ -0,0 +1,109 @@
+'''Finds what is holding up an event loop.
+
+The loop brackets each piece of work with begin() / end() and calls end_iteration()
+once per pass. Any pass whose work took longer than the threshold is logged with a
+breakdown by section, and counted in the metrics against the section that took the
+longest.
+
+A section only reports that it was slow once it is over, which doesn't say which
+function inside it was slow. So a watchdog thread also looks at the section that is
+running. If it has been running longer than the threshold, the watchdog records the
+main thread's stack, and that stack is printed with the report, e.g. for a tick
+that spent 2 s in send_info_packet -> time.sleep.
+'''
+import sys
+import time
+import threading
+import traceback
+from os.path import basename
+
+from utils import getmtime
+
+STALL_THRESHOLD = 0.1
+
+# Stack frames to print with a stall report, innermost last
+REPORT_FRAMES = 6
+
+class StallDetector:
+    def __init__(self, metrics, threshold=STALL_THRESHOLD):
+        self.metrics = metrics
+        self.threshold = threshold
+
+        # (name, start time) of the running section, or None; replaced as a whole so
+        # the watchdog never sees a name with the wrong start time
+        self.current = None
+        self.times = {}
+        self.stall_stack = None
+
+        self.m_stalls = metrics.counter('stalls')
+        self.m_stall_time = metrics.counter('stall_time', 's')
+        self.m_busy_time = metrics.histogram('loop_busy_time')
+        self.section_metrics = {}
+
+        self.main_ident = threading.get_ident()
+        self.watchdog = threading.Thread(target=self.run_watchdog, name='stall watchdog', daemon=True)
+        self.watchdog.start()
+
+    def begin(self, name):
+        self.current = name, getmtime()
+
+    def end(self):
+        cur = self.current
+        if cur is not None:
+            self.current = None
+            name, start = cur
+            times = self.times
+            times[name] = times.get(name, 0) + (getmtime() - start)
+
+    def end_iteration(self):
+        '''Check the pass that just finished and start a new one.'''
+        times = self.times
+        if not times:
+            return
+        busy = sum(times.values())
+        self.m_busy_time.observe(busy * 1000)
+        if busy >= self.threshold:
+            self.report(busy, times)
+        self.times = {}
+
+    def report(self, busy, times):
+        worst = max(times, key=times.get)
+        self.m_stalls.inc()
+        self.m_stall_time.inc(busy)
+
+        count, worst_ms = self.get_section_metrics(worst)
+        count.inc()
+        if times[worst] * 1000 > worst_ms.value:
+            worst_ms.set(times[worst] * 1000)
+
+        breakdown = ', '.join('%s %.0f ms' % (name, t * 1000) for name, t in
+                              sorted(times.items(), key=lambda v: -v[1]))
+        print('stall: %.0f ms, mostly in %s (%s)' % (busy * 1000, worst, breakdown))
+
+        stack = self.stall_stack
+        self.stall_stack = None
+        if stack is not None and stack[0] == worst:
+            for fs in stack[1][-REPORT_FRAMES:]:
+                print('stall:   %s:%d %s' % (basename(fs.filename), fs.lineno, fs.name))
+
+    def get_section_metrics(self, name):
+        m = self.section_metrics.get(name)
+        if m is None:
+            m = self.section_metrics[name] = (
+                self.metrics.counter('stalls_in_%s' % name),
+                self.metrics.gauge('worst_%s' % name, 'ms'))
+        return m
+
+    def run_watchdog(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            cur = self.current
+            if cur is None or cur is reported:
+                continue
+
+            if getmtime() - cur[1] >= self.threshold:
+                reported = cur
+                frame = sys._current_frames().get(self.main_ident)
+                if frame is not None:
+                    self.stall_stack = cur[0], traceback.extract_stack(frame)
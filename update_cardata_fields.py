@@ -4,6 +4,7 @@ import re
 import time
 import os
 import argparse
+import itertools
 import subprocess
 import traceback
 
@@ -11,6 +12,7 @@ UPDATE_FILES = [
     'monitor_hotload.py',
     'cardata_shmem.py',
     'bitstream/bitstream.inc',
+    'bitstream/cardata.h',
 ]
 
 fields = [
@@ -132,8 +134,54 @@ for mcname, logname, dtype, bits, signed in fields:
 
     bigfirst.sort(key=lambda v: -v[0])
 
+# Fields filled in by the monitor rather than parsed from the data frame; these go
+# after the parsed fields, in this order.
+extra_fields = [
+ ('motion_state',          8,  0),
+ ('fw_millis',             32, 0),
+]
+
 field_by_name = {v[1]:v for v in fields}
 
+STRUCT_CHARS = {8: 'b', 16: 'h', 32: 'i'}
+
+def compute_layout():
+    '''Return ([(mcname, logname, typbits, signed, offset)], size) for the full CarData
+    structure, using the same alignment rules as C and ctypes.'''
+    all_fields = [(mcname, logname, typbits, signed) for typbits, mcname, logname, dtype, bits, signed in bigfirst]
+    all_fields.extend((name, name, typbits, signed) for name, typbits, signed in extra_fields)
+
+    layout = []
+    offset = 0
+    maxalign = 1
+    for mcname, logname, typbits, signed in all_fields:
+        size = typbits // 8
+        offset = (offset + size - 1) & ~(size - 1)
+        layout.append((mcname, logname, typbits, signed, offset))
+        offset += size
+        maxalign = max(maxalign, size)
+
+    return layout, (offset + maxalign - 1) & ~(maxalign - 1)
+
+layout, layout_size = compute_layout()
+
+def struct_format():
+    '''struct module format string matching the CarData layout, with explicit padding.'''
+    chars = []
+    pos = 0
+    for mcname, logname, typbits, signed, offset in layout:
+        chars.extend('x' * (offset - pos))
+        char = STRUCT_CHARS[typbits]
+        chars.append(char if signed else char.upper())
+        pos = offset + typbits // 8
+    chars.extend('x' * (layout_size - pos))
+
+    fmt = ['=']
+    for char, group in itertools.groupby(chars):
+        count = len(list(group))
+        fmt.append(char if count == 1 else '%d%s' % (count, char))
+    return ''.join(fmt)
+
 rxautostart = re.compile(r'^(\s*)(//|#)AUTO START : (.*)$')
 rxautoend = re.compile(r'^(\s*)(//|#)AUTO END')
 
@@ -181,9 +229,18 @@ def modify_file(path, all_changes, all_seen_changes):
 
 def add_struct_changes(changes):
     cc = changes['struct CarData'] = []
-    for typbits, mcname, logname, dtype, bits, signed in bigfirst:
+    for mcname, logname, typbits, signed, offset in layout:
         cc.append('uint%d_t %s;' % (typbits, mcname))
 
+    cc = changes['cardata offsets'] = []
+    for mcname, logname, typbits, signed, offset in layout:
+        cc.append('#define CARDATA_OFS_%s %d' % (mcname.upper(), offset))
+    cc.append('#define CARDATA_SIZE %d' % layout_size)
+    cc.append('')
+    for mcname, logname, typbits, signed, offset in layout:
+        cc.append('_Static_assert(offsetof(cardata_t, %s) == CARDATA_OFS_%s, "cardata_t.%s moved");' % (mcname, mcname.upper(), mcname))
+    cc.append('_Static_assert(sizeof(cardata_t) == CARDATA_SIZE, "cardata_t size changed");')
+
 def add_m2ret_changes(changes):
     cc = changes['build_data_frame'] = []
     for mcname, logname, dtype, bits, signed in fields:
@@ -191,9 +248,17 @@ def add_m2ret_changes(changes):
 
 def add_monitor_changes(changes):
     cc = changes['ctypes CarData fields'] = []
-    for typbits, mcname, logname, dtype, bits, signed in bigfirst:
+    for mcname, logname, typbits, signed, offset in layout:
         cc.append('(%r, ctypes.c_%sint%d),' % (logname, ('' if signed else 'u'), typbits))
 
+    cc = changes['numpy CarData layout'] = []
+    for mcname, logname, typbits, signed, offset in layout:
+        cc.append('(%r, %r, %d),' % (logname, '%s%d' % ('i' if signed else 'u', typbits // 8), offset))
+
+    cc = changes['CarData size and format'] = []
+    cc.append('CARDATA_SIZE = %d' % layout_size)
+    cc.append('CARDATA_STRUCT_FORMAT = %r' % struct_format())
+
     cc = changes['monitor_hotload CarDataLogger row_order'] = []
     for logname in log_fields:
         cc.append('%r,' % (logname))
@@ -0,0 +1,196 @@
+'''Decides which clips do_copy.py uploads first.
+
+Clips are sorted by a list of scorers, most important first. Each scorer gives a
+clip a sort key where lower goes first; later scorers only break ties, and the
+name breaks any that are left, as it did when clips were uploaded by name alone.
+
+    excerpts  the few seconds around each marker, cut out of their clips by
+              mp4_excerpt.py, so what matters arrives even over a slow link
+    partial   clips already partly uploaded, so an interrupted session finishes
+              what it started before starting anything else
+    markers   clips within MARKER_WINDOW of a marker (or a chosen event) in the
+              cardata logs
+    recent    newest first
+    small     smallest first; with a time budget, clips that can't finish within
+              it go last
+
+The order comes from upload_order in the config, or --order. The server remembers
+how much of each clip it has, and do_copy.py how much of that has no gaps, so a later
+session picks up wherever this one stopped.
+'''
+import os
+import bisect
+import gzip
+import json
+import fcntl
+import tempfile
+from os.path import join, dirname
+
+DEFAULT_ORDER = ['excerpts', 'partial', 'markers', 'recent']
+
+# Seconds either side of a marker that a clip must overlap to count as near it
+MARKER_WINDOW = 120
+
+scorers = {}
+
+def scorer(name):
+    def decorator(f):
+        scorers[name] = f
+        return f
+    return decorator
+
+class Clip:
+    '''A file do_copy.py needs to send. begintime and endtime are Unix times, or
+    None when unknown (e.g. cardata logs).'''
+    def __init__(self, name, size, startpos, begintime=None, endtime=None, excerpt=False):
+        self.name = name
+        self.size = size
+        self.startpos = startpos
+        self.remaining = max(0, size - startpos)
+        self.begintime = begintime
+        self.endtime = endtime
+        self.excerpt = excerpt
+
+@scorer('excerpts')
+def score_excerpts(sched, clip):
+    return 0 if clip.excerpt else 1
+
+@scorer('partial')
+def score_partial(sched, clip):
+    return 0 if clip.startpos > 0 else 1
+
+@scorer('markers')
+def score_markers(sched, clip):
+    if clip.begintime is None:
+        return 1
+    marks = sched.marks
+    i = bisect.bisect_left(marks, clip.begintime - MARKER_WINDOW)
+    return 0 if i < len(marks) and marks[i] <= (clip.endtime or clip.begintime) + MARKER_WINDOW else 1
+
+@scorer('recent')
+def score_recent(sched, clip):
+    return -(clip.begintime or 0)
+
+@scorer('small')
+def score_small(sched, clip):
+    if sched.budget_bytes is not None:
+        return (0 if clip.remaining <= sched.budget_bytes else 1), clip.remaining
+    return clip.remaining
+
+class Scheduler:
+    def __init__(self, order=DEFAULT_ORDER, marks=(), budget=None, rate=None, tiebreak=None):
+        '''budget is the seconds expected to be available and rate the expected
+        upload speed in bytes per second; both are needed for the budget to apply.'''
+        unknown = [name for name in order if name not in scorers]
+        if unknown:
+            raise ValueError('unknown upload order %s; choose from %s' % (', '.join(unknown), ', '.join(sorted(scorers))))
+        self.order = [scorers[name] for name in order]
+        self.marks = sorted(marks)
+        self.budget_bytes = budget * rate if budget and rate else None
+        self.tiebreak = tiebreak or (lambda name: name)
+
+    def key(self, clip):
+        return tuple(f(self, clip) for f in self.order) + (self.tiebreak(clip.name),)
+
+    def sort(self, clips):
+        return sorted(clips, key=self.key)
+
+####################################################################################
+# Markers from the cardata logs
+
+def read_log_marks(path, events=()):
+    '''Unix times of the markers, and of events named in events, in one cardata
+    log. A log that is still being written ends early; what was read is returned.'''
+    marks = []
+    mono = 0
+    sync = None
+    try:
+        with gzip.open(path, 'rt', errors='replace') as fp:
+            for line in fp:
+                row = line.rstrip('\n').split('\t')
+                if len(row) < 3:
+                    continue
+                try:
+                    mono += int(row[0])
+                except ValueError:
+                    continue
+
+                typ = row[1]
+                if typ == 'W':
+                    sync = mono, int(row[2])
+                elif sync is not None and (typ == 'M' or (typ == 'E' and row[3:4] and row[3] in events)):
+                    marks.append((sync[1] + mono - sync[0]) / 1000)
+    except (OSError, EOFError, ValueError) as e:
+        print('%s: read stopped: %s' % (path, e))
+    return marks
+
+def find_marks(logdir, cache_path, events=()):
+    '''Unix times of every marker in the logs in logdir. Each log is only read
+    again if its size or mtime changed since cache_path was written.'''
+    try:
+        with open(cache_path) as fp:
+            cache = json.load(fp)
+        if cache.get('events') != sorted(events):
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+
+    logs = cache.get('logs', {})
+    new_logs = {}
+    marks = []
+    try:
+        names = [fn for fn in os.listdir(logdir) if fn.endswith('.txt.gz')]
+    except FileNotFoundError:
+        names = []
+
+    for fn in names:
+        try:
+            st = os.stat(join(logdir, fn))
+        except OSError:
+            continue
+        ent = logs.get(fn)
+        if ent is None or ent[0] != st.st_size or ent[1] != st.st_mtime:
+            ent = [st.st_size, st.st_mtime, read_log_marks(join(logdir, fn), events)]
+        new_logs[fn] = ent
+        marks.extend(ent[2])
+
+    if new_logs != logs:
+        write_json(cache_path, {'events': sorted(events), 'logs': new_logs})
+
+    return sorted(marks)
+
+####################################################################################
+# Upload rate, remembered between sessions for the time budget
+
+def load_rate(path, copyname):
+    try:
+        with open(path) as fp:
+            return json.load(fp).get(copyname)
+    except (OSError, ValueError):
+        return None
+
+def save_rate(path, copyname, rate):
+    # Every camera's copy runs at once and shares the file; lock so none is lost
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as fp:
+                rates = json.load(fp)
+        except (OSError, ValueError):
+            rates = {}
+        rates[copyname] = rate
+        write_json(path, rates)
+
+####################################################################################
+# Files in cvmeta, which the copies for every camera share
+
+def write_json(path, data):
+    '''Replace path with data in one step. The temporary file is unique, so copies
+    running at once can't write into each other's.'''
+    with tempfile.NamedTemporaryFile('w', dir=dirname(path) or '.', prefix='.tmp-', delete=False) as fp:
+        try:
+            json.dump(data, fp)
+        except BaseException:
+            os.unlink(fp.name)
+            raise
+    os.replace(fp.name, path)
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+'''Checks the upload order from upload_schedule.py, reading markers from cardata
+logs, and the rate file every camera's copy shares. Runs under pytest or as a
+script.'''
+import gzip
+import threading
+
+import pytest
+
+import upload_schedule
+from upload_schedule import Scheduler, Clip
+
+def names(sched, clips):
+    return [clip.name for clip in sched.sort(clips)]
+
+def test_default_order():
+    clips = [
+        Clip('old.mov', 100, 0, 1000, 1060),
+        Clip('new.mov', 100, 0, 5000, 5060),
+        Clip('partial.mov', 100, 50, 2000, 2060),
+        Clip('marked.mov', 100, 0, 3000, 3060),
+        Clip('marked_excerpt.mov', 10, 0, 3010, 3030, excerpt=True),
+    ]
+    sched = Scheduler(marks=[3020])
+    assert names(sched, clips) == ['marked_excerpt.mov', 'partial.mov', 'marked.mov', 'new.mov', 'old.mov']
+
+def test_marker_window():
+    window = upload_schedule.MARKER_WINDOW
+    sched = Scheduler(['markers'], marks=[1000])
+    near = Clip('near.mov', 1, 0, 1000 + window - 1, 1000 + window + 59)
+    far = Clip('far.mov', 1, 0, 1000 + window + 1, 1000 + window + 61)
+    assert names(sched, [far, near]) == ['near.mov', 'far.mov']
+
+def test_budget():
+    # 100 bytes/s for 10 s: the big clip can't finish, so it goes last
+    sched = Scheduler(['small'], budget=10, rate=100)
+    clips = [Clip('big.mov', 5000, 0), Clip('fits.mov', 900, 0), Clip('tiny.mov', 10, 0)]
+    assert names(sched, clips) == ['tiny.mov', 'fits.mov', 'big.mov']
+
+def test_unknown_order():
+    with pytest.raises(ValueError):
+        Scheduler(['excerpts', 'bogus'])
+
+def test_read_log_marks(tmp_path):
+    path = str(tmp_path / 'log.txt.gz')
+    with gzip.open(path, 'wt') as fp:
+        fp.write('0\tW\t1700000000000\n')
+        fp.write('1500\tM\t\n')
+        fp.write('500\tE\t1\tbrake\n')
+        fp.write('1000\tE\t2\thorn\n')
+    assert upload_schedule.read_log_marks(path) == [1700000001.5]
+    assert upload_schedule.read_log_marks(path, ['horn']) == [1700000001.5, 1700000003.0]
+
+def test_save_rate_concurrent(tmp_path):
+    # Every camera's copy saves its rate at about the same time; none may be lost
+    path = str(tmp_path / 'upload_rate.json')
+    threads = [threading.Thread(target=upload_schedule.save_rate, args=(path, 'cam%d' % i, i))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(8):
+        assert upload_schedule.load_rate(path, 'cam%d' % i) == i
+
+def main():
+    raise SystemExit(pytest.main([__file__]))
+
+if __name__ == '__main__':
+    main()
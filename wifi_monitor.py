@@ -11,12 +11,13 @@ import traceback
 from os.path import dirname, basename, join, exists, expanduser
 
 from utils import load_config, CONFIG, getmtime, get_iface_address, getaddr, getmask, pack_addr, unpack_addr
+from metrics import Metrics
 
 STATUS_TEXT = ['NOADDR', 'PINGFAIL', 'WRONGLAN', 'READY']
 STATUS_NOADDR, STATUS_PINGFAIL, STATUS_WRONGLAN, STATUS_READY = range(4)
 
 class InterfaceManager:
-    def __init__(self, iface, driver):
+    def __init__(self, iface, driver, metrics):
         self.iface = iface
         self.driver = driver
         self.last_poke = 0
@@ -24,6 +25,10 @@ class InterfaceManager:
         self.ping_fail_count = 0
         self.last_status = None
 
+        self.m_status = metrics.gauge('%s_status' % iface)
+        self.m_ping_fails = metrics.counter('%s_ping_fails' % iface)
+        self.m_pokes = metrics.counter('%s_pokes' % iface)
+
     def get_status(self):
         addr = getaddr(self.iface)
         mask = getmask(self.iface)
@@ -49,8 +54,10 @@ class InterfaceManager:
         if status != self.last_status:
             self.last_status = status
             print('%s status = %s' % (self.iface, STATUS_TEXT[status]))
+            self.m_status.set(status)
 
         if status == STATUS_PINGFAIL:
+            self.m_ping_fails.inc()
             self.ping_fail_count += 1
         else:
             self.ping_fail_count = 0
@@ -61,6 +68,7 @@ class InterfaceManager:
 
         if self.ping_fail_count == 4 or (status == STATUS_NOADDR and (ctime > self.last_poke + 30)):
             print('poke %s' % self.iface)
+            self.m_pokes.inc()
             subprocess.call(['rmmod', self.driver])
             subprocess.call(['modprobe', self.driver])
             self.last_poke = ctime
@@ -79,9 +87,13 @@ def flag_prop(flag):
 
 class Manager:
     def __init__(self):
+        self.metrics = m = Metrics('wifi_monitor')
+        self.m_check_time = m.histogram('check_time')
+        self.m_addr_changes = m.counter('addr_changes')
+
         self.interfaces = [
-            InterfaceManager('wlan0', 'brcmfmac'),
-            #InterfaceManager('wlan1', '8822bu'),
+            InterfaceManager('wlan0', 'brcmfmac', m),
+            #InterfaceManager('wlan1', '8822bu', m),
         ]
 
         self.wifi_addr = None
@@ -120,10 +132,12 @@ class Manager:
 
             if addr != self.wifi_addr:
                 self.wifi_addr = addr
+                self.m_addr_changes.inc()
                 print('wifi_addr = %s' % addr)
                 with open('wifi-addr', 'w') as fp:
                     fp.write('%s\n' % (addr or ''))
             ttime = getmtime() - sttime
+            self.m_check_time.observe(ttime * 1000)
             sleeptime = 1.0 - ttime
             if sleeptime > 0:
                 time.sleep(sleeptime)